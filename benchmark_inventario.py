@@ -0,0 +1,101 @@
+# ecommerce-flask/benchmark_inventario.py
+#
+# Compara checkouts/segundo sobre un solo producto "caliente" con y sin inventario fragmentado.
+# Cada checkout recorre el camino real: reservar al agregar al carrito y confirmar la reserva
+# como lo hace el worker de pedidos.
+#
+#   python benchmark_inventario.py --hilos 32 --segundos 10 --shards 16
+#
+# Usa la base de datos MONGO_DB_BENCHMARK (ecommerce_benchmark por defecto), nunca MONGO_DB, y se
+# niega a correr sobre una cuyo nombre no termine en _benchmark.
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+# Siempre una base de datos propia. MONGO_DB no se respeta a propósito.
+os.environ['MONGO_DB'] = os.environ.get('MONGO_DB_BENCHMARK', 'ecommerce_benchmark')
+
+from bson import ObjectId  # noqa: E402
+
+import database  # noqa: E402  (debe importarse después de fijar MONGO_DB)
+
+SUFIJO_BASE = '_benchmark'
+
+
+def _verificar_base_de_prueba():
+    """Aborta si la base de datos no es una de prueba (su nombre debe terminar en _benchmark)."""
+    nombre = database._db_primaria.name
+    if not nombre.endswith(SUFIJO_BASE):
+        sys.exit(f"La base de datos '{nombre}' no termina en '{SUFIJO_BASE}'; no se usa para el benchmark.")
+
+
+def _limpiar():
+    """Borra solo los productos del benchmark y sus contadores y reservas."""
+    ids = [p['_id'] for p in database.db.productos.find({'benchmark': True}, {'_id': 1})]
+    database.db.inventario_shards.delete_many({'producto_id': {'$in': ids}})
+    database.db.reservas.delete_many({'producto_id': {'$in': ids}})
+    database.db.productos.delete_many({'_id': {'$in': ids}})
+
+
+def _preparar_producto(inventario, shards):
+    _limpiar()
+    producto_id = database.db.productos.insert_one({
+        'nombre': 'Producto benchmark',
+        'precio': 1.0,
+        'inventario': inventario,
+        'reservado': 0,
+        'benchmark': True
+    }).inserted_id
+    if shards > 1:
+        database.activar_inventario_fragmentado(producto_id, shards)
+    return producto_id
+
+
+def _medir(producto_id, hilos, segundos):
+    completados = [0] * hilos
+    fin = time.monotonic() + segundos
+
+    def trabajador(indice):
+        usuario_id = ObjectId()
+        linea = [{'producto_id': producto_id, 'nombre': 'Producto benchmark', 'cantidad': 1}]
+        while time.monotonic() < fin:
+            # Agregar al carrito (reserva) y pagar (confirmación en el worker)
+            if not database.reservar_inventario(usuario_id, producto_id, 1):
+                continue
+            lote = ObjectId()  # en el worker es el _id del pedido
+            if not database.confirmar_reservas_carrito(usuario_id, linea, lote):
+                database.cerrar_reservas_confirmadas(lote)
+                completados[indice] += 1
+
+    trabajadores = [threading.Thread(target=trabajador, args=(i,)) for i in range(hilos)]
+    inicio = time.monotonic()
+    for t in trabajadores:
+        t.start()
+    for t in trabajadores:
+        t.join()
+    return sum(completados) / (time.monotonic() - inicio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de inventario fragmentado')
+    parser.add_argument('--hilos', type=int, default=32)
+    parser.add_argument('--segundos', type=float, default=10)
+    parser.add_argument('--shards', type=int, default=16)
+    parser.add_argument('--inventario', type=int, default=10_000_000)
+    args = parser.parse_args()
+
+    _verificar_base_de_prueba()
+    for etiqueta, shards in (('sin fragmentar', 1), (f'{args.shards} shards', args.shards)):
+        producto_id = _preparar_producto(args.inventario, shards)
+        tasa = _medir(producto_id, args.hilos, args.segundos)
+        restante = database.obtener_inventario_disponible(producto_id)
+        print(f"{etiqueta:>16}: {tasa:10.1f} checkouts/s  (inventario restante: {restante})")
+
+    _limpiar()
+
+
+if __name__ == '__main__':
+    main()
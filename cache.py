@@ -0,0 +1,165 @@
+# ecommerce-flask/cache.py
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+import config
+
+# --- Caché en memoria del catálogo ---
+# Cada proceso guarda sus propias copias (clave -> valor) durante CACHE_CATALOGO_SEGUNDOS como
+# máximo. Los valores se comparten entre peticiones: quien los lea no debe modificarlos.
+# Guarda como máximo CACHE_MAX_ENTRADAS claves: al escribir se descartan las vencidas y, si
+# todavía sobran, las usadas hace más tiempo (LRU).
+#
+# --- Bus de invalidación entre procesos ---
+# Las rutas de escritura del admin publican las claves afectadas en la colección 'cambios'
+# (capped). Cada proceso la revisa cada CACHE_INTERVALO_BUS segundos en su propio hilo y borra
+# solo esas claves. Una clave que termina en '*' borra todas las que empiezan con ese prefijo.
+# Si el bus se atrasa (la colección ya rotó los eventos pendientes o la revisión lleva fallando
+# más de CACHE_MAX_ATRASO_SEGUNDOS) se vacía la caché completa.
+
+_entradas = OrderedDict()  # clave -> (valor, vence), de la menos a la más recientemente usada
+_lock = threading.Lock()
+_manejadores = []  # (prefijo, función) que se llaman además de borrar la clave local
+
+_coleccion_cambios = None
+_hilo_bus = None
+
+
+def obtener_o_calcular(clave, funcion):
+    """Devuelve el valor cacheado de la clave o lo calcula con funcion() y lo guarda."""
+    ahora = time.monotonic()
+    with _lock:
+        entrada = _entradas.get(clave)
+        if entrada and entrada[1] > ahora:
+            _entradas.move_to_end(clave)
+            return entrada[0]
+
+    valor = funcion()
+    with _lock:
+        _entradas[clave] = (valor, ahora + config.CACHE_CATALOGO_SEGUNDOS)
+        _entradas.move_to_end(clave)
+        _podar(ahora)
+    return valor
+
+
+def _podar(ahora):
+    """Descarta las entradas vencidas y luego las menos usadas hasta CACHE_MAX_ENTRADAS. Requiere _lock."""
+    for clave in [c for c, (_, vence) in _entradas.items() if vence <= ahora]:
+        del _entradas[clave]
+    while len(_entradas) > config.CACHE_MAX_ENTRADAS:
+        _entradas.popitem(last=False)
+
+
+def _invalidar_local(claves):
+    with _lock:
+        for clave in claves:
+            if clave.endswith('*'):
+                prefijo = clave[:-1]
+                for existente in [c for c in _entradas if c.startswith(prefijo)]:
+                    del _entradas[existente]
+            else:
+                _entradas.pop(clave, None)
+
+    for clave in claves:
+        for prefijo, funcion in _manejadores:
+            if clave.startswith(prefijo):
+                try:
+                    funcion(clave[len(prefijo):])
+                except Exception as e:
+                    print(f"Error invalidando {clave}: {e}")
+
+
+def vaciar_cache():
+    with _lock:
+        _entradas.clear()
+
+
+def tamano_cache():
+    return len(_entradas)
+
+
+def registrar_manejador(prefijo, funcion):
+    """Llama a funcion(resto_de_la_clave) cuando llega un cambio cuya clave empieza con prefijo."""
+    _manejadores.append((prefijo, funcion))
+
+
+def publicar_cambio(*claves):
+    """Invalida las claves en este proceso y las anuncia a los demás."""
+    claves = [clave for clave in claves if clave]
+    if not claves:
+        return
+    _invalidar_local(claves)
+    if _coleccion_cambios is not None:
+        try:
+            _coleccion_cambios.insert_one({'claves': claves})
+        except Exception as e:
+            # Sin bus los demás procesos se ponen al día al vencer sus entradas
+            print(f"Error publicando cambio de caché: {e}")
+
+
+class _LectorCambios:
+    """Lee los eventos nuevos. Relee una ventana de CACHE_MARGEN_BUS segundos y descarta repetidos."""
+
+    def __init__(self, coleccion):
+        self.coleccion = coleccion
+        self.desde = datetime.now(timezone.utc)
+        self.vistos = {}
+        self.ultima_revision_ok = time.monotonic()
+
+    def revisar(self):
+        inicio = self.desde - timedelta(seconds=config.CACHE_MARGEN_BUS)
+        if time.monotonic() - self.ultima_revision_ok > config.CACHE_MAX_ATRASO_SEGUNDOS:
+            vaciar_cache()
+        elif self._se_perdieron_eventos(inicio):
+            vaciar_cache()
+
+        nuevos = []
+        for evento in self.coleccion.find({'_id': {'$gte': ObjectId.from_datetime(inicio)}}).sort('_id', 1):
+            if evento['_id'] not in self.vistos:
+                self.vistos[evento['_id']] = evento['_id'].generation_time
+                nuevos.extend(evento.get('claves', []))
+        if nuevos:
+            _invalidar_local(nuevos)
+
+        self.desde = datetime.now(timezone.utc)
+        self.ultima_revision_ok = time.monotonic()
+        limite = inicio - timedelta(seconds=config.CACHE_MARGEN_BUS)
+        self.vistos = {i: t for i, t in self.vistos.items() if t >= limite}
+
+    def _se_perdieron_eventos(self, inicio):
+        """La colección capped está llena y su evento más antiguo es posterior a la ventana pendiente."""
+        if self.coleccion.estimated_document_count() < config.CAMBIOS_MAX_DOCUMENTOS:
+            return False
+        mas_antiguo = self.coleccion.find_one({}, {'_id': 1}, sort=[('$natural', 1)])
+        return bool(mas_antiguo) and mas_antiguo['_id'].generation_time > inicio
+
+
+def _escuchar_cambios(lector):
+    while True:
+        try:
+            lector.revisar()
+        except Exception as e:
+            print(f"Error revisando el bus de caché: {e}")
+        time.sleep(config.CACHE_INTERVALO_BUS)
+
+
+def configurar_bus(coleccion):
+    """Indica la colección 'cambios' donde se publican los eventos."""
+    global _coleccion_cambios
+    _coleccion_cambios = coleccion
+
+
+def iniciar_bus():
+    """Inicia (una vez por proceso) el hilo que aplica los cambios publicados por otros procesos."""
+    global _hilo_bus
+    if _hilo_bus is not None or _coleccion_cambios is None:
+        return
+    _hilo_bus = threading.Thread(
+        target=_escuchar_cambios, args=(_LectorCambios(_coleccion_cambios),), name='bus-cache', daemon=True
+    )
+    _hilo_bus.start()
@@ -0,0 +1,128 @@
+# ecommerce-flask/config.py
+
+import os
+import tempfile
+
+# --- Configuración general (se puede sobreescribir con variables de entorno) ---
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+MONGO_DB = os.environ.get('MONGO_DB', 'ecommerce')
+
+# Lecturas tolerantes (catálogo, reseñas, reportes) a secundarios; ver POLITICA_LECTURA en database.py.
+# Para probarlo en local basta un replica set de un nodo:
+#   mongod --replSet rs0  y  rs.initiate()  con  MONGO_URI=mongodb://localhost:27017/?replicaSet=rs0
+MONGO_LECTURAS_SECUNDARIAS = os.environ.get('MONGO_LECTURAS_SECUNDARIAS', '1') == '1'
+MONGO_MAX_STALENESS_SEGUNDOS = int(os.environ.get('MONGO_MAX_STALENESS_SEGUNDOS', 90))  # MongoDB exige al menos 90
+
+# Tareas periódicas en segundo plano (barridos de limpieza, etc.)
+TAREAS_PERIODICAS_ACTIVAS = os.environ.get('TAREAS_PERIODICAS_ACTIVAS', '1') == '1'
+INTERVALO_BARRIDO_CARRITOS = int(os.environ.get('INTERVALO_BARRIDO_CARRITOS', 3600))  # segundos
+TAMANO_LOTE_BARRIDO = int(os.environ.get('TAMANO_LOTE_BARRIDO', 500))
+
+# Carritos abandonados: se eliminan tras este tiempo sin modificaciones (índice TTL)
+DIAS_EXPIRACION_CARRITO = int(os.environ.get('DIAS_EXPIRACION_CARRITO', 30))
+
+# Reservas de inventario al agregar al carrito
+MINUTOS_RESERVA = int(os.environ.get('MINUTOS_RESERVA', 15))
+INTERVALO_BARRIDO_RESERVAS = int(os.environ.get('INTERVALO_BARRIDO_RESERVAS', 60))  # segundos
+# Un lote de reservas tomado ('liberando'/'confirmando') por un proceso que murió vuelve a
+# 'activa' tras este tiempo y el barrido lo procesa de nuevo; uno ya 'aplicada' solo se borra
+SEGUNDOS_RECLAMO_RESERVA = int(os.environ.get('SEGUNDOS_RECLAMO_RESERVA', 300))
+
+# Cola de procesamiento de pedidos (worker_pedidos.py)
+COLA_TAMANO_LOTE = int(os.environ.get('COLA_TAMANO_LOTE', 50))
+COLA_MAX_INTENTOS = int(os.environ.get('COLA_MAX_INTENTOS', 5))
+COLA_SEGUNDOS_VISIBILIDAD = int(os.environ.get('COLA_SEGUNDOS_VISIBILIDAD', 120))
+COLA_ESPERA_SIN_TRABAJO = float(os.environ.get('COLA_ESPERA_SIN_TRABAJO', 1.0))  # segundos
+
+# Importación masiva de productos
+IMPORTACION_TAMANO_LOTE = int(os.environ.get('IMPORTACION_TAMANO_LOTE', 1000))
+IMPORTACION_MAX_ERRORES_REPORTE = int(os.environ.get('IMPORTACION_MAX_ERRORES_REPORTE', 500))
+
+# Exportaciones en streaming (CSV/JSONL)
+EXPORTACION_BATCH_SIZE = int(os.environ.get('EXPORTACION_BATCH_SIZE', 1000))  # documentos por viaje a MongoDB
+EXPORTACION_TAMANO_BLOQUE = int(os.environ.get('EXPORTACION_TAMANO_BLOQUE', 64 * 1024))  # bytes por bloque enviado
+
+# Cambios de estado de pedidos en lote (admin)
+PEDIDOS_LOTE_ESTADO = int(os.environ.get('PEDIDOS_LOTE_ESTADO', 500))
+
+# Contraseñas e inicio de sesión
+HASH_METODO = os.environ.get('HASH_METODO', 'scrypt:32768:8:1')  # formato de werkzeug; los hashes distintos se rehashean al entrar
+LOGIN_PROCESOS_HASH = int(os.environ.get('LOGIN_PROCESOS_HASH', 2))  # 0 = verificar en el mismo proceso
+LOGIN_COLA_MAXIMA = int(os.environ.get('LOGIN_COLA_MAXIMA', 16))  # verificaciones en curso por proceso web
+LOGIN_TIMEOUT_HASH = float(os.environ.get('LOGIN_TIMEOUT_HASH', 5))  # segundos
+LOGIN_VENTANA_SEGUNDOS = int(os.environ.get('LOGIN_VENTANA_SEGUNDOS', 900))
+LOGIN_MAX_FALLOS_CUENTA = int(os.environ.get('LOGIN_MAX_FALLOS_CUENTA', 5))
+LOGIN_MAX_FALLOS_IP = int(os.environ.get('LOGIN_MAX_FALLOS_IP', 30))
+
+# Carrito de invitado (se guarda en la cookie de sesión, que tiene un límite de ~4 KB)
+CARRITO_INVITADO_MAX_PRODUCTOS = int(os.environ.get('CARRITO_INVITADO_MAX_PRODUCTOS', 50))
+
+# Sesiones: 'servidor' (MongoDB con LRU en memoria) o 'cookie' (cookie firmada de Flask)
+SESIONES_ALMACEN = os.environ.get('SESIONES_ALMACEN', 'servidor')
+SESIONES_DIAS = int(os.environ.get('SESIONES_DIAS', 7))
+SESIONES_LRU_CAPACIDAD = int(os.environ.get('SESIONES_LRU_CAPACIDAD', 10000))
+SESIONES_LRU_SEGUNDOS = int(os.environ.get('SESIONES_LRU_SEGUNDOS', 30))  # máximo que un proceso tarda en ver un cambio
+
+# Caché en memoria del catálogo y bus de invalidación entre procesos (cache.py)
+CACHE_CATALOGO_SEGUNDOS = int(os.environ.get('CACHE_CATALOGO_SEGUNDOS', 60))  # atraso máximo aunque falle el bus
+CACHE_MAX_ENTRADAS = int(os.environ.get('CACHE_MAX_ENTRADAS', 1000))  # por proceso; se descartan las menos usadas
+CACHE_BUS_ACTIVO = os.environ.get('CACHE_BUS_ACTIVO', '1') == '1'
+CACHE_INTERVALO_BUS = float(os.environ.get('CACHE_INTERVALO_BUS', 1.0))  # segundos entre revisiones de 'cambios'
+CACHE_MARGEN_BUS = int(os.environ.get('CACHE_MARGEN_BUS', 5))  # segundos que se releen por escrituras concurrentes
+CACHE_MAX_ATRASO_SEGUNDOS = int(os.environ.get('CACHE_MAX_ATRASO_SEGUNDOS', 30))  # después, se vacía toda la caché
+CAMBIOS_MAX_DOCUMENTOS = int(os.environ.get('CAMBIOS_MAX_DOCUMENTOS', 10000))
+
+# Recomendaciones "comprados juntos" (flask recalcular-recomendaciones)
+RECOMENDACIONES_TOP_K = int(os.environ.get('RECOMENDACIONES_TOP_K', 10))  # vecinos guardados por producto
+RECOMENDACIONES_MOSTRAR = int(os.environ.get('RECOMENDACIONES_MOSTRAR', 4))  # tarjetas en producto y carrito
+RECOMENDACIONES_TAMANO_LOTE = int(os.environ.get('RECOMENDACIONES_TAMANO_LOTE', 1000))  # pedidos por bulk_write
+RECOMENDACIONES_MAX_PRODUCTOS_PEDIDO = int(os.environ.get('RECOMENDACIONES_MAX_PRODUCTOS_PEDIDO', 50))
+RECOMENDACIONES_BLOQUEO_SEGUNDOS = int(os.environ.get('RECOMENDACIONES_BLOQUEO_SEGUNDOS', 3600))  # si una ejecución muere
+
+# Directorio por usuario del proceso para perfiles y trazas (se crea con permisos 0700 y se verifica
+# su dueño antes de usarlo, como la caché de bytecode de Jinja); nunca una ruta compartida en /tmp
+DIRECTORIO_PRIVADO = os.path.join(
+    tempfile.gettempdir(), f'ecommerce-flask-{os.getuid()}' if hasattr(os, 'getuid') else 'ecommerce-flask'
+)
+
+# Perfilado bajo demanda (admin: ?_perfil=1 o encabezado X-Perfil: 1)
+PERFILADOR_ACTIVO = os.environ.get('PERFILADOR_ACTIVO', '1') == '1'
+# Los perfiles se cargan con marshal (pstats): el directorio debe ser del usuario y sin permisos para otros
+PERFILES_DIRECTORIO = os.environ.get('PERFILES_DIRECTORIO') or os.path.join(DIRECTORIO_PRIVADO, 'perfiles')
+PERFILES_MAXIMOS = int(os.environ.get('PERFILES_MAXIMOS', 50))  # los más antiguos se borran
+
+# Diagnóstico de memoria (/admin/memoria, tracemalloc por proceso)
+MEMORIA_RASTREO_AL_INICIAR = os.environ.get('MEMORIA_RASTREO_AL_INICIAR', '0') == '1'
+MEMORIA_MARCOS = int(os.environ.get('MEMORIA_MARCOS', 5))  # niveles de pila por asignación (más = más memoria)
+MEMORIA_MAX_INSTANTANEAS = int(os.environ.get('MEMORIA_MAX_INSTANTANEAS', 4))
+MEMORIA_LIMITE_DIFERENCIAS = int(os.environ.get('MEMORIA_LIMITE_DIFERENCIAS', 30))
+
+# Trazas (trazas.py): '' = desactivadas, 'archivo' = OTLP/JSON en TRAZAS_ARCHIVO, 'otlp' = collector local
+TRAZAS_EXPORTADOR = os.environ.get('TRAZAS_EXPORTADOR', '')
+TRAZAS_MUESTREO = float(os.environ.get('TRAZAS_MUESTREO', 0.05))  # fracción de peticiones trazadas (0 a 1)
+# '1': obedecer la bandera 'sampled' de un traceparent entrante (solo detrás de un proxy de confianza).
+# Si no, cualquier cliente podría forzar el trazado de todas sus peticiones; se usa TRAZAS_MUESTREO.
+TRAZAS_RESPETAR_TRACEPARENT = os.environ.get('TRAZAS_RESPETAR_TRACEPARENT', '0') == '1'
+TRAZAS_SERVICIO = os.environ.get('TRAZAS_SERVICIO', 'ecommerce-flask')
+TRAZAS_ARCHIVO = os.environ.get('TRAZAS_ARCHIVO') or os.path.join(DIRECTORIO_PRIVADO, 'trazas.jsonl')
+TRAZAS_OTLP_URL = os.environ.get('TRAZAS_OTLP_URL', 'http://localhost:4318/v1/traces')
+TRAZAS_OTLP_TIMEOUT = float(os.environ.get('TRAZAS_OTLP_TIMEOUT', 5))  # segundos
+TRAZAS_TAMANO_LOTE = int(os.environ.get('TRAZAS_TAMANO_LOTE', 512))  # spans por envío
+TRAZAS_INTERVALO_ENVIO = float(os.environ.get('TRAZAS_INTERVALO_ENVIO', 5))  # segundos máximos en la cola
+TRAZAS_COLA_MAXIMA = int(os.environ.get('TRAZAS_COLA_MAXIMA', 10000))  # después se descartan spans
+
+# Registro de consultas lentas (consultas_lentas.py, /admin/consultas-lentas)
+CONSULTAS_LENTAS_ACTIVAS = os.environ.get('CONSULTAS_LENTAS_ACTIVAS', '1') == '1'
+CONSULTAS_LENTAS_UMBRAL_MS = float(os.environ.get('CONSULTAS_LENTAS_UMBRAL_MS', 100))
+CONSULTAS_LENTAS_EXPLICAR = os.environ.get('CONSULTAS_LENTAS_EXPLICAR', '1') == '1'  # explain en la primera de cada forma
+CONSULTAS_LENTAS_MAXIMO = int(os.environ.get('CONSULTAS_LENTAS_MAXIMO', 200))  # ocurrencias en el búfer circular
+CONSULTAS_LENTAS_MAX_FORMAS = int(os.environ.get('CONSULTAS_LENTAS_MAX_FORMAS', 500))
+
+# Plantillas (plantillas.py): caché de bytecode de Jinja compartida entre workers
+PLANTILLAS_CACHE_BYTECODE = os.environ.get('PLANTILLAS_CACHE_BYTECODE', '1') == '1'
+# Sin definir: el directorio propio de Jinja (por usuario, permisos 0700 y dueño verificado).
+# Jinja carga las entradas con marshal: nunca debe ser un directorio en el que otros usuarios escriban.
+PLANTILLAS_CACHE_DIRECTORIO = os.environ.get('PLANTILLAS_CACHE_DIRECTORIO') or None
+# Revisar si cambió el archivo en cada uso: '1' sí, '0' no, sin definir solo en modo debug
+PLANTILLAS_AUTO_RECARGA = {'1': True, '0': False}.get(os.environ.get('PLANTILLAS_AUTO_RECARGA'))
+PLANTILLAS_PRECARGAR = os.environ.get('PLANTILLAS_PRECARGAR', '1') == '1'  # compilar todas al iniciar el proceso
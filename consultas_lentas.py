@@ -0,0 +1,257 @@
+# ecommerce-flask/consultas_lentas.py
+
+import json
+import os
+import queue
+import threading
+from collections import deque
+from datetime import datetime
+
+from pymongo import monitoring
+
+import config
+
+# --- Registro de consultas lentas ---
+# Un oyente de comandos de pymongo anota todo comando que tarda más de CONSULTAS_LENTAS_UMBRAL_MS
+# junto con su forma: el comando con los valores reemplazados por '?' (se conservan los campos,
+# los operadores, las etapas del pipeline y las rutas '$campo'), así las consultas que solo
+# cambian de parámetros se agrupan. La primera vez que aparece cada forma se ejecuta
+# explain("executionStats") con los valores originales en un hilo aparte (la petición no lo
+# espera) y se guardan documentos examinados contra devueltos y las etapas del plan (COLLSCAN,
+# SORT en memoria). Todo es por proceso y en memoria: un búfer circular con las últimas
+# CONSULTAS_LENTAS_MAXIMO ocurrencias y hasta CONSULTAS_LENTAS_MAX_FORMAS formas explicadas.
+
+# Comandos que se pueden explicar y los campos que definen su forma
+_CAMPOS_FORMA = {
+    'find': ('filter', 'sort', 'projection'),
+    'aggregate': ('pipeline',),
+    'count': ('query',),
+    'distinct': ('key', 'query'),
+    'findAndModify': ('query', 'sort', 'update'),
+    'update': ('updates',),
+    'delete': ('deletes',),
+}
+_IGNORADOS = {'explain', 'hello', 'ismaster', 'isMaster', 'ping', 'endSessions', 'killCursors', 'saslStart', 'saslContinue'}
+# Campos del comando que agrega el driver y que explain no acepta
+_CAMPOS_DRIVER = {
+    'lsid', '$clusterTime', '$db', 'txnNumber', '$readPreference', 'readConcern', 'writeConcern',
+    'apiVersion', 'apiStrict', 'apiDeprecationErrors', 'startTransaction', 'autocommit', 'ordered',
+}
+
+_lock = threading.Lock()
+_ocurrencias = deque(maxlen=config.CONSULTAS_LENTAS_MAXIMO)
+_formas = {}  # forma -> {'coleccion', 'comando', 'forma', 'veces', 'maximo_ms', 'ultima', 'explicacion'}
+
+_cliente = None
+_cola_explicaciones = None
+_pid_explicador = None
+
+
+def _forma(valor):
+    """Reemplaza los valores por '?' conservando la estructura y las rutas '$campo'."""
+    if isinstance(valor, dict):
+        return {clave: _forma(contenido) for clave, contenido in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        if valor and all(isinstance(elemento, dict) for elemento in valor):
+            return [_forma(elemento) for elemento in valor]
+        return ['?'] if valor else []
+    if isinstance(valor, str) and valor.startswith('$'):
+        return valor
+    return '?'
+
+
+def forma_comando(nombre, comando):
+    """Texto que identifica la forma del comando (colección, comando y campos relevantes)."""
+    campos = {campo: comando[campo] for campo in _CAMPOS_FORMA.get(nombre, ()) if campo in comando}
+    if nombre == 'update':
+        campos['updates'] = [{'q': u.get('q'), 'u': u.get('u')} for u in campos.get('updates', [])[:1]]
+    elif nombre == 'delete':
+        campos['deletes'] = [{'q': d.get('q')} for d in campos.get('deletes', [])[:1]]
+    if 'key' in campos:
+        campos['key'] = '$' + str(campos['key'])  # el campo de distinct es parte de la forma
+    return json.dumps(_forma(campos), sort_keys=False, default=str, ensure_ascii=False)
+
+
+def _documentos_devueltos(respuesta):
+    cursor = respuesta.get('cursor')
+    if cursor:
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', ())))
+    for campo in ('n', 'values'):
+        if campo in respuesta:
+            valor = respuesta[campo]
+            return len(valor) if isinstance(valor, list) else valor
+    return None
+
+
+class MonitorConsultasLentas(monitoring.CommandListener):
+    """Guarda los comandos explicables mientras corren y registra los que pasan del umbral."""
+
+    def __init__(self):
+        self._pendientes = {}
+
+    def started(self, event):
+        if event.command_name in _IGNORADOS:
+            return
+        comando = event.command
+        nombre = event.command_name
+        if nombre == 'getMore':
+            coleccion = comando.get('collection')
+        else:
+            coleccion = comando.get(nombre)
+        self._pendientes[(event.request_id, event.connection_id)] = (
+            event.database_name, coleccion, comando if nombre in _CAMPOS_FORMA else None
+        )
+
+    def succeeded(self, event):
+        datos = self._pendientes.pop((event.request_id, event.connection_id), None)
+        if datos is None or event.duration_micros < config.CONSULTAS_LENTAS_UMBRAL_MS * 1000:
+            return
+        base, coleccion, comando = datos
+        _registrar(base, coleccion, event.command_name, comando, event.duration_micros / 1000,
+                   _documentos_devueltos(event.reply))
+
+    def failed(self, event):
+        self._pendientes.pop((event.request_id, event.connection_id), None)
+
+
+def oyentes_consultas_lentas():
+    """Oyentes de comandos para el MongoClient de database.py."""
+    return [MonitorConsultasLentas()] if config.CONSULTAS_LENTAS_ACTIVAS else []
+
+
+def configurar_explicaciones(cliente):
+    """Indica el cliente con el que se ejecutan los explain (el mismo de database.py)."""
+    global _cliente
+    _cliente = cliente
+
+
+def _registrar(base, coleccion, nombre, comando, milisegundos, devueltos):
+    forma = forma_comando(nombre, comando) if comando is not None else '{}'
+    clave = (base, coleccion, nombre, forma)
+    ahora = datetime.utcnow()
+    explicar = False
+    with _lock:
+        _ocurrencias.append({
+            'fecha': ahora, 'coleccion': coleccion, 'comando': nombre, 'forma': forma,
+            'milisegundos': round(milisegundos, 1), 'devueltos': devueltos
+        })
+        datos = _formas.get(clave)
+        if datos is None and len(_formas) < config.CONSULTAS_LENTAS_MAX_FORMAS:
+            datos = _formas[clave] = {
+                'coleccion': coleccion, 'comando': nombre, 'forma': forma, 'veces': 0,
+                'maximo_ms': 0, 'ultima': ahora, 'explicacion': None
+            }
+            explicar = comando is not None
+        if datos is not None:
+            datos['veces'] += 1
+            datos['maximo_ms'] = max(datos['maximo_ms'], round(milisegundos, 1))
+            datos['ultima'] = ahora
+
+    print(f"Consulta lenta ({milisegundos:.0f} ms) {coleccion}.{nombre}: {forma}")
+    if explicar:
+        _encolar_explicacion(clave, base, nombre, comando)
+
+
+# --- Explain en segundo plano ---
+def _encolar_explicacion(clave, base, nombre, comando):
+    global _cola_explicaciones, _pid_explicador
+    if _cliente is None or not config.CONSULTAS_LENTAS_EXPLICAR:
+        return
+    if _pid_explicador != os.getpid():
+        with _lock:
+            if _pid_explicador != os.getpid():
+                _cola_explicaciones = queue.Queue(maxsize=100)
+                threading.Thread(
+                    target=_explicar_pendientes, args=(_cola_explicaciones,), name='explicar-consultas', daemon=True
+                ).start()
+                _pid_explicador = os.getpid()
+    try:
+        _cola_explicaciones.put_nowait((clave, base, nombre, comando))
+    except queue.Full:
+        pass
+
+
+def comando_para_explain(nombre, comando):
+    """El comando tal como lo envió el driver, sin los campos que explain no acepta."""
+    limpio = {campo: valor for campo, valor in comando.items() if campo not in _CAMPOS_DRIVER}
+    # explain solo acepta una sentencia por update/delete
+    if nombre == 'update':
+        limpio['updates'] = limpio['updates'][:1]
+    elif nombre == 'delete':
+        limpio['deletes'] = limpio['deletes'][:1]
+    return limpio
+
+
+def _explicar_pendientes(cola):
+    while True:
+        clave, base, nombre, comando = cola.get()
+        if nombre == 'aggregate' and any('$out' in etapa or '$merge' in etapa for etapa in comando.get('pipeline', [])):
+            explicacion = {'error': 'No se explican pipelines con $out/$merge'}
+        else:
+            try:
+                resultado = _cliente[base].command(
+                    {'explain': comando_para_explain(nombre, comando), 'verbosity': 'executionStats'}
+                )
+                explicacion = resumir_explicacion(resultado)
+            except Exception as e:
+                explicacion = {'error': str(e)}
+        with _lock:
+            if clave in _formas:
+                _formas[clave]['explicacion'] = explicacion
+
+
+def _recorrer_plan(nodo, etapas, totales, lookups):
+    if isinstance(nodo, dict):
+        if isinstance(nodo.get('stage'), str):
+            etapas.append(nodo['stage'])
+            # $lookup ejecutado por el motor SBE: sin índice en la colección foránea no usa IndexedLoopJoin
+            if nodo['stage'] == 'EQ_LOOKUP' and nodo.get('strategy') in ('NestedLoopJoin', 'HashJoin'):
+                lookups.append(nodo.get('foreignCollection'))
+        # Etapas del pipeline que no se convirtieron en parte del plan de la consulta
+        for etapa in nodo.get('stages', []) if isinstance(nodo.get('stages'), list) else []:
+            if isinstance(etapa, dict):
+                etapas.extend(campo for campo in etapa if campo.startswith('$') and campo != '$cursor')
+        estadisticas = nodo.get('executionStats')
+        if isinstance(estadisticas, dict):
+            for campo in totales:
+                totales[campo] += estadisticas.get(campo, 0) or 0
+        for campo, valor in nodo.items():
+            # Los planes descartados no se ejecutaron para esta consulta
+            if campo not in ('rejectedPlans', 'allPlansExecution', 'executionStages', 'executionStats'):
+                _recorrer_plan(valor, etapas, totales, lookups)
+    elif isinstance(nodo, list):
+        for elemento in nodo:
+            _recorrer_plan(elemento, etapas, totales, lookups)
+
+
+def resumir_explicacion(explicacion):
+    """Documentos y claves examinados contra devueltos y etapas del plan ganador."""
+    etapas = []
+    lookups = []
+    totales = {'totalDocsExamined': 0, 'totalKeysExamined': 0, 'nReturned': 0, 'executionTimeMillis': 0}
+    _recorrer_plan(explicacion, etapas, totales, lookups)
+    return {
+        'examinados': totales['totalDocsExamined'],
+        'claves_examinadas': totales['totalKeysExamined'],
+        'devueltos': totales['nReturned'],
+        'milisegundos': totales['executionTimeMillis'],
+        'etapas': etapas,
+        'collscan': 'COLLSCAN' in etapas,
+        'sort_en_memoria': any(etapa in ('SORT', '$sort') for etapa in etapas),
+        'lookups_sin_indice': lookups,
+    }
+
+
+# --- Consulta ---
+def listar_consultas_lentas():
+    """(formas de la más lenta a la más rápida, ocurrencias de la más reciente a la más antigua)."""
+    with _lock:
+        formas = sorted((dict(datos) for datos in _formas.values()), key=lambda datos: datos['maximo_ms'], reverse=True)
+        ocurrencias = list(reversed(_ocurrencias))
+    return formas, ocurrencias
+
+
+def reiniciar_consultas_lentas():
+    with _lock:
+        _ocurrencias.clear()
+        _formas.clear()
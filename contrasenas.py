@@ -0,0 +1,77 @@
+# ecommerce-flask/contrasenas.py
+
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+import config
+
+# --- Hash y verificación de contraseñas ---
+# El hash es intencionalmente costoso en CPU. Para que una ola de inicios de sesión no deje sin
+# CPU al resto de las rutas del mismo proceso, la verificación corre en un pool de procesos
+# acotado y, si ya hay demasiadas verificaciones en espera, se rechaza en lugar de encolarla.
+
+_pool = None
+_pool_lock = threading.Lock()
+_cupos = threading.BoundedSemaphore(max(config.LOGIN_COLA_MAXIMA, 1))
+
+
+def _obtener_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=config.LOGIN_PROCESOS_HASH)
+        return _pool
+
+
+def _ejecutar(funcion, *args):
+    """
+    Ejecuta funcion en el pool. Devuelve (True, resultado) o (False, None) si el pool está saturado.
+    El cupo se libera cuando la tarea termina (o se cancela), no cuando deja de esperarse: así el
+    límite cuenta también las tareas abandonadas por tiempo de espera que siguen en el pool.
+    """
+    if config.LOGIN_PROCESOS_HASH <= 0:
+        return True, funcion(*args)
+
+    if not _cupos.acquire(blocking=False):
+        return False, None
+    try:
+        futuro = _obtener_pool().submit(funcion, *args)
+    except Exception:
+        _cupos.release()
+        raise
+    futuro.add_done_callback(lambda _: _cupos.release())
+
+    try:
+        return True, futuro.result(timeout=config.LOGIN_TIMEOUT_HASH)
+    except TimeoutError:
+        # Si todavía no empezó se quita de la cola; si ya corre, su cupo se libera al terminar
+        futuro.cancel()
+        print("Verificación de contraseña cancelada por tiempo de espera.")
+        return False, None
+
+
+def hashear_contrasena(password):
+    """Hash con los parámetros configurados (HASH_METODO). Se usa al crear usuarios y al rehashear."""
+    return generate_password_hash(password, method=config.HASH_METODO)
+
+
+def verificar_contrasena(password_hash, password):
+    """
+    Devuelve True o False según la contraseña, o None si no se pudo verificar
+    porque hay demasiadas verificaciones en curso.
+    """
+    disponible, valida = _ejecutar(check_password_hash, password_hash, password)
+    return valida if disponible else None
+
+
+def necesita_rehash(password_hash):
+    """True si el hash se generó con parámetros distintos a HASH_METODO."""
+    return password_hash.split('$', 1)[0] != config.HASH_METODO
+
+
+def rehashear_contrasena(password):
+    """Genera el hash nuevo en el pool. Devuelve None si el pool está saturado."""
+    disponible, nuevo_hash = _ejecutar(generate_password_hash, password, config.HASH_METODO)
+    return nuevo_hash if disponible else None
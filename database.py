@@ -1,13 +1,57 @@
 # ecommerce-flask/database.py
 
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure, DuplicateKeyError
+from pymongo.read_preferences import SecondaryPreferred
 from bson import ObjectId
-from werkzeug.security import generate_password_hash
-from datetime import datetime
+from bson.errors import InvalidId
+from contrasenas import hashear_contrasena
+from cache import obtener_o_calcular, publicar_cambio, configurar_bus
+from trazas import trazar, oyentes_mongo, activas as trazas_activas
+from consultas_lentas import oyentes_consultas_lentas, configurar_explicaciones
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict
+from contextvars import ContextVar
+from functools import wraps
+import random
+import time
+import config
 
 # --- Configuración de la Conexión a MongoDB ---
-client = MongoClient('mongodb://localhost:27017/')
-db = client['ecommerce']
+client = MongoClient(config.MONGO_URI, event_listeners=oyentes_mongo() + oyentes_consultas_lentas())
+_db_primaria = client[config.MONGO_DB]
+# Lecturas que toleran datos algo atrasados (ver POLITICA_LECTURA al final del archivo)
+_db_secundaria = client.get_database(
+    config.MONGO_DB,
+    read_preference=SecondaryPreferred(max_staleness=config.MONGO_MAX_STALENESS_SEGUNDOS)
+)
+_lectura_actual = ContextVar('lectura_actual', default='primaria')
+
+
+class _BaseDatosEnrutada:
+    """
+    Se usa como 'db': entrega las colecciones del handle primario o del secundario según la
+    política de lectura de la función que se está ejecutando. Las escrituras siempre van al primario.
+    """
+
+    def _actual(self):
+        if _lectura_actual.get() == 'secundaria' and config.MONGO_LECTURAS_SECUNDARIAS:
+            return _db_secundaria
+        return _db_primaria
+
+    def __getattr__(self, nombre):
+        return getattr(self._actual(), nombre)
+
+    def __getitem__(self, nombre):
+        return self._actual()[nombre]
+
+
+db = _BaseDatosEnrutada()
+
+# Bus de invalidación de la caché del catálogo entre procesos (cache.py)
+configurar_bus(_db_primaria.cambios)
+# explain de las consultas lentas (consultas_lentas.py)
+configurar_explicaciones(client)
 
 
 # --- Función para mapear el campo _id a id ---
@@ -16,6 +60,25 @@ def _mapear_id(documento):
         documento['id'] = str(documento['_id'])
     return documento
 
+
+# --- Ids de referencia ---
+# Todas las referencias (usuario_id, producto_id, ...) se guardan como ObjectId para que las
+# consultas y los índices compuestos coincidan; en URLs, formularios y sesión viajan como texto.
+# Los datos antiguos con ids de texto se corrigen con migrar_ids_object_id().
+
+def a_object_id(valor):
+    """ObjectId a partir de un ObjectId o de su texto hexadecimal. Lanza InvalidId si no es válido."""
+    if isinstance(valor, ObjectId):
+        return valor
+    if isinstance(valor, str) and ObjectId.is_valid(valor):
+        return ObjectId(valor)
+    raise InvalidId(f'Id inválido: {valor!r}')
+
+
+def _expr_a_object_id(expresion):
+    """Lo mismo que a_object_id dentro de un pipeline; deja el valor igual si no es convertible."""
+    return {'$convert': {'input': expresion, 'to': 'objectId', 'onError': expresion, 'onNull': expresion}}
+
 # --- Funciones de Usuario ---
 def obtener_usuario_por_correo(correo):
     """Busca un usuario por su correo electrónico."""
@@ -36,12 +99,51 @@ def crear_usuario(nombre, correo, password):
     usuario = {
         "nombre": nombre,
         "correo": correo,
-        "password": generate_password_hash(password),
+        "password": hashear_contrasena(password),
         "rol": "cliente"  # Todos los nuevos usuarios son clientes por defecto
     }
     db.usuarios.insert_one(usuario)
     return usuario
 
+def actualizar_hash_contrasena(usuario_id, hash_anterior, hash_nuevo):
+    """Reemplaza el hash (rehash al iniciar sesión) solo si nadie lo cambió mientras tanto."""
+    db.usuarios.update_one(
+        {'_id': ObjectId(usuario_id), 'password': hash_anterior},
+        {'$set': {'password': hash_nuevo}}
+    )
+
+
+# --- Límite de intentos de inicio de sesión ---
+# Un documento por clave ('correo:...' o 'ip:...') en intentos_login; el índice TTL sobre
+# 'expira' los borra al terminar la ventana.
+
+def login_bloqueado(correo, ip):
+    """True si la cuenta o la IP superaron los fallos permitidos en la ventana actual."""
+    limites = {f'correo:{correo}': config.LOGIN_MAX_FALLOS_CUENTA, f'ip:{ip}': config.LOGIN_MAX_FALLOS_IP}
+    ahora = datetime.utcnow()
+    for intento in db.intentos_login.find({'_id': {'$in': list(limites)}, 'expira': {'$gt': ahora}}):
+        if intento.get('fallos', 0) >= limites[intento['_id']]:
+            return True
+    return False
+
+
+def registrar_login_fallido(correo, ip):
+    ahora = datetime.utcnow()
+    expira = ahora + timedelta(seconds=config.LOGIN_VENTANA_SEGUNDOS)
+    db.intentos_login.bulk_write([
+        # Si la ventana anterior ya venció (y el TTL aún no la borró) se reinicia el conteo
+        UpdateOne({'_id': clave}, [{'$set': {
+            'fallos': {'$cond': [{'$gt': ['$expira', ahora]}, {'$add': ['$fallos', 1]}, 1]},
+            'expira': {'$cond': [{'$gt': ['$expira', ahora]}, '$expira', expira]}
+        }}], upsert=True)
+        for clave in (f'correo:{correo}', f'ip:{ip}')
+    ], ordered=False)
+
+
+def limpiar_login_fallidos(correo):
+    db.intentos_login.delete_one({'_id': f'correo:{correo}'})
+
+
 def obtener_usuarios():
     usuarios_cursor = db.usuarios.find()
     return [_mapear_id(user) for user in usuarios_cursor]
@@ -53,8 +155,7 @@ def obtener_categorias():
     """
     Devuelve todas las categorías disponibles.
     """
-    categorias_cursor = db.categorias.find()
-    return [_mapear_id(cat) for cat in categorias_cursor]
+    return obtener_o_calcular('categorias', lambda: [_mapear_id(cat) for cat in db.categorias.find()])
 
 
 def obtener_categoria_por_id(categoria_id):
@@ -93,7 +194,6 @@ def obtener_productos():
                 'nombre': 1,
                 'descripcion': 1,
                 'precio': 1,
-                'inventario': 1,
                 'activo': 1,
                 'imagen_url': 1,
                 'categoria_id': '$categoria_info._id',
@@ -102,8 +202,27 @@ def obtener_productos():
         }
     ]
 
-    productos_cursor = db.productos.aggregate(pipeline)
-    return [_mapear_id(prod) for prod in productos_cursor]
+    return _con_inventario_actual(obtener_o_calcular(
+        'productos',
+        lambda: [_mapear_id(prod) for prod in db.productos.aggregate(pipeline)]
+    ))
+
+
+def obtener_inventarios_disponibles(producto_ids):
+    """{producto_id: inventario disponible} con una consulta $in (y una suma de shards si hace falta)."""
+    productos = list(db.productos.find(
+        {'_id': {'$in': list(producto_ids)}}, {'inventario': 1, 'reservado': 1, 'inventario_fragmentado': 1}
+    ))
+    return {prod['_id']: prod.get('inventario', 0) for prod in _sumar_inventario_fragmentado(productos)}
+
+
+def _con_inventario_actual(productos):
+    """
+    Copias de los productos cacheados con el inventario leído en el momento: reservas, pagos y
+    liberaciones no invalidan la caché, así que el listado no guarda el stock.
+    """
+    inventarios = obtener_inventarios_disponibles(prod['_id'] for prod in productos)
+    return [{**prod, 'inventario': inventarios.get(prod['_id'], 0)} for prod in productos]
 
 
 def obtener_productos_por_categoria(categoria_id):
@@ -111,10 +230,15 @@ def obtener_productos_por_categoria(categoria_id):
     Devuelve productos que pertenecen a una categoría específica (por ObjectId),
     junto con el nombre de la categoría.
     Usado por la tienda cuando el usuario filtra productos.
+    Solo se cachean categorías existentes: el id viene de la URL y no debe crear claves nuevas.
     """
     try:
+        categoria_id = ObjectId(categoria_id)
+        if not any(cat['_id'] == categoria_id for cat in obtener_categorias()):
+            return []
+
         pipeline = [
-            {'$match': {'categoria': ObjectId(categoria_id)}},
+            {'$match': {'categoria': categoria_id}},
             {
                 '$lookup': {
                     'from': 'categorias',
@@ -129,7 +253,6 @@ def obtener_productos_por_categoria(categoria_id):
                     'nombre': 1,
                     'descripcion': 1,
                     'precio': 1,
-                    'inventario': 1,
                     'activo': 1,
                     'imagen_url': 1,
                     'categoria_id': '$categoria_info._id',
@@ -138,8 +261,10 @@ def obtener_productos_por_categoria(categoria_id):
             }
         ]
 
-        productos_cursor = db.productos.aggregate(pipeline)
-        return [_mapear_id(prod) for prod in productos_cursor]
+        return _con_inventario_actual(obtener_o_calcular(
+            f'productos_categoria:{categoria_id}',
+            lambda: [_mapear_id(prod) for prod in db.productos.aggregate(pipeline)]
+        ))
     except Exception:
         return []
 
@@ -147,8 +272,18 @@ def obtener_productos_por_categoria(categoria_id):
 def obtener_producto_por_id(documento):
     """
     Obtiene un producto específico junto con el nombre y el ID de su categoría.
-    Usado tanto para editar un producto (admin) como para mostrar detalle (usuario).
+    Lee del primario: se usa para editar un producto (admin) y para validar el stock al agregarlo
+    al carrito. La página de detalle usa obtener_producto_catalogo.
     """
+    return _leer_producto(documento)
+
+
+def obtener_producto_catalogo(documento):
+    """Igual que obtener_producto_por_id, para la página de detalle (tolera leer de un secundario)."""
+    return _leer_producto(documento)
+
+
+def _leer_producto(documento):
     try:
         pipeline = [
             {'$match': {'_id': ObjectId(documento)}},
@@ -167,6 +302,7 @@ def obtener_producto_por_id(documento):
                     'descripcion': 1,
                     'precio': 1,
                     'inventario': 1,
+                    'inventario_fragmentado': 1,
                     'activo': 1,
                     'imagen_url': 1,
                     'categoria_id': '$categoria_info._id',
@@ -175,11 +311,31 @@ def obtener_producto_por_id(documento):
             }
         ]
 
-        producto = list(db.productos.aggregate(pipeline))
+        producto = _sumar_inventario_fragmentado(list(db.productos.aggregate(pipeline)))
         return _mapear_id(producto[0]) if producto else None
     except Exception:
         return None
 
+def eliminar_producto(producto_id):
+    """
+    Elimina un producto y limpia en cascada sus referencias en los carritos.
+    """
+    try:
+        producto_object_id = ObjectId(producto_id)
+        producto = db.productos.find_one({'_id': producto_object_id}, {'precio': 1, 'categoria': 1})
+        if not producto:
+            return False
+
+        db.productos.delete_one({'_id': producto_object_id})
+        invalidar_cache_productos(producto.get('categoria'))
+        eliminar_producto_de_todos_los_carritos(producto_object_id, producto.get('precio', 0))
+        db.reservas.delete_many({'producto_id': producto_object_id})
+        db.inventario_shards.delete_many({'producto_id': producto_object_id})
+        return True
+    except Exception as e:
+        print(f"Error en eliminar_producto: {e}")
+        return False
+
 def obtener_reseñas():
     reseñas_cursor = db.reseñas.find()
     return [_mapear_id(res) for res in reseñas_cursor]
@@ -188,10 +344,7 @@ def obtener_reseñas_por_producto(producto_id):
     """Obtiene todas las reseñas de un producto específico con información del usuario."""
     try:
         # Convertir producto_id a ObjectId si es necesario
-        if isinstance(producto_id, str):
-            producto_object_id = ObjectId(producto_id)
-        else:
-            producto_object_id = producto_id
+        producto_object_id = a_object_id(producto_id)
         
         pipeline = [
             # Buscar reseñas por producto_id (solo ObjectId)
@@ -200,6 +353,10 @@ def obtener_reseñas_por_producto(producto_id):
                     'producto_id': producto_object_id
                 }
             },
+            # Ordenar por fecha más reciente (antes del $lookup, con el índice (producto_id, fecha))
+            {
+                '$sort': {'fecha': -1}
+            },
             # Join con usuarios para obtener nombre del autor
             {
                 '$lookup': {
@@ -226,10 +383,6 @@ def obtener_reseñas_por_producto(producto_id):
                     'usuario_nombre': '$usuario_info.nombre',
                     'usuario_id': 1
                 }
-            },
-            # Ordenar por fecha más reciente
-            {
-                '$sort': {'fecha': -1}
             }
         ]
         
@@ -241,7 +394,10 @@ def obtener_reseñas_por_producto(producto_id):
         return []
 
 def crear_reseña(producto_id, usuario_id, calificacion, comentario):
-    """Crea una nueva reseña para un producto."""
+    """
+    Crea una nueva reseña para un producto. Devuelve None si el usuario ya reseñó el producto
+    (lo garantiza el índice único (usuario_id, producto_id), incluso con envíos simultáneos).
+    """
     from datetime import datetime
     import pytz
     
@@ -249,16 +405,8 @@ def crear_reseña(producto_id, usuario_id, calificacion, comentario):
     mexico_tz = pytz.timezone('America/Mexico_City')
     fecha_actual = datetime.now(mexico_tz)
     
-    # Convertir IDs a ObjectId si son strings
-    if isinstance(producto_id, str):
-        producto_object_id = ObjectId(producto_id)
-    else:
-        producto_object_id = producto_id
-        
-    if isinstance(usuario_id, str):
-        usuario_object_id = ObjectId(usuario_id)
-    else:
-        usuario_object_id = usuario_id
+    producto_object_id = a_object_id(producto_id)
+    usuario_object_id = a_object_id(usuario_id)
     
     reseña = {
         "producto_id": producto_object_id,
@@ -268,30 +416,25 @@ def crear_reseña(producto_id, usuario_id, calificacion, comentario):
         "fecha": fecha_actual
     }
     
-    resultado = db.reseñas.insert_one(reseña)
+    try:
+        resultado = db.reseñas.insert_one(reseña)
+    except DuplicateKeyError:
+        return None
     return resultado.inserted_id
 
 def verificar_usuario_puede_reseñar(usuario_id, producto_id):
     """Verifica si un usuario puede escribir una reseña para un producto (debe haberlo comprado)."""
     try:
-        if isinstance(usuario_id, str):
-            usuario_object_id = ObjectId(usuario_id)
-        else:
-            usuario_object_id = usuario_id
-            
-        if isinstance(producto_id, str):
-            producto_object_id = ObjectId(producto_id)
-        else:
-            producto_object_id = producto_id
+        usuario_object_id = a_object_id(usuario_id)
+        producto_object_id = a_object_id(producto_id)
         
-        # Buscar si el usuario ha comprado este producto
-        pedido_con_producto = db.pedidos.find_one({
-            'usuario_id': usuario_object_id,
-            'productos.producto_id': producto_object_id,
-            'estado': {'$in': ['enviado', 'entregado']}  # Solo pedidos enviados o entregados
-        })
+        # Consulta puntual por _id en el resumen de productos comprados (ver ESTADOS_COMPRADOS)
+        comprado = db.productos_comprados.find_one({
+            '_id': {'usuario_id': usuario_object_id, 'producto_id': producto_object_id},
+            'pedidos': {'$gt': 0}
+        }, {'_id': 1})
         
-        return pedido_con_producto is not None
+        return comprado is not None
         
     except Exception:
         return False
@@ -299,23 +442,13 @@ def verificar_usuario_puede_reseñar(usuario_id, producto_id):
 def usuario_ya_reseño_producto(usuario_id, producto_id):
     """Verifica si un usuario ya escribió una reseña para este producto."""
     try:
-        if isinstance(usuario_id, str):
-            usuario_object_id = ObjectId(usuario_id)
-        else:
-            usuario_object_id = usuario_id
-            
-        if isinstance(producto_id, str):
-            producto_object_id = ObjectId(producto_id)
-        else:
-            producto_object_id = producto_id
+        usuario_object_id = a_object_id(usuario_id)
+        producto_object_id = a_object_id(producto_id)
         
-        reseña_existente = db.reseñas.find_one({
-            'usuario_id': usuario_object_id,
-            '$or': [
-                {'producto_id': producto_object_id},
-                {'producto_id': producto_id}
-            ]
-        })
+        # Índice único (usuario_id, producto_id) en reseñas
+        reseña_existente = db.reseñas.find_one(
+            {'usuario_id': usuario_object_id, 'producto_id': producto_object_id}, {'_id': 1}
+        )
         
         return reseña_existente is not None
         
@@ -327,6 +460,10 @@ def obtener_todas_las_reseñas_admin():
     """Obtiene todas las reseñas con información de usuario y producto para el admin."""
     try:
         pipeline = [
+            # Ordenar por fecha más reciente (antes de los $lookup, con el índice de fecha)
+            {
+                '$sort': {'fecha': -1}
+            },
             # Join con usuarios para obtener nombre del autor
             {
                 '$lookup': {
@@ -372,10 +509,6 @@ def obtener_todas_las_reseñas_admin():
                     'producto_nombre': '$producto_info.nombre',
                     'producto_precio': '$producto_info.precio'
                 }
-            },
-            # Ordenar por fecha más reciente
-            {
-                '$sort': {'fecha': -1}
             }
         ]
         
@@ -389,10 +522,7 @@ def obtener_todas_las_reseñas_admin():
 def obtener_reseña_por_id_admin(reseña_id):
     """Obtiene una reseña específica con información completa para el admin."""
     try:
-        if isinstance(reseña_id, str):
-            reseña_object_id = ObjectId(reseña_id)
-        else:
-            reseña_object_id = reseña_id
+        reseña_object_id = a_object_id(reseña_id)
         
         pipeline = [
             # Buscar reseña específica
@@ -460,10 +590,7 @@ def obtener_reseña_por_id_admin(reseña_id):
 def eliminar_reseña_admin(reseña_id):
     """Elimina una reseña (solo para administradores)."""
     try:
-        if isinstance(reseña_id, str):
-            reseña_object_id = ObjectId(reseña_id)
-        else:
-            reseña_object_id = reseña_id
+        reseña_object_id = a_object_id(reseña_id)
         
         resultado = db.reseñas.delete_one({'_id': reseña_object_id})
         return resultado.deleted_count > 0
@@ -475,10 +602,7 @@ def eliminar_reseña_admin(reseña_id):
 def calcular_promedio_calificacion(producto_id):
     """Calcula el promedio de calificaciones de un producto."""
     try:
-        if isinstance(producto_id, str):
-            producto_object_id = ObjectId(producto_id)
-        else:
-            producto_object_id = producto_id
+        producto_object_id = a_object_id(producto_id)
         
         pipeline = [
             {
@@ -514,255 +638,771 @@ def eliminar_reseña(reseña_id):
     except Exception:
         return False
 
-# --- Funciones de Carrito ---    
-def obtener_carrito_por_usuario(usuario_id):
+# --- Funciones de Inventario (normal y fragmentado) ---
+# Un producto en modo "venta flash" (inventario_fragmentado=True) reparte su inventario en
+# varios documentos de la colección inventario_shards para que los descuentos concurrentes
+# no compitan por el mismo documento. Su campo 'inventario' queda en 0 y se lee sumando shards;
+# mientras se activa o desactiva el modo, el documento del producto cuenta como un shard más.
+
+def _descontar_inventario(producto_id, cantidad, reservar=False):
     """
-    Obtiene los productos en el carrito de un usuario y calcula el total.
-    Usa ObjectId tanto para usuario como para productos.
+    Descuenta unidades de forma atómica solo si hay suficientes.
+    Si reservar=True, las unidades se suman a 'reservado'. Devuelve True si se descontó.
     """
-    # Asegurar tipo ObjectId
-    if isinstance(usuario_id, str):
-        usuario_id = ObjectId(usuario_id)
+    # También para los fragmentados: su 'inventario' es 0 salvo mientras se desactiva el modo
+    resultado = db.productos.update_one(
+        {'_id': producto_id, 'inventario': {'$gte': cantidad}},
+        {'$inc': _incremento_descuento(cantidad, reservar)}
+    )
+    if resultado.modified_count:
+        return True
 
-    # Buscar primero si el carrito existe
-    carrito = db.carrito.find_one({'usuario_id': usuario_id})
-    
-    if not carrito or not carrito.get('productos'):
-        return {'items': [], 'total': 0}
+    producto = db.productos.find_one({'_id': producto_id, 'inventario_fragmentado': True}, {'num_shards': 1})
+    if not producto:
+        return False
+    return _descontar_inventario_fragmentado(producto_id, producto.get('num_shards', 1), cantidad, reservar)
 
-    # Pipeline de agregación para unir con los productos
-    pipeline = [
-        {'$match': {'usuario_id': usuario_id}},
-        {'$unwind': '$productos'},
-        {
-            '$lookup': {
-                'from': 'productos',
-                'localField': 'productos',
-                'foreignField': '_id',
-                'as': 'producto_info'
-            }
-        },
-        # Preservar productos incluso si el lookup no encuentra coincidencias
-        {'$unwind': {
-            'path': '$producto_info',
-            'preserveNullAndEmptyArrays': True
-        }},
-        # Filtrar solo productos que existen
-        {'$match': {'producto_info': {'$ne': None}}},
-        {
-            '$group': {
-                '_id': '$producto_info._id',
-                'nombre': {'$first': '$producto_info.nombre'},
-                'precio': {'$first': '$producto_info.precio'},
-                'imagen_url': {'$first': '$producto_info.imagen_url'},
-                'cantidad': {'$sum': 1},
-                'subtotal': {'$sum': '$producto_info.precio'}
-            }
-        },
-        {
-            '$project': {
-                'producto_id': '$_id',
-                'nombre': 1,
-                'precio': 1,
-                'imagen_url': 1,
-                'cantidad': 1,
-                'subtotal': 1
-            }
-        }
+
+def _incremento_descuento(cantidad, reservar):
+    incremento = {'inventario': -cantidad}
+    if reservar:
+        incremento['reservado'] = cantidad
+    return incremento
+
+
+def _descontar_inventario_fragmentado(producto_id, num_shards, cantidad, reservar=False):
+    """Toma las unidades de un shard al azar; si no alcanza, prueba los demás y, si hace falta, las reparte."""
+    incremento = _incremento_descuento(cantidad, reservar)
+    inicio = random.randrange(num_shards)
+
+    for i in range(num_shards):
+        resultado = db.inventario_shards.update_one(
+            {'producto_id': producto_id, 'shard': (inicio + i) % num_shards, 'inventario': {'$gte': cantidad}},
+            {'$inc': incremento}
+        )
+        if resultado.modified_count:
+            return True
+
+    # Ningún shard tiene todas las unidades: tomar lo disponible de cada uno
+    tomadas = []
+    pendiente = cantidad
+    for shard in db.inventario_shards.find({'producto_id': producto_id, 'inventario': {'$gt': 0}}):
+        parte = min(shard['inventario'], pendiente)
+        inc_parte = _incremento_descuento(parte, reservar)
+        resultado = db.inventario_shards.update_one(
+            {'_id': shard['_id'], 'inventario': {'$gte': parte}},
+            {'$inc': inc_parte}
+        )
+        if resultado.modified_count:
+            tomadas.append((shard['_id'], inc_parte))
+            pendiente -= parte
+        if pendiente == 0:
+            return True
+
+    # No alcanzó: devolver lo tomado
+    for shard_id, inc_parte in tomadas:
+        db.inventario_shards.update_one({'_id': shard_id}, {'$inc': {k: -v for k, v in inc_parte.items()}})
+    return False
+
+
+def _ajustar_inventario_lote(ajustes):
+    """
+    Aplica incrementos de inventario en lote. ajustes = {producto_id: {'inventario': n, 'reservado': m}}.
+    Los productos normales se actualizan con un bulk_write y los fragmentados en un shard al azar.
+    """
+    ajustes = {pid: inc for pid, inc in ajustes.items() if any(inc.values())}
+    if not ajustes:
+        return
+
+    fragmentados = {
+        p['_id']: p.get('num_shards', 1) for p in db.productos.find(
+            {'_id': {'$in': list(ajustes)}, 'inventario_fragmentado': True}, {'num_shards': 1}
+        )
+    }
+
+    normales = [
+        UpdateOne({'_id': pid}, {'$inc': inc})
+        for pid, inc in ajustes.items() if pid not in fragmentados
     ]
+    if normales:
+        db.productos.bulk_write(normales, ordered=False)
 
-    items = list(db.carrito.aggregate(pipeline))
-    total = sum(item.get('subtotal', 0) for item in items)
+    for pid, num_shards in fragmentados.items():
+        shard = random.randrange(num_shards)
+        # upsert: el shard pudo haberse retirado mientras se desactiva el modo (se recoge al final)
+        db.inventario_shards.update_one({'producto_id': pid, 'shard': shard}, {'$inc': ajustes[pid]}, upsert=True)
 
-    # Limpiar productos fantasmas (productos que ya no existen en la BD)
-    if carrito.get('productos'):
-        productos_validos = [item['producto_id'] for item in items]
-        productos_actuales = carrito.get('productos', [])
-        
-        # Contar cuántos productos fantasmas hay
-        productos_fantasmas = [p for p in productos_actuales if p not in productos_validos]
-        
-        if productos_fantasmas:
-            print(f"Limpiando {len(productos_fantasmas)} productos fantasmas del carrito del usuario {usuario_id}")
-            # Mantener solo los productos válidos
-            productos_limpios = []
-            for item in items:
-                productos_limpios.extend([item['producto_id']] * item['cantidad'])
-            
-            db.carrito.update_one(
-                {'usuario_id': usuario_id},
-                {'$set': {
-                    'productos': productos_limpios,
-                    'total': total
-                }}
-            )
-        else:
-            # Solo actualizar el total si no hay productos fantasmas
-            db.carrito.update_one(
-                {'usuario_id': usuario_id},
-                {'$set': {'total': total}},
-                upsert=True
-            )
 
-    return {'items': items, 'total': total}
+def _sumar_inventario_fragmentado(productos):
+    """
+    Reemplaza el inventario de los productos fragmentados por la suma de sus shards más lo que
+    quede en el documento del producto (una sola consulta).
+    """
+    ids = [p['_id'] for p in productos if p.get('inventario_fragmentado')]
+    if not ids:
+        return productos
+
+    sumas = {
+        grupo['_id']: grupo
+        for grupo in db.inventario_shards.aggregate([
+            {'$match': {'producto_id': {'$in': ids}}},
+            {'$group': {'_id': '$producto_id', 'inventario': {'$sum': '$inventario'}, 'reservado': {'$sum': '$reservado'}}}
+        ])
+    }
+    for producto in productos:
+        if producto['_id'] in sumas:
+            producto['inventario'] = producto.get('inventario', 0) + sumas[producto['_id']]['inventario']
+            producto['reservado'] = producto.get('reservado', 0) + sumas[producto['_id']]['reservado']
+    return productos
 
 
-def agregar_producto_al_carrito_db(usuario_id, producto_object_id):
-    """Agrega un producto al carrito de un usuario en la BD."""
-    if isinstance(usuario_id, str):
-        usuario_id = ObjectId(usuario_id)
-    if isinstance(producto_object_id, str):
-        producto_object_id = ObjectId(producto_object_id)
+def obtener_inventario_disponible(producto_id):
+    """Devuelve el inventario disponible de un producto (sumando shards si está fragmentado)."""
+    producto_id = a_object_id(producto_id)
 
-    db.carrito.update_one(
-        {'usuario_id': usuario_id},
-        {'$push': {'productos': ObjectId(producto_object_id)}},
-        
-        upsert=True  # Crea el carrito si no existe
+    producto = db.productos.find_one({'_id': producto_id}, {'inventario': 1, 'inventario_fragmentado': 1})
+    if not producto:
+        return 0
+    return _sumar_inventario_fragmentado([producto])[0].get('inventario', 0)
+
+
+def establecer_inventario_producto(producto_id, cantidad):
+    """Fija el inventario disponible de un producto (por ejemplo, desde el formulario del admin)."""
+    producto_id = a_object_id(producto_id)
+
+    producto = db.productos.find_one({'_id': producto_id}, {'inventario_fragmentado': 1, 'num_shards': 1})
+    if not producto:
+        return False
+
+    if not producto.get('inventario_fragmentado'):
+        db.productos.update_one({'_id': producto_id}, {'$set': {'inventario': cantidad}})
+        return True
+
+    num_shards = producto.get('num_shards', 1)
+    db.productos.update_one({'_id': producto_id}, {'$set': {'inventario': 0}})
+    db.inventario_shards.bulk_write([
+        UpdateOne(
+            {'producto_id': producto_id, 'shard': i},
+            {'$set': {'inventario': cantidad // num_shards + (1 if i < cantidad % num_shards else 0)}},
+            upsert=True
+        )
+        for i in range(num_shards)
+    ], ordered=False)
+    return True
+
+
+def ajustar_inventario_producto(producto_id, delta):
+    """
+    Suma delta unidades al inventario disponible (negativo para quitar), por ejemplo desde el
+    formulario del admin. Es un $inc, así que no pisa las reservas ni los pagos hechos mientras
+    tanto, y 'reservado' no se toca. Al quitar no deja el disponible debajo de 0: devuelve
+    False si no alcanzó (y no cambia nada).
+    """
+    producto_id = a_object_id(producto_id)
+    if delta < 0:
+        return _descontar_inventario(producto_id, -delta)
+    if delta > 0:
+        _ajustar_inventario_lote({producto_id: {'inventario': delta}})
+    return True
+
+
+def activar_inventario_fragmentado(producto_id, num_shards):
+    """
+    Activa el modo venta flash: reparte el inventario actual del producto entre num_shards
+    contadores. Las unidades reservadas pasan al shard 0, de donde se descuentan al liberar o
+    confirmar esas reservas.
+    """
+    producto_id = a_object_id(producto_id)
+
+    anterior = db.productos.find_one_and_update(
+        {'_id': producto_id, 'inventario_fragmentado': {'$ne': True}},
+        {'$set': {'inventario_fragmentado': True, 'num_shards': num_shards, 'inventario': 0, 'reservado': 0}}
     )
+    if not anterior:
+        return False
 
-def vaciar_carrito_db(usuario_id):
-    """Vacía el carrito de un usuario en la BD (establece el array de productos a vacío)."""
-    if isinstance(usuario_id, str):
-        usuario_id = ObjectId(usuario_id)
-    
-    db.carrito.update_one(
-        {'usuario_id': usuario_id},
-        {'$set': {'productos': [], 'total': 0}}    #MEDIA HORA VIENDO POR QUE NO JALABA Y TENIA ESCRITO MAL EL NOMBRE DEL CAMPO
+    inventario = anterior.get('inventario', 0)
+    # $inc con upsert: una liberación concurrente pudo crear ya alguno de los shards
+    db.inventario_shards.bulk_write([
+        UpdateOne(
+            {'producto_id': producto_id, 'shard': i},
+            {'$inc': {
+                'inventario': inventario // num_shards + (1 if i < inventario % num_shards else 0),
+                'reservado': anterior.get('reservado', 0) if i == 0 else 0
+            }},
+            upsert=True
+        )
+        for i in range(num_shards)
+    ], ordered=False)
+    return True
+
+
+def desactivar_inventario_fragmentado(producto_id):
+    """
+    Regresa el producto a un solo contador sumando y eliminando sus shards. Los shards se pasan
+    al producto antes de quitar la marca: mientras tanto las unidades ya pasadas se leen y
+    descuentan del documento del producto, así el inventario nunca aparece en 0.
+    """
+    producto_id = a_object_id(producto_id)
+
+    if not db.productos.find_one({'_id': producto_id, 'inventario_fragmentado': True}, {'_id': 1}):
+        return False
+
+    _recoger_shards(producto_id)
+    resultado = db.productos.update_one(
+        {'_id': producto_id, 'inventario_fragmentado': True},
+        {'$set': {'inventario_fragmentado': False}, '$unset': {'num_shards': ''}}
     )
+    # Un ajuste concurrente pudo volver a crear un shard antes de quitar la marca
+    _recoger_shards(producto_id)
+    return bool(resultado.modified_count)
 
-def actualizar_cantidad_carrito(usuario_id, producto_id, accion):
-    """Actualiza la cantidad de un producto en el carrito (incrementar o decrementar)."""
-    if isinstance(usuario_id, str):
-        usuario_id = ObjectId(usuario_id)
-    if isinstance(producto_id, str):
-        producto_id = ObjectId(producto_id)
-    
-    carrito = db.carrito.find_one({'usuario_id': usuario_id})
-    if not carrito:
+
+def _recoger_shards(producto_id):
+    """Pasa al documento del producto el inventario y lo reservado de sus shards, borrándolos."""
+    while True:
+        shard = db.inventario_shards.find_one_and_delete({'producto_id': producto_id})
+        if not shard:
+            break
+        db.productos.update_one({'_id': producto_id}, {'$inc': {
+            'inventario': shard.get('inventario', 0),
+            'reservado': shard.get('reservado', 0)
+        }})
+
+# --- Funciones de Reservas de Inventario ---
+# Al agregar al carrito se aparta inventario (se descuenta de 'inventario' y se suma a 'reservado')
+# por un tiempo limitado. Las reservas vencidas se liberan en lote con un barrido periódico y
+# al pagar se convierten en descuentos definitivos.
+
+def reservar_inventario(usuario_id, producto_id, cantidad):
+    """
+    Aparta unidades de un producto de forma atómica.
+    Devuelve False si no hay inventario disponible suficiente.
+    """
+    if not _descontar_inventario(producto_id, cantidad, reservar=True):
         return False
-    
-    productos = carrito.get('productos', [])
-    
-    if accion == 'incrementar':
-        # Agregar una instancia más del producto
-        db.carrito.update_one(
-            {'usuario_id': usuario_id},
-            {'$push': {'productos': producto_id}}
-        )
-    elif accion == 'decrementar':
-        # Contar cuántas veces aparece el producto
-        count = productos.count(producto_id)
-        if count > 1:
-            # Si hay más de 1, eliminar solo una instancia
-            db.carrito.update_one(
-                {'usuario_id': usuario_id},
-                {'$pull': {'productos': producto_id}},
-                {'multi': False}  # Solo eliminar una instancia
-            )
-        elif count == 1:
-            # Si solo hay 1, eliminar completamente
-            db.carrito.update_one(
-                {'usuario_id': usuario_id},
-                {'$pull': {'productos': producto_id}}
-            )
-    
+
+    db.reservas.update_one(
+        {'usuario_id': usuario_id, 'producto_id': producto_id, 'estado': 'activa'},
+        {
+            '$inc': {'cantidad': cantidad},
+            '$set': {'expira': datetime.now() + timedelta(minutes=config.MINUTOS_RESERVA)}
+        },
+        upsert=True
+    )
     return True
 
-def eliminar_producto_carrito(usuario_id, producto_id):
-    """Elimina completamente un producto del carrito (todas las instancias)."""
-    if isinstance(usuario_id, str):
-        usuario_id = ObjectId(usuario_id)
-    if isinstance(producto_id, str):
-        producto_id = ObjectId(producto_id)
-    
-    db.carrito.update_one(
-        {'usuario_id': usuario_id},
-        {'$pull': {'productos': producto_id}}
+
+def liberar_unidades_reservadas(usuario_id, producto_id, cantidad):
+    """Devuelve al inventario parte de una reserva activa (por ejemplo, al decrementar el carrito)."""
+    reserva = db.reservas.find_one_and_update(
+        {'usuario_id': usuario_id, 'producto_id': producto_id, 'estado': 'activa', 'cantidad': {'$gte': cantidad}},
+        {'$inc': {'cantidad': -cantidad}},
+        return_document=ReturnDocument.AFTER
     )
+    if not reserva:
+        return False
+
+    _ajustar_inventario_lote({producto_id: {'inventario': cantidad, 'reservado': -cantidad}})
+    if reserva['cantidad'] <= 0:
+        db.reservas.delete_one({'_id': reserva['_id'], 'cantidad': {'$lte': 0}})
     return True
 
-# --- Funciones Admin de Carritos ---
-def obtener_todos_los_carritos_admin():
-    """Obtiene todos los carritos con información de usuario y productos para el admin."""
-    try:
-        pipeline = [
-            # Join con usuarios para obtener información del usuario
-            {
-                '$lookup': {
-                    'from': 'usuarios',
-                    'localField': 'usuario_id',
-                    'foreignField': '_id',
-                    'as': 'usuario_info'
-                }
-            },
-            # Descomponer usuario_info
-            {
-                '$unwind': {
-                    'path': '$usuario_info',
-                    'preserveNullAndEmptyArrays': True
-                }
-            },
-            # Calcular estadísticas del carrito
-            {
-                '$addFields': {
-                    'productos_unicos': {
-                        '$size': {
-                            '$setUnion': [
-                                {'$ifNull': ['$productos', []]},
-                                []
-                            ]
-                        }
-                    },
-                    'cantidad_total': {
-                        '$size': {'$ifNull': ['$productos', []]}
-                    },
-                    'fecha_modificacion': {
-                        '$ifNull': ['$fecha_modificacion', '$$NOW']
-                    }
-                }
-            },
-            # Proyectar campos necesarios
-            {
-                '$project': {
-                    'usuario_id': 1,
-                    'productos': 1,
-                    'total': {'$ifNull': ['$total', 0]},
-                    'fecha_modificacion': 1,
-                    'productos_unicos': 1,
-                    'cantidad_total': 1,
-                    'usuario_nombre': '$usuario_info.nombre',
-                    'usuario_correo': '$usuario_info.correo',
-                    'usuario_telefono': '$usuario_info.telefono',
-                    'tiene_productos': {
-                        '$gt': ['$cantidad_total', 0]
-                    }
-                }
-            },
-            # Ordenar por fecha de modificación más reciente
-            {
-                '$sort': {'fecha_modificacion': -1}
-            }
-        ]
-        
-        carritos_cursor = db.carrito.aggregate(pipeline)
-        carritos = [_mapear_id(carrito) for carrito in carritos_cursor]
-        
-        return carritos
-        
-    except Exception as e:
-        print(f"Error en obtener_todos_los_carritos_admin: {e}")
-        import traceback
-        traceback.print_exc()
-        return []
 
-def obtener_carrito_detallado_admin(usuario_id):
-    """Obtiene un carrito específico con detalles de productos para el admin."""
-    try:
-        if isinstance(usuario_id, str):
-            usuario_object_id = ObjectId(usuario_id)
-        else:
-            usuario_object_id = usuario_id
+def liberar_reservas(filtro, tamano_lote=500):
+    """
+    Libera en lote las reservas activas que cumplan el filtro y devuelve el inventario.
+    Cada lote se marca con un token para que el checkout y el barrido no procesen
+    la misma reserva dos veces, y pasa a 'aplicada' antes de tocar los productos (ver
+    liberar_reservas_vencidas). Devuelve el número de unidades liberadas.
+    """
+    liberadas = 0
+    while True:
+        ids = [r['_id'] for r in db.reservas.find({**filtro, 'estado': 'activa'}, {'_id': 1}).limit(tamano_lote)]
+        if not ids:
+            break
+
+        token = ObjectId()
+        db.reservas.update_many(
+            {'_id': {'$in': ids}, 'estado': 'activa'},
+            {'$set': {'estado': 'liberando', 'token': token, 'reclamada': datetime.now()}}
+        )
+        # Solo se devuelven las reservas que pasaron a 'aplicada' (un barrido pudo reactivar el lote)
+        db.reservas.update_many({'token': token, 'estado': 'liberando'}, {'$set': {'estado': 'aplicada'}})
+
+        por_producto = defaultdict(int)
+        for reserva in db.reservas.find({'token': token, 'estado': 'aplicada'}, {'producto_id': 1, 'cantidad': 1}):
+            por_producto[reserva['producto_id']] += reserva['cantidad']
+
+        _ajustar_inventario_lote({
+            producto_id: {'inventario': cantidad, 'reservado': -cantidad}
+            for producto_id, cantidad in por_producto.items()
+        })
+        db.reservas.delete_many({'token': token})
+        liberadas += sum(por_producto.values())
+
+    return liberadas
+
+
+def liberar_reservas_vencidas(tamano_lote=500):
+    """
+    Barrido periódico: libera todas las reservas cuyo tiempo ya expiró.
+    Antes recupera los lotes tomados hace más de SEGUNDOS_RECLAMO_RESERVA (el proceso que los
+    liberaba o confirmaba murió): los que no llegaron a 'aplicada' no tocaron los productos y
+    vuelven a 'activa'; los 'aplicada' ya movieron (o estaban por mover) las unidades y solo se
+    borran. Si el proceso murió justo entre marcar y ajustar, las unidades quedan en 'reservado'
+    en lugar de devolverse dos veces.
+    """
+    ahora = datetime.now()
+    limite = ahora - timedelta(seconds=config.SEGUNDOS_RECLAMO_RESERVA)
+    vencidos = {'estado': {'$in': ['liberando', 'confirmando', 'aplicada']}, 'reclamada': {'$lt': limite}}
+    # Los lotes de un checkout cuyo pedido sigue en la cola ('procesando' o 'fallido') los
+    # termina el reintento del trabajo: se dejan como están
+    tokens = db.reservas.distinct('token', vencidos)
+    en_cola = [p['_id'] for p in db.pedidos.find(
+        {'_id': {'$in': tokens}, 'estado': {'$in': ['procesando', 'fallido']}}, {'_id': 1}
+    )] if tokens else []
+    if en_cola:
+        vencidos['token'] = {'$nin': en_cola}
+
+    db.reservas.update_many(
+        {**vencidos, 'estado': {'$in': ['liberando', 'confirmando']}},
+        {'$set': {'estado': 'activa'}, '$unset': {'token': '', 'reclamada': ''}}
+    )
+    db.reservas.delete_many({**vencidos, 'estado': 'aplicada'})
+    return liberar_reservas({'expira': {'$lt': ahora}}, tamano_lote)
+
+
+def confirmar_reservas_carrito(usuario_id, items, token):
+    """
+    Convierte en descuentos definitivos de inventario las reservas del usuario para los
+    productos de items (las líneas del pedido); las de otros productos siguen activas.
+    Se puede reanudar: las reservas se marcan con token (el _id del pedido) y las unidades sin
+    reservar se apartan como reservas del mismo token, así un reintento ve lo que ya se hizo.
+    El lote pasa a 'aplicada' antes de ajustar los productos; si un intento anterior llegó ahí,
+    no se vuelve a ajustar nada. Las reservas 'aplicada' quedan hasta que el llamador las borra
+    con cerrar_reservas_confirmadas (después de registrar que el pedido ya descontó).
+    Devuelve la lista de productos sin inventario suficiente (vacía si todo salió bien); en ese
+    caso las reservas del token vuelven a 'activa' y siguen venciendo como cualquier otra.
+    """
+    if db.reservas.find_one({'token': token, 'estado': 'aplicada'}, {'_id': 1}):
+        return []
+
+    ahora = datetime.now()
+    db.reservas.update_many(
+        {
+            'usuario_id': usuario_id, 'estado': 'activa',
+            'producto_id': {'$in': [item['producto_id'] for item in items]}
+        },
+        {'$set': {'estado': 'confirmando', 'token': token, 'reclamada': ahora}}
+    )
+
+    reservado = defaultdict(int)
+    for reserva in db.reservas.find({'token': token, 'estado': 'confirmando'}, {'producto_id': 1, 'cantidad': 1}):
+        reservado[reserva['producto_id']] += reserva['cantidad']
+
+    # Las unidades sin reservar se apartan y se anotan como reservas del lote
+    insuficientes = []
+    for item in items:
+        faltante = item['cantidad'] - reservado.get(item['producto_id'], 0)
+        if faltante <= 0:
+            continue
+        if not _descontar_inventario(item['producto_id'], faltante, reservar=True):
+            insuficientes.append(item['nombre'])
+            continue
+        db.reservas.insert_one({
+            'usuario_id': usuario_id, 'producto_id': item['producto_id'], 'estado': 'confirmando',
+            'cantidad': faltante, 'token': token, 'reclamada': ahora,
+            'expira': ahora + timedelta(minutes=config.MINUTOS_RESERVA)
+        })
+
+    if insuficientes:
+        # Nada se descontó en definitiva: las reservas del lote siguen siendo del usuario
+        db.reservas.update_many(
+            {'token': token, 'estado': 'confirmando'},
+            {'$set': {'estado': 'activa'}, '$unset': {'token': '', 'reclamada': ''}}
+        )
+        return insuficientes
+
+    # Marcar el lote como aplicado antes de tocar los productos (ver liberar_reservas_vencidas)
+    db.reservas.update_many({'token': token, 'estado': 'confirmando'}, {'$set': {'estado': 'aplicada'}})
+    reservado = defaultdict(int)
+    for reserva in db.reservas.find({'token': token, 'estado': 'aplicada'}, {'producto_id': 1, 'cantidad': 1}):
+        reservado[reserva['producto_id']] += reserva['cantidad']
+
+    if any(reservado.get(item['producto_id'], 0) < item['cantidad'] for item in items):
+        # Un barrido reactivó parte del lote mientras tanto: deshacer la marca y reintentar
+        db.reservas.update_many(
+            {'token': token, 'estado': 'aplicada'},
+            {'$set': {'estado': 'activa'}, '$unset': {'token': '', 'reclamada': ''}}
+        )
+        raise RuntimeError(f'Reservas del lote {token} reactivadas durante la confirmación')
+
+    en_carrito = {item['producto_id']: item['cantidad'] for item in items}
+    _ajustar_inventario_lote({
+        producto_id: {'reservado': -cantidad, 'inventario': max(cantidad - en_carrito.get(producto_id, 0), 0)}
+        for producto_id, cantidad in reservado.items()
+    })
+    return []
+
+
+def cerrar_reservas_confirmadas(token):
+    """Borra las reservas ya aplicadas de un lote de confirmar_reservas_carrito."""
+    db.reservas.delete_many({'token': token, 'estado': 'aplicada'})
+
+# --- Funciones de Carrito ---    
+def _items_carrito(cantidades):
+    """
+    Arma las líneas de un carrito a partir de {producto_id: cantidad} con una sola consulta $in.
+    Los productos que ya no existen se omiten. Devuelve (items, total).
+    """
+    productos = {
+        prod['_id']: prod for prod in db.productos.find(
+            {'_id': {'$in': list(cantidades)}}, {'nombre': 1, 'precio': 1, 'imagen_url': 1}
+        )
+    }
+    items = []
+    for producto_id, cantidad in cantidades.items():
+        producto = productos.get(producto_id)
+        if not producto:
+            continue
+        items.append({
+            'producto_id': producto_id,
+            'nombre': producto.get('nombre'),
+            'precio': producto.get('precio', 0),
+            'imagen_url': producto.get('imagen_url'),
+            'cantidad': cantidad,
+            'subtotal': producto.get('precio', 0) * cantidad
+        })
+    return items, sum(item['subtotal'] for item in items)
+
+
+def obtener_carrito_por_usuario(usuario_id):
+    """
+    Obtiene los productos en el carrito de un usuario y calcula el total.
+    Usa ObjectId tanto para usuario como para productos.
+    """
+    # Asegurar tipo ObjectId
+    usuario_id = a_object_id(usuario_id)
+
+    carrito = db.carrito.find_one({'usuario_id': usuario_id}, {'productos': 1, 'fecha_modificacion': 1})
+    
+    if not carrito or not carrito.get('productos'):
+        return {'items': [], 'total': 0, 'fecha_modificacion': None}
+
+    # Cada unidad es una referencia en el arreglo; se cuentan en el orden en que se agregaron
+    cantidades = {}
+    for producto_id in carrito['productos']:
+        cantidades[producto_id] = cantidades.get(producto_id, 0) + 1
+
+    # Solo lectura: los productos fantasma se filtran aquí y se eliminan al borrar el producto
+    items, total = _items_carrito(cantidades)
+
+    return {'items': items, 'total': total, 'fecha_modificacion': carrito.get('fecha_modificacion')}
+
+
+# --- Carrito de invitado ---
+# Los visitantes sin sesión guardan {producto_id: cantidad} en la cookie firmada de la sesión
+# (sin escrituras en la BD). Al iniciar sesión se fusiona con su carrito en MongoDB.
+
+def _cantidades_invitado(cantidades):
+    """Convierte las claves de la cookie a ObjectId y descarta valores inválidos."""
+    resultado = {}
+    for producto_id, cantidad in (cantidades or {}).items():
+        try:
+            cantidad = int(cantidad)
+            if cantidad > 0:
+                resultado[ObjectId(producto_id)] = cantidad
+        except Exception:
+            continue
+    return resultado
+
+
+def obtener_carrito_invitado(cantidades):
+    """Igual que obtener_carrito_por_usuario, pero desde las cantidades guardadas en la sesión."""
+    items, total = _items_carrito(_cantidades_invitado(cantidades))
+    return {'items': items, 'total': total, 'fecha_modificacion': None}
+
+
+def fusionar_carrito_invitado(usuario_id, cantidades):
+    """
+    Pasa el carrito de invitado al carrito del usuario: reserva el inventario de cada producto
+    y agrega todas las unidades con un solo upsert. Devuelve los nombres de los productos que
+    no se pudieron agregar por falta de inventario.
+    """
+    usuario_id = a_object_id(usuario_id)
+
+    cantidades = _cantidades_invitado(cantidades)
+    productos = {
+        prod['_id']: prod for prod in db.productos.find(
+            {'_id': {'$in': list(cantidades)}}, {'nombre': 1, 'precio': 1}
+        )
+    }
+
+    agregados = []
+    total_agregado = 0
+    sin_inventario = []
+    for producto_id, cantidad in cantidades.items():
+        producto = productos.get(producto_id)
+        if not producto:
+            continue
+        if not reservar_inventario(usuario_id, producto_id, cantidad):
+            sin_inventario.append(producto.get('nombre'))
+            continue
+        agregados.extend([producto_id] * cantidad)
+        total_agregado += producto.get('precio', 0) * cantidad
+
+    if agregados:
+        # El resumen se calcula en la misma escritura (actualización con pipeline)
+        productos_nuevos = {'$concatArrays': [{'$ifNull': ['$productos', []]}, agregados]}
+        db.carrito.update_one(
+            {'usuario_id': usuario_id},
+            [
+                {'$set': {
+                    'productos': productos_nuevos,
+                    'total': {'$add': [{'$ifNull': ['$total', 0]}, total_agregado]}
+                }},
+                {'$set': {
+                    'cantidad_total': {'$size': '$productos'},
+                    'productos_unicos': {'$size': {'$setUnion': ['$productos', []]}},
+                    'fecha_modificacion': datetime.now(timezone.utc)
+                }}
+            ],
+            upsert=True
+        )
+    return sin_inventario
+
+
+def _resumen_carrito(productos, total):
+    """Campos precalculados que se guardan en el carrito en cada escritura."""
+    return {
+        'total': total,
+        'productos_unicos': len(set(productos)),
+        'cantidad_total': len(productos),
+        'fecha_modificacion': datetime.now(timezone.utc)
+    }
+
+
+def _recalcular_total_carrito(usuario_id):
+    """
+    Recalcula y guarda el resumen del carrito (total, productos únicos, unidades y
+    fecha de modificación) después de una escritura.
+    Usa una sola consulta $in sobre productos y descarta referencias a productos inexistentes.
+    """
+    carrito = db.carrito.find_one({'usuario_id': usuario_id}, {'productos': 1})
+    if not carrito:
+        return 0
+
+    productos = carrito.get('productos', [])
+    precios = {
+        prod['_id']: prod.get('precio', 0)
+        for prod in db.productos.find({'_id': {'$in': list(set(productos))}}, {'precio': 1})
+    }
+    productos_validos = [p for p in productos if p in precios]
+    total = sum(precios[p] for p in productos_validos)
+    productos_fantasma = list({p for p in productos if p not in precios})
+
+    actualizacion = {'$set': _resumen_carrito(productos_validos, total)}
+    if productos_fantasma:
+        actualizacion['$pullAll'] = {'productos': productos_fantasma}
+
+    db.carrito.update_one({'usuario_id': usuario_id}, actualizacion)
+    return total
+
+
+def agregar_producto_al_carrito_db(usuario_id, producto_object_id, cantidad=1):
+    """
+    Agrega un producto (una o varias unidades) al carrito de un usuario en la BD,
+    reservando el inventario. Devuelve False si no hay inventario suficiente.
+    """
+    usuario_id = a_object_id(usuario_id)
+    producto_object_id = a_object_id(producto_object_id)
+
+    if not reservar_inventario(usuario_id, producto_object_id, cantidad):
+        return False
+
+    db.carrito.update_one(
+        {'usuario_id': usuario_id},
+        {'$push': {'productos': {'$each': [producto_object_id] * cantidad}}},
+        
+        upsert=True  # Crea el carrito si no existe
+    )
+    _recalcular_total_carrito(usuario_id)
+    return True
+
+def vaciar_carrito_db(usuario_id):
+    """
+    Vacía el carrito de un usuario en la BD (establece el array de productos a vacío)
+    y libera sus reservas activas (después del pago ya no queda ninguna).
+    """
+    usuario_id = a_object_id(usuario_id)
+    
+    db.carrito.update_one(
+        {'usuario_id': usuario_id},
+        {'$set': {'productos': [], **_resumen_carrito([], 0)}}    #MEDIA HORA VIENDO POR QUE NO JALABA Y TENIA ESCRITO MAL EL NOMBRE DEL CAMPO
+    )
+    liberar_reservas({'usuario_id': usuario_id})
+
+def actualizar_cantidad_carrito(usuario_id, producto_id, accion):
+    """Actualiza la cantidad de un producto en el carrito (incrementar o decrementar)."""
+    usuario_id = a_object_id(usuario_id)
+    producto_id = a_object_id(producto_id)
+    
+    carrito = db.carrito.find_one({'usuario_id': usuario_id}, {'_id': 1})
+    if not carrito:
+        return False
+    
+    if accion == 'incrementar':
+        # Reservar y agregar una instancia más del producto
+        if not reservar_inventario(usuario_id, producto_id, 1):
+            return False
+        db.carrito.update_one(
+            {'usuario_id': usuario_id},
+            {'$push': {'productos': producto_id}}
+        )
+    elif accion == 'decrementar':
+        # Eliminar solo una instancia ($pull quitaría todas): se corta el arreglo en la primera aparición
+        indice = {'$indexOfArray': ['$productos', producto_id]}
+        resultado = db.carrito.update_one(
+            {'usuario_id': usuario_id, 'productos': producto_id},
+            [{'$set': {'productos': {'$concatArrays': [
+                {'$slice': ['$productos', indice]},
+                {'$slice': ['$productos', {'$add': [indice, 1]}, {'$size': '$productos'}]}
+            ]}}}]
+        )
+        if resultado.modified_count:
+            liberar_unidades_reservadas(usuario_id, producto_id, 1)
+    
+    _recalcular_total_carrito(usuario_id)
+    return True
+
+def eliminar_producto_carrito(usuario_id, producto_id):
+    """Elimina completamente un producto del carrito (todas las instancias)."""
+    usuario_id = a_object_id(usuario_id)
+    producto_id = a_object_id(producto_id)
+    
+    db.carrito.update_one(
+        {'usuario_id': usuario_id},
+        {'$pull': {'productos': producto_id}}
+    )
+    liberar_reservas({'usuario_id': usuario_id, 'producto_id': producto_id})
+    _recalcular_total_carrito(usuario_id)
+    return True
+
+def eliminar_producto_de_todos_los_carritos(producto_id, precio=0):
+    """
+    Quita todas las referencias a un producto de todos los carritos con un solo update_many.
+    Equivale a un $pull, pero como actualización con pipeline para descontar también el total.
+    """
+    producto_id = a_object_id(producto_id)
+
+    unidades = {'$size': {'$filter': {'input': '$productos', 'cond': {'$eq': ['$$this', producto_id]}}}}
+    resultado = db.carrito.update_many(
+        {'productos': producto_id},
+        [{'$set': {
+            'total': {'$subtract': [{'$ifNull': ['$total', 0]}, {'$multiply': [precio, unidades]}]},
+            'productos': {'$filter': {'input': '$productos', 'cond': {'$ne': ['$$this', producto_id]}}},
+            'cantidad_total': {'$subtract': [{'$size': '$productos'}, unidades]},
+            'productos_unicos': {'$subtract': [{'$size': {'$setUnion': ['$productos', []]}}, 1]},
+            'fecha_modificacion': '$$NOW'
+        }}]
+    )
+    return resultado.modified_count
+
+
+def barrer_productos_fantasma_carritos(tamano_lote=500):
+    """
+    Red de seguridad: recorre los carritos por lotes y elimina referencias a productos
+    que ya no existen (por ejemplo, borrados directamente en la BD).
+    Devuelve el número de carritos corregidos.
+    """
+    corregidos = 0
+    ultimo_id = None
+
+    while True:
+        filtro = {'_id': {'$gt': ultimo_id}} if ultimo_id else {}
+        lote = list(
+            db.carrito.find(filtro, {'productos': 1})
+            .sort('_id', 1)
+            .limit(tamano_lote)
+        )
+        if not lote:
+            break
+        ultimo_id = lote[-1]['_id']
+
+        # Una sola consulta $in por lote para saber qué productos existen y su precio
+        ids_referenciados = {p for carrito in lote for p in carrito.get('productos', [])}
+        precios = {
+            prod['_id']: prod.get('precio', 0)
+            for prod in db.productos.find({'_id': {'$in': list(ids_referenciados)}}, {'precio': 1})
+        }
+
+        operaciones = []
+        for carrito in lote:
+            productos = carrito.get('productos', [])
+            fantasmas = list({p for p in productos if p not in precios})
+            if fantasmas:
+                validos = [p for p in productos if p in precios]
+                operaciones.append(UpdateOne(
+                    {'_id': carrito['_id']},
+                    {
+                        '$pullAll': {'productos': fantasmas},
+                        '$set': _resumen_carrito(validos, sum(precios[p] for p in validos))
+                    }
+                ))
+
+        if operaciones:
+            resultado = db.carrito.bulk_write(operaciones, ordered=False)
+            corregidos += resultado.modified_count
+
+    return corregidos
+
+# --- Funciones Admin de Carritos ---
+def obtener_todos_los_carritos_admin():
+    """
+    Obtiene todos los carritos con información de usuario para el admin.
+    Lee los campos precalculados en cada escritura, ordenados por el índice de fecha_modificacion,
+    y resuelve los usuarios con una sola consulta $in.
+    """
+    try:
+        carritos = list(
+            db.carrito.find({}, {
+                'usuario_id': 1,
+                'total': 1,
+                'fecha_modificacion': 1,
+                'productos_unicos': 1,
+                'cantidad_total': 1
+            }).sort('fecha_modificacion', -1)
+        )
+
+        ids_usuarios = list({c['usuario_id'] for c in carritos if c.get('usuario_id')})
+        usuarios = {
+            u['_id']: u
+            for u in db.usuarios.find({'_id': {'$in': ids_usuarios}}, {'nombre': 1, 'correo': 1, 'telefono': 1})
+        }
+
+        for carrito in carritos:
+            usuario = usuarios.get(carrito.get('usuario_id'), {})
+            carrito['total'] = carrito.get('total', 0)
+            carrito['productos_unicos'] = carrito.get('productos_unicos', 0)
+            carrito['cantidad_total'] = carrito.get('cantidad_total', 0)
+            carrito['usuario_nombre'] = usuario.get('nombre')
+            carrito['usuario_correo'] = usuario.get('correo')
+            carrito['usuario_telefono'] = usuario.get('telefono')
+            carrito['tiene_productos'] = carrito['cantidad_total'] > 0
+
+        return [_mapear_id(carrito) for carrito in carritos]
+        
+    except Exception as e:
+        print(f"Error en obtener_todos_los_carritos_admin: {e}")
+        import traceback
+        traceback.print_exc()
+        return []
+
+def obtener_carrito_detallado_admin(usuario_id):
+    """Obtiene un carrito específico con detalles de productos para el admin."""
+    try:
+        usuario_object_id = a_object_id(usuario_id)
         
         # Usar la función existente para obtener productos del carrito
         carrito_data = obtener_carrito_por_usuario(usuario_object_id)
@@ -797,19 +1437,16 @@ def obtener_carrito_detallado_admin(usuario_id):
 def vaciar_carrito_admin(usuario_id):
     """Vacía un carrito específico (solo para administradores)."""
     try:
-        if isinstance(usuario_id, str):
-            usuario_object_id = ObjectId(usuario_id)
-        else:
-            usuario_object_id = usuario_id
+        usuario_object_id = a_object_id(usuario_id)
         
         resultado = db.carrito.update_one(
             {'usuario_id': usuario_object_id},
             {'$set': {
                 'productos': [],
-                'total': 0,
-                'fecha_modificacion': datetime.now()
+                **_resumen_carrito([], 0)
             }}
         )
+        liberar_reservas({'usuario_id': usuario_object_id})
         return resultado.modified_count > 0
         
     except Exception as e:
@@ -819,15 +1456,8 @@ def vaciar_carrito_admin(usuario_id):
 def actualizar_cantidad_producto_carrito_admin(usuario_id, producto_id, nueva_cantidad):
     """Actualiza la cantidad de un producto en el carrito (admin)."""
     try:
-        if isinstance(usuario_id, str):
-            usuario_object_id = ObjectId(usuario_id)
-        else:
-            usuario_object_id = usuario_id
-            
-        if isinstance(producto_id, str):
-            producto_object_id = ObjectId(producto_id)
-        else:
-            producto_object_id = producto_id
+        usuario_object_id = a_object_id(usuario_id)
+        producto_object_id = a_object_id(producto_id)
         
         # Obtener el carrito actual
         carrito = db.carrito.find_one({'usuario_id': usuario_object_id})
@@ -848,12 +1478,13 @@ def actualizar_cantidad_producto_carrito_admin(usuario_id, producto_id, nueva_ca
             {'usuario_id': usuario_object_id},
             {'$set': {
                 'productos': nuevos_productos,
-                'fecha_modificacion': datetime.now()
+                'fecha_modificacion': datetime.now(timezone.utc)
             }}
         )
         
-        # Recalcular el total
-        obtener_carrito_por_usuario(usuario_object_id)
+        # Liberar la reserva del producto (el pago descontará lo que falte) y recalcular el total
+        liberar_reservas({'usuario_id': usuario_object_id, 'producto_id': producto_object_id})
+        _recalcular_total_carrito(usuario_object_id)
         
         return True
         
@@ -866,27 +1497,21 @@ def actualizar_cantidad_producto_carrito_admin(usuario_id, producto_id, nueva_ca
 def eliminar_producto_carrito_admin(usuario_id, producto_id):
     """Elimina todas las unidades de un producto del carrito (admin)."""
     try:
-        if isinstance(usuario_id, str):
-            usuario_object_id = ObjectId(usuario_id)
-        else:
-            usuario_object_id = usuario_id
-            
-        if isinstance(producto_id, str):
-            producto_object_id = ObjectId(producto_id)
-        else:
-            producto_object_id = producto_id
+        usuario_object_id = a_object_id(usuario_id)
+        producto_object_id = a_object_id(producto_id)
         
         # Eliminar todas las instancias del producto
         resultado = db.carrito.update_one(
             {'usuario_id': usuario_object_id},
             {
                 '$pull': {'productos': producto_object_id},
-                '$set': {'fecha_modificacion': datetime.now()}
+                '$set': {'fecha_modificacion': datetime.now(timezone.utc)}
             }
         )
         
-        # Recalcular el total
-        obtener_carrito_por_usuario(usuario_object_id)
+        # Liberar la reserva del producto (el pago descontará lo que falte) y recalcular el total
+        liberar_reservas({'usuario_id': usuario_object_id, 'producto_id': producto_object_id})
+        _recalcular_total_carrito(usuario_object_id)
         
         return resultado.modified_count > 0
         
@@ -900,8 +1525,11 @@ def obtener_todos_los_pedidos():
     pedidos_cursor = db.pedidos.find().sort('fecha', -1)
     return [_mapear_id(pedido) for pedido in pedidos_cursor]
 
-def crear_pedido(usuario_id, items_carrito, total):
-    """Crea un nuevo pedido con los productos del carrito."""
+def crear_pedido(usuario_id, items_carrito, total, estado="pendiente", clave_checkout=None):
+    """
+    Crea un nuevo pedido con los productos del carrito.
+    clave_checkout (opcional) es única: si ya existe un pedido con esa clave se lanza DuplicateKeyError.
+    """
     from datetime import datetime
     import pytz
     
@@ -909,28 +1537,72 @@ def crear_pedido(usuario_id, items_carrito, total):
     mexico_tz = pytz.timezone('America/Mexico_City')
     fecha_actual = datetime.now(mexico_tz)
     
-    if isinstance(usuario_id, str):
-        usuario_id = ObjectId(usuario_id)
+    usuario_id = a_object_id(usuario_id)
     
     pedido = {
         "usuario_id": usuario_id,
         "productos": items_carrito,
+        "num_productos": len(items_carrito),  # Guardado para el listado resumido
         "total": total,
         "fecha": fecha_actual,
-        "estado": "pendiente"
+        "estado": estado
     }
+    if clave_checkout:
+        pedido["clave_checkout"] = clave_checkout
     
     resultado = db.pedidos.insert_one(pedido)
+    _registrar_cambio_estado_pedido(pedido, None, estado)
     return resultado.inserted_id
 
 def obtener_pedidos_por_usuario(usuario_id):
     """Obtiene todos los pedidos de un usuario."""
-    if isinstance(usuario_id, str):
-        usuario_id = ObjectId(usuario_id)
+    usuario_id = a_object_id(usuario_id)
     
     pedidos_cursor = db.pedidos.find({'usuario_id': usuario_id}).sort('fecha', -1)
     return [_mapear_id(pedido) for pedido in pedidos_cursor]
 
+def obtener_resumen_pedidos_por_usuario(usuario_id, cursor=None, limite=20):
+    """
+    Obtiene una página del historial de pedidos de un usuario sin las líneas de productos.
+    Usa paginación por búsqueda sobre (usuario_id, fecha, _id): cursor es el valor
+    'siguiente' de la página anterior. Devuelve (pedidos, siguiente_cursor o None).
+    Los pedidos antiguos sin fecha van al final (en orden descendente null queda después de
+    cualquier fecha) y su cursor lleva la fecha vacía.
+    """
+    usuario_id = a_object_id(usuario_id)
+
+    filtro = {'usuario_id': usuario_id}
+    if cursor:
+        try:
+            fecha_texto, ultimo_id = cursor.rsplit('_', 1)
+            ultimo_id = ObjectId(ultimo_id)
+            if fecha_texto:
+                fecha = datetime.fromisoformat(fecha_texto)
+                filtro['$or'] = [
+                    {'fecha': {'$lt': fecha}},
+                    {'fecha': fecha, '_id': {'$lt': ultimo_id}},
+                    {'fecha': None}
+                ]
+            else:
+                filtro['fecha'] = None
+                filtro['_id'] = {'$lt': ultimo_id}
+        except Exception:
+            pass  # Cursor inválido: empezar desde la primera página
+
+    pedidos_cursor = db.pedidos.find(
+        filtro,
+        {'fecha': 1, 'estado': 1, 'total': 1, 'num_productos': 1}
+    ).sort([('fecha', -1), ('_id', -1)]).limit(limite + 1)
+
+    pedidos = [_mapear_id(pedido) for pedido in pedidos_cursor]
+    siguiente = None
+    if len(pedidos) > limite:
+        pedidos = pedidos[:limite]
+        ultimo = pedidos[-1]
+        fecha_texto = ultimo['fecha'].isoformat() if ultimo.get('fecha') else ''
+        siguiente = f"{fecha_texto}_{ultimo['_id']}"
+    return pedidos, siguiente
+
 def obtener_pedido_por_id(pedido_id):
     """Obtiene un pedido específico por su ID."""
     try:
@@ -940,49 +1612,166 @@ def obtener_pedido_por_id(pedido_id):
         return None
 
 def reducir_inventario_producto(producto_id, cantidad):
-    """Reduce el inventario de un producto específico."""
+    """Reduce el inventario de un producto específico (usa los shards si está en modo venta flash)."""
     try:
-        if isinstance(producto_id, str):
-            producto_id = ObjectId(producto_id)
+        producto_id = a_object_id(producto_id)
         
-        resultado = db.productos.update_one(
-            {'_id': producto_id},
-            {'$inc': {'inventario': -cantidad}}
-        )
-        return resultado.modified_count > 0
+        return _descontar_inventario(producto_id, cantidad)
     except Exception:
         return False
 
 def verificar_inventario_suficiente(producto_id, cantidad_solicitada):
     """Verifica si hay suficiente inventario para un producto."""
     try:
-        if isinstance(producto_id, str):
-            producto_id = ObjectId(producto_id)
+        producto_id = a_object_id(producto_id)
         
-        producto = db.productos.find_one({'_id': producto_id})
-        if producto:
-            return producto.get('inventario', 0) >= cantidad_solicitada
-        return False
+        return obtener_inventario_disponible(producto_id) >= cantidad_solicitada
     except Exception:
         return False
 
-def actualizar_estado_pedido(pedido_id, nuevo_estado):
-    """Actualiza el estado de un pedido."""
+def actualizar_estado_pedido(pedido_id, nuevo_estado, estado_actual=None, campos_extra=None):
+    """
+    Actualiza el estado de un pedido y los resúmenes de ventas.
+    Si se indica estado_actual, solo cambia pedidos que estén en ese estado.
+    """
     try:
-        if isinstance(pedido_id, str):
-            pedido_id = ObjectId(pedido_id)
+        pedido_id = a_object_id(pedido_id)
+
+        filtro = {'_id': pedido_id}
+        if estado_actual:
+            filtro['estado'] = estado_actual
         
-        resultado = db.pedidos.update_one(
-            {'_id': pedido_id},
-            {'$set': {'estado': nuevo_estado}}
+        anterior = db.pedidos.find_one_and_update(
+            filtro,
+            {'$set': {'estado': nuevo_estado, **(campos_extra or {})}},
+            projection={'usuario_id': 1, 'productos': 1, 'total': 1, 'fecha': 1, 'estado': 1}
         )
-        return resultado.modified_count > 0
+        if not anterior or anterior.get('estado') == nuevo_estado:
+            return False
+
+        _registrar_cambio_estado_pedido(anterior, anterior.get('estado'), nuevo_estado)
+        return True
     except Exception:
         return False
 
+def eliminar_pedido(pedido_id):
+    """Elimina un pedido y lo descuenta de los resúmenes de ventas."""
+    try:
+        pedido = db.pedidos.find_one_and_delete({'_id': ObjectId(pedido_id)})
+        if not pedido:
+            return False
+        _registrar_cambio_estado_pedido(pedido, pedido.get('estado'), None)
+        return True
+    except Exception as e:
+        print(f"Error en eliminar_pedido: {e}")
+        return False
+
+# Transiciones que el admin puede aplicar en lote ('procesando' y 'fallido' los maneja la cola)
+TRANSICIONES_PEDIDO = {
+    'pendiente': ('enviado', 'cancelado'),
+    'enviado': ('entregado', 'cancelado'),
+    'entregado': (),
+    'cancelado': ()
+}
+
+
+def rango_fechas(desde=None, hasta=None):
+    """Convierte 'AAAA-MM-DD' (días completos en hora de Ciudad de México) en un filtro $gte/$lt."""
+    import pytz
+    zona = pytz.timezone('America/Mexico_City')
+    rango = {}
+    if desde:
+        rango['$gte'] = zona.localize(datetime.strptime(desde, '%Y-%m-%d'))
+    if hasta:
+        rango['$lt'] = zona.localize(datetime.strptime(hasta, '%Y-%m-%d') + timedelta(days=1))
+    return rango
+
+
+def cambiar_estado_pedidos_lote(nuevo_estado, pedido_ids=None, estado=None, desde=None, hasta=None, tamano_lote=None):
+    """
+    Cambia el estado de varios pedidos, elegidos por lista de ids o por filtro (estado y/o
+    fechas AAAA-MM-DD). Cada lote se escribe con un solo bulk_write condicionado al estado leído.
+    Devuelve {pedido_id: resultado} con 'actualizado', 'sin_cambio', 'transicion_no_permitida',
+    'conflicto' (cambió mientras tanto), 'no_encontrado' o 'id_invalido'.
+    Lanza ValueError si el estado destino o las fechas no son válidos, o si no se indica ningún
+    id ni ningún criterio del filtro (nunca se cambian todos los pedidos).
+    """
+    origenes = [origen for origen, destinos in TRANSICIONES_PEDIDO.items() if nuevo_estado in destinos]
+    if not origenes:
+        raise ValueError(f'No se puede pasar pedidos a {nuevo_estado!r} en lote')
+    if not pedido_ids and not (estado or desde or hasta):
+        raise ValueError('Indica al menos un pedido o un criterio del filtro (estado, desde o hasta)')
+    tamano_lote = tamano_lote or config.PEDIDOS_LOTE_ESTADO
+    resultados = {}
+
+    if pedido_ids is not None:
+        ids = []
+        for pedido_id in pedido_ids:
+            try:
+                ids.append(ObjectId(pedido_id))
+            except Exception:
+                resultados[str(pedido_id)] = 'id_invalido'
+        filtro = {'_id': {'$in': ids}}
+    else:
+        ids = []
+        filtro = {'estado': {'$in': [estado] if estado else origenes}}
+        rango = rango_fechas(desde, hasta)
+        if rango:
+            filtro['fecha'] = rango
+
+    candidatos = []
+    cursor = db.pedidos.find(
+        filtro, {'usuario_id': 1, 'estado': 1, 'productos': 1, 'total': 1, 'fecha': 1}
+    ).batch_size(tamano_lote)
+    for pedido in cursor:
+        if pedido.get('estado') == nuevo_estado:
+            resultados[str(pedido['_id'])] = 'sin_cambio'
+        elif pedido.get('estado') not in origenes:
+            resultados[str(pedido['_id'])] = 'transicion_no_permitida'
+        else:
+            candidatos.append(pedido)
+        if len(candidatos) >= tamano_lote:
+            _cambiar_estado_lote(candidatos, nuevo_estado, resultados)
+            candidatos = []
+    if candidatos:
+        _cambiar_estado_lote(candidatos, nuevo_estado, resultados)
+
+    for pedido_id in ids:
+        resultados.setdefault(str(pedido_id), 'no_encontrado')
+    return resultados
+
+
+def _cambiar_estado_lote(pedidos, nuevo_estado, resultados):
+    """Escribe un lote con bulk_write y marca con un token los que sí cambiaron para actualizar los resúmenes."""
+    token = ObjectId()
+    db.pedidos.bulk_write([
+        UpdateOne(
+            {'_id': pedido['_id'], 'estado': pedido['estado']},
+            {'$set': {'estado': nuevo_estado, 'lote_estado': token}}
+        )
+        for pedido in pedidos
+    ], ordered=False)
+
+    actualizados = {doc['_id'] for doc in db.pedidos.find({'lote_estado': token}, {'_id': 1})}
+    if actualizados:
+        db.pedidos.update_many({'lote_estado': token}, {'$unset': {'lote_estado': ''}})
+
+    cambios = []
+    for pedido in pedidos:
+        if pedido['_id'] in actualizados:
+            resultados[str(pedido['_id'])] = 'actualizado'
+            cambios.append((pedido, pedido['estado']))
+        else:
+            resultados[str(pedido['_id'])] = 'conflicto'
+    _registrar_cambios_estado_pedidos(cambios, nuevo_estado)
+
 def obtener_pedidos_con_usuario():
     """Obtiene todos los pedidos con información del usuario para el admin."""
     pipeline = [
+        # Ordenar primero para que use el índice de fecha (después del $lookup sería en memoria)
+        {
+            '$sort': {'fecha': -1}
+        },
         {
             '$lookup': {
                 'from': 'usuarios',
@@ -1007,17 +1796,131 @@ def obtener_pedidos_con_usuario():
                 'usuario_nombre': '$usuario_info.nombre',
                 'usuario_correo': '$usuario_info.correo'
             }
-        },
-        {
-            '$sort': {'fecha': -1}
         }
     ]
     
     pedidos_cursor = db.pedidos.aggregate(pipeline)
     return [_mapear_id(pedido) for pedido in pedidos_cursor]
 
-def crear_pedido_desde_admin(usuario_id, productos_data, total, estado="pendiente"):
-    """Crea un nuevo pedido desde el panel de administración."""
+def obtener_productos_para_pedido():
+    """Productos (id, nombre, precio, inventario) para el formulario de pedido, sin el $lookup de categorías."""
+    def leer():
+        productos = list(db.productos.find(
+            {}, {'nombre': 1, 'precio': 1, 'inventario': 1, 'inventario_fragmentado': 1}
+        ).sort('nombre', 1))
+        return [_mapear_id(p) for p in _sumar_inventario_fragmentado(productos)]
+    return obtener_o_calcular('productos_pedido', leer)
+
+
+def invalidar_cache_productos(*categorias):
+    """
+    Anuncia a todos los procesos que cambiaron productos (al crear, editar, importar o eliminar).
+    Si se conocen las categorías afectadas solo se invalidan sus listados.
+    """
+    por_categoria = [f'productos_categoria:{c}' for c in categorias if c] or ['productos_categoria:*']
+    publicar_cambio('productos', 'productos_pedido', *por_categoria)
+
+
+def invalidar_cache_categorias(categoria_id=None):
+    """Anuncia cambios en categorías; los listados de productos muestran su nombre."""
+    publicar_cambio('categorias', 'productos', 'productos_pedido',
+                    f'productos_categoria:{categoria_id}' if categoria_id else 'productos_categoria:*')
+
+
+def construir_lineas_pedido(productos_data):
+    """
+    Resuelve todos los productos con una sola consulta $in y arma las líneas del pedido.
+    productos_data = [{'producto_id': ..., 'cantidad': ...}]. Las líneas de productos que ya
+    no existen se omiten. Devuelve (lineas, total, productos) con productos por _id.
+    """
+    solicitados = []
+    for producto in productos_data:
+        cantidad = int(producto['cantidad'])
+        if cantidad > 0:
+            solicitados.append((ObjectId(producto['producto_id']), cantidad))
+
+    productos = {
+        p['_id']: p for p in db.productos.find(
+            {'_id': {'$in': list({pid for pid, _ in solicitados})}},
+            {'nombre': 1, 'precio': 1, 'imagen_url': 1, 'inventario': 1, 'inventario_fragmentado': 1, 'num_shards': 1}
+        )
+    }
+
+    lineas = []
+    total = 0
+    for producto_id, cantidad in solicitados:
+        producto_info = productos.get(producto_id)
+        if not producto_info:
+            continue
+        subtotal = producto_info['precio'] * cantidad
+        lineas.append({
+            'producto_id': producto_id,
+            'nombre': producto_info['nombre'],
+            'precio': producto_info['precio'],
+            'cantidad': cantidad,
+            'subtotal': subtotal,
+            'imagen_url': producto_info.get('imagen_url', '')
+        })
+        total += subtotal
+    return lineas, total, productos
+
+
+def _descontar_inventario_lineas(lineas, productos):
+    """
+    Descuenta el inventario de las líneas de un pedido. Los productos normales se descuentan
+    con un solo bulk_write condicionado a que alcance el stock; si alguno no alcanzó se revierte
+    lo descontado y se lanza ValueError con los nombres sin inventario suficiente.
+    """
+    cantidades = defaultdict(int)
+    for linea in lineas:
+        cantidades[linea['producto_id']] += linea['cantidad']
+
+    normales = {pid: n for pid, n in cantidades.items() if not productos[pid].get('inventario_fragmentado')}
+    faltantes = [pid for pid, n in normales.items() if productos[pid].get('inventario', 0) < n]
+    descontados = {}
+
+    if normales and not faltantes:
+        # El token marca qué documentos descontó este lote, por si otro proceso ganó la carrera
+        token = ObjectId()
+        resultado = db.productos.bulk_write([
+            UpdateOne(
+                {'_id': pid, 'inventario_fragmentado': {'$ne': True}, 'inventario': {'$gte': n}},
+                {'$inc': {'inventario': -n}, '$set': {'lote_inventario': token}}
+            )
+            for pid, n in normales.items()
+        ], ordered=False)
+        if resultado.matched_count == len(normales):
+            descontados = dict(normales)
+        else:
+            aplicados = {p['_id'] for p in db.productos.find({'_id': {'$in': list(normales)}, 'lote_inventario': token}, {'_id': 1})}
+            descontados = {pid: n for pid, n in normales.items() if pid in aplicados}
+            faltantes = [pid for pid in normales if pid not in aplicados]
+        # El token ya se leyó: se quita para no dejarlo en los productos (por _id, que tiene índice)
+        db.productos.update_many(
+            {'_id': {'$in': list(normales)}, 'lote_inventario': token}, {'$unset': {'lote_inventario': ''}}
+        )
+
+    if not faltantes:
+        for pid, n in cantidades.items():
+            if pid in normales:
+                continue
+            if _descontar_inventario(pid, n):
+                descontados[pid] = n
+            else:
+                faltantes.append(pid)
+                break
+
+    if faltantes:
+        _ajustar_inventario_lote({pid: {'inventario': n} for pid, n in descontados.items()})
+        raise ValueError('Inventario insuficiente: ' + ', '.join(productos[pid]['nombre'] for pid in faltantes))
+
+
+def crear_pedido_desde_admin(usuario_id, productos_data, total=None, estado="pendiente", descontar_inventario=False):
+    """
+    Crea un nuevo pedido desde el panel de administración.
+    El total se calcula con los precios actuales (el parámetro total se conserva por compatibilidad).
+    Con descontar_inventario=True valida y descuenta el stock; lanza ValueError si no alcanza.
+    """
     from datetime import datetime
     import pytz
     
@@ -1025,30 +1928,777 @@ def crear_pedido_desde_admin(usuario_id, productos_data, total, estado="pendient
     mexico_tz = pytz.timezone('America/Mexico_City')
     fecha_actual = datetime.now(mexico_tz)
     
-    if isinstance(usuario_id, str):
-        usuario_id = ObjectId(usuario_id)
+    usuario_id = a_object_id(usuario_id)
     
-    # Convertir productos_data a formato correcto
-    productos_procesados = []
-    for producto in productos_data:
-        producto_info = obtener_producto_por_id(producto['producto_id'])
-        if producto_info:
-            productos_procesados.append({
-                'producto_id': ObjectId(producto['producto_id']),
-                'nombre': producto_info['nombre'],
-                'precio': producto_info['precio'],
-                'cantidad': int(producto['cantidad']),
-                'subtotal': producto_info['precio'] * int(producto['cantidad']),
-                'imagen_url': producto_info.get('imagen_url', '')
-            })
+    productos_procesados, total, productos = construir_lineas_pedido(productos_data)
+    if not productos_procesados:
+        raise ValueError('Ninguno de los productos del pedido existe.')
+
+    if descontar_inventario and estado != 'cancelado':
+        _descontar_inventario_lineas(productos_procesados, productos)
     
     pedido = {
         "usuario_id": usuario_id,
         "productos": productos_procesados,
+        "num_productos": len(productos_procesados),
         "total": total,
         "fecha": fecha_actual,
         "estado": estado
     }
     
     resultado = db.pedidos.insert_one(pedido)
-    return resultado.inserted_id
\ No newline at end of file
+    _registrar_cambio_estado_pedido(pedido, None, estado)
+    return resultado.inserted_id
+
+# --- Resúmenes de Ventas (dashboard) ---
+# Colecciones materializadas que se actualizan con $inc cada vez que un pedido se crea,
+# cambia de estado o se elimina, para que el dashboard no tenga que recorrer 'pedidos':
+#   ventas_por_dia, ventas_por_categoria, ventas_por_producto y pedidos_por_estado.
+# Solo cuentan como venta los pedidos en ESTADOS_CON_VENTA.
+# De la misma forma se mantiene productos_comprados, {_id: {usuario_id, producto_id}, pedidos: n},
+# con cuántos pedidos en ESTADOS_COMPRADOS tiene cada usuario de cada producto; con él, saber si
+# un usuario puede reseñar un producto es una lectura por _id.
+# Cada pedido que entra o sale de ESTADOS_CON_VENTA deja además un registro en coocurrencias_cambios,
+# {pedido_id, productos, signo}, que recomendaciones.py suma (o resta) a la matriz "comprados juntos".
+
+ESTADOS_CON_VENTA = ('pendiente', 'enviado', 'entregado')
+ESTADOS_COMPRADOS = ('enviado', 'entregado')
+
+
+def _dia_del_pedido(fecha):
+    """Día (AAAA-MM-DD, hora de Ciudad de México) al que pertenece un pedido."""
+    import pytz
+
+    if fecha.tzinfo is None:
+        fecha = pytz.utc.localize(fecha)  # MongoDB devuelve las fechas en UTC sin zona
+    return fecha.astimezone(pytz.timezone('America/Mexico_City')).strftime('%Y-%m-%d')
+
+
+def _aplicar_venta_a_resumenes(pedido, signo):
+    """Suma (signo=1) o resta (signo=-1) un pedido en los resúmenes de ventas."""
+    _aplicar_ventas_a_resumenes([(pedido, signo)])
+
+
+def _aplicar_ventas_a_resumenes(cambios):
+    """Aplica varios (pedido, signo) a los resúmenes con una escritura por colección."""
+    ids_productos = {linea.get('producto_id') for pedido, _ in cambios for linea in pedido.get('productos', [])}
+    categorias = {
+        prod['_id']: prod.get('categoria')
+        for prod in db.productos.find({'_id': {'$in': list(ids_productos)}}, {'categoria': 1})
+    }
+
+    por_dia = defaultdict(lambda: {'ingresos': 0, 'unidades': 0, 'pedidos': 0})
+    por_producto = defaultdict(lambda: {'ingresos': 0, 'unidades': 0})
+    nombres = {}
+    por_categoria = defaultdict(lambda: {'ingresos': 0, 'unidades': 0})
+    for pedido, signo in cambios:
+        lineas = pedido.get('productos', [])
+        dia = por_dia[_dia_del_pedido(pedido['fecha'])]
+        dia['ingresos'] += signo * pedido.get('total', 0)
+        dia['unidades'] += signo * sum(linea.get('cantidad', 0) for linea in lineas)
+        dia['pedidos'] += signo
+
+        for linea in lineas:
+            ingresos = signo * linea.get('subtotal', 0)
+            unidades = signo * linea.get('cantidad', 0)
+            producto = por_producto[linea.get('producto_id')]
+            producto['ingresos'] += ingresos
+            producto['unidades'] += unidades
+            nombres[linea.get('producto_id')] = linea.get('nombre')
+            categoria = por_categoria[categorias.get(linea.get('producto_id'))]
+            categoria['ingresos'] += ingresos
+            categoria['unidades'] += unidades
+
+    if por_dia:
+        db.ventas_por_dia.bulk_write([
+            UpdateOne({'_id': dia}, {'$inc': valores}, upsert=True)
+            for dia, valores in por_dia.items()
+        ], ordered=False)
+    if por_producto:
+        db.ventas_por_producto.bulk_write([
+            UpdateOne({'_id': producto_id}, {'$inc': valores, '$set': {'nombre': nombres[producto_id]}}, upsert=True)
+            for producto_id, valores in por_producto.items()
+        ], ordered=False)
+    if por_categoria:
+        db.ventas_por_categoria.bulk_write([
+            UpdateOne({'_id': categoria_id}, {'$inc': valores}, upsert=True)
+            for categoria_id, valores in por_categoria.items()
+        ], ordered=False)
+
+
+def _aplicar_productos_comprados(cambios):
+    """Suma (signo=1) o resta (signo=-1) los productos de cada (pedido, signo) en productos_comprados."""
+    conteos = defaultdict(int)
+    for pedido, signo in cambios:
+        for producto_id in {linea.get('producto_id') for linea in pedido.get('productos', [])}:
+            conteos[(pedido.get('usuario_id'), producto_id)] += signo
+
+    operaciones = [
+        UpdateOne({'_id': {'usuario_id': usuario_id, 'producto_id': producto_id}}, {'$inc': {'pedidos': total}}, upsert=True)
+        for (usuario_id, producto_id), total in conteos.items() if total
+    ]
+    if operaciones:
+        db.productos_comprados.bulk_write(operaciones, ordered=False)
+
+
+def _anotar_coocurrencias(cambios):
+    """Deja en coocurrencias_cambios cada (pedido, signo) para la siguiente recalcular_comprados_juntos."""
+    registros = [
+        {
+            'pedido_id': pedido.get('_id'),
+            'productos': sorted({str(linea.get('producto_id')) for linea in pedido.get('productos', []) if linea.get('producto_id')}),
+            'signo': signo
+        }
+        for pedido, signo in cambios
+    ]
+    if registros:
+        db.coocurrencias_cambios.insert_many(registros, ordered=False)
+
+
+def _registrar_cambio_estado_pedido(pedido, estado_anterior, estado_nuevo):
+    """
+    Actualiza los resúmenes cuando un pedido se crea (estado_anterior=None), cambia de estado
+    o se elimina (estado_nuevo=None). Un error aquí no interrumpe la operación del pedido:
+    los resúmenes se pueden recalcular con reconstruir_resumenes_ventas().
+    """
+    try:
+        conteos = []
+        if estado_anterior:
+            conteos.append(UpdateOne({'_id': estado_anterior}, {'$inc': {'total': -1}}, upsert=True))
+        if estado_nuevo:
+            conteos.append(UpdateOne({'_id': estado_nuevo}, {'$inc': {'total': 1}}, upsert=True))
+        if conteos:
+            db.pedidos_por_estado.bulk_write(conteos, ordered=False)
+
+        contaba = estado_anterior in ESTADOS_CON_VENTA
+        cuenta = estado_nuevo in ESTADOS_CON_VENTA
+        if contaba != cuenta:
+            _aplicar_venta_a_resumenes(pedido, 1 if cuenta else -1)
+            _anotar_coocurrencias([(pedido, 1 if cuenta else -1)])
+
+        comprado = estado_nuevo in ESTADOS_COMPRADOS
+        if (estado_anterior in ESTADOS_COMPRADOS) != comprado:
+            _aplicar_productos_comprados([(pedido, 1 if comprado else -1)])
+    except Exception as e:
+        print(f"Error actualizando resúmenes de ventas: {e}")
+
+
+def _registrar_cambios_estado_pedidos(cambios, estado_nuevo):
+    """
+    Versión por lotes de _registrar_cambio_estado_pedido para cambios masivos:
+    cambios es una lista de (pedido, estado_anterior) que pasaron todos a estado_nuevo.
+    """
+    try:
+        conteos = defaultdict(int)
+        ventas = []
+        compras = []
+        cuenta = estado_nuevo in ESTADOS_CON_VENTA
+        comprado = estado_nuevo in ESTADOS_COMPRADOS
+        for pedido, estado_anterior in cambios:
+            conteos[estado_anterior] -= 1
+            conteos[estado_nuevo] += 1
+            if (estado_anterior in ESTADOS_CON_VENTA) != cuenta:
+                ventas.append((pedido, 1 if cuenta else -1))
+            if (estado_anterior in ESTADOS_COMPRADOS) != comprado:
+                compras.append((pedido, 1 if comprado else -1))
+
+        operaciones = [
+            UpdateOne({'_id': estado}, {'$inc': {'total': total}}, upsert=True)
+            for estado, total in conteos.items() if total
+        ]
+        if operaciones:
+            db.pedidos_por_estado.bulk_write(operaciones, ordered=False)
+        if ventas:
+            _aplicar_ventas_a_resumenes(ventas)
+            _anotar_coocurrencias(ventas)
+        if compras:
+            _aplicar_productos_comprados(compras)
+    except Exception as e:
+        print(f"Error actualizando resúmenes de ventas: {e}")
+
+
+def reconstruir_resumenes_ventas():
+    """
+    Recalcula todos los resúmenes desde el historial de pedidos (cada $out reemplaza la
+    colección completa). Conviene ejecutarlo con poco tráfico: los cambios que lleguen
+    mientras corre pueden quedar fuera.
+    """
+    solo_ventas = {'$match': {'estado': {'$in': list(ESTADOS_CON_VENTA)}}}
+
+    db.pedidos.aggregate([
+        {'$group': {'_id': '$estado', 'total': {'$sum': 1}}},
+        {'$out': 'pedidos_por_estado'}
+    ])
+    db.pedidos.aggregate([
+        solo_ventas,
+        {'$group': {
+            '_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$fecha', 'timezone': 'America/Mexico_City'}},
+            'ingresos': {'$sum': '$total'},
+            'unidades': {'$sum': {'$sum': '$productos.cantidad'}},
+            'pedidos': {'$sum': 1}
+        }},
+        {'$out': 'ventas_por_dia'}
+    ])
+    db.pedidos.aggregate([
+        solo_ventas,
+        {'$unwind': '$productos'},
+        {'$group': {
+            '_id': '$productos.producto_id',
+            'nombre': {'$last': '$productos.nombre'},
+            'ingresos': {'$sum': '$productos.subtotal'},
+            'unidades': {'$sum': '$productos.cantidad'}
+        }},
+        {'$out': 'ventas_por_producto'}
+    ])
+    db.pedidos.aggregate([
+        solo_ventas,
+        {'$unwind': '$productos'},
+        {'$lookup': {
+            'from': 'productos',
+            'localField': 'productos.producto_id',
+            'foreignField': '_id',
+            'as': 'producto_info'
+        }},
+        {'$group': {
+            '_id': {'$arrayElemAt': ['$producto_info.categoria', 0]},
+            'ingresos': {'$sum': '$productos.subtotal'},
+            'unidades': {'$sum': '$productos.cantidad'}
+        }},
+        {'$out': 'ventas_por_categoria'}
+    ])
+    db.ventas_por_producto.create_index([('ingresos', -1)])
+    reconstruir_productos_comprados()
+
+
+def reconstruir_productos_comprados():
+    """Recalcula productos_comprados desde el historial de pedidos (mismas advertencias que arriba)."""
+    db.pedidos.aggregate([
+        {'$match': {'estado': {'$in': list(ESTADOS_COMPRADOS)}}},
+        {'$unwind': '$productos'},
+        # Un pedido cuenta una vez por producto aunque lo tenga en varias líneas
+        {'$group': {'_id': {'pedido': '$_id', 'usuario_id': '$usuario_id', 'producto_id': '$productos.producto_id'}}},
+        {'$group': {
+            '_id': {'usuario_id': '$_id.usuario_id', 'producto_id': '$_id.producto_id'},
+            'pedidos': {'$sum': 1}
+        }},
+        {'$out': 'productos_comprados'}
+    ])
+
+
+def obtener_dashboard_ventas(dias=30, top_productos=10):
+    """Datos del dashboard leídos solo de los resúmenes (costo constante sin importar el número de pedidos)."""
+    ventas_dias = list(db.ventas_por_dia.find().sort('_id', -1).limit(dias))
+    ventas_dias.reverse()
+
+    productos = list(db.ventas_por_producto.find().sort('ingresos', -1).limit(top_productos))
+
+    ventas_categorias = list(db.ventas_por_categoria.find().sort('ingresos', -1))
+    nombres = {
+        cat['_id']: cat.get('nombre')
+        for cat in db.categorias.find({'_id': {'$in': [c['_id'] for c in ventas_categorias]}}, {'nombre': 1})
+    }
+    for categoria in ventas_categorias:
+        categoria['nombre'] = nombres.get(categoria['_id'], 'Sin categoría')
+
+    estados = {e['_id']: e['total'] for e in db.pedidos_por_estado.find()}
+
+    return {
+        'ventas_dias': ventas_dias,
+        'productos': productos,
+        'categorias': ventas_categorias,
+        'estados': estados,
+        'ingresos_periodo': sum(d.get('ingresos', 0) for d in ventas_dias),
+        'pedidos_periodo': sum(d.get('pedidos', 0) for d in ventas_dias),
+        'unidades_periodo': sum(d.get('unidades', 0) for d in ventas_dias)
+    }
+
+
+# --- Cola de Procesamiento de Pedidos ---
+# El checkout solo crea el pedido en estado 'procesando' y encola un trabajo en cola_pedidos.
+# worker_pedidos.py toma los trabajos por lotes, descuenta el inventario, cambia el estado del
+# pedido y quita sus líneas del carrito. Los errores se reintentan con espera creciente y, al agotar los
+# intentos, el trabajo queda como 'fallido' (dead-letter) para revisión del admin.
+
+def encolar_checkout(usuario_id, carrito_data):
+    """
+    Crea el pedido pendiente de procesar y encola su trabajo de checkout.
+    Es idempotente: el mismo carrito (misma fecha de modificación) produce la misma clave,
+    así que un doble envío devuelve el pedido ya creado. Devuelve (pedido_id, nuevo).
+    """
+    usuario_id = a_object_id(usuario_id)
+
+    fecha_carrito = carrito_data.get('fecha_modificacion')
+    clave = f"{usuario_id}:{fecha_carrito.isoformat() if fecha_carrito else ''}"
+
+    try:
+        pedido_id = crear_pedido(
+            usuario_id, carrito_data['items'], carrito_data['total'],
+            estado='procesando', clave_checkout=clave
+        )
+    except DuplicateKeyError:
+        existente = db.pedidos.find_one({'clave_checkout': clave}, {'_id': 1, 'estado': 1})
+        if existente.get('estado') == 'procesando':
+            # Si el proceso que creó el pedido murió antes de encolarlo, el reenvío lo encola
+            _encolar_trabajo_checkout(existente['_id'], usuario_id)
+        return existente['_id'], False
+
+    _encolar_trabajo_checkout(pedido_id, usuario_id)
+    return pedido_id, True
+
+
+def _encolar_trabajo_checkout(pedido_id, usuario_id):
+    """Crea el trabajo de checkout del pedido si todavía no existe (upsert por pedido_id)."""
+    ahora = datetime.now()
+    db.cola_pedidos.update_one(
+        {'pedido_id': pedido_id},
+        {'$setOnInsert': {
+            'tipo': 'checkout',
+            'usuario_id': usuario_id,
+            'estado': 'pendiente',
+            'intentos': 0,
+            'disponible_en': ahora,
+            'creado': ahora
+        }},
+        upsert=True
+    )
+
+
+def tomar_lote_cola(tamano_lote, segundos_visibilidad):
+    """
+    Reclama hasta tamano_lote trabajos disponibles (pendientes, o en proceso cuyo bloqueo venció
+    porque el worker que los tomaba murió). Devuelve los trabajos reclamados.
+    """
+    ahora = datetime.now()
+    ids = [t['_id'] for t in db.cola_pedidos.find({'$or': [
+        {'estado': 'pendiente', 'disponible_en': {'$lte': ahora}},
+        {'estado': 'en_proceso', 'bloqueado_hasta': {'$lt': ahora}}
+    ]}, {'_id': 1}).sort('disponible_en', 1).limit(tamano_lote)]
+    if not ids:
+        return []
+
+    token = ObjectId()
+    db.cola_pedidos.update_many(
+        {'_id': {'$in': ids}, '$or': [
+            {'estado': 'pendiente'},
+            {'estado': 'en_proceso', 'bloqueado_hasta': {'$lt': ahora}}
+        ]},
+        {
+            '$set': {
+                'estado': 'en_proceso',
+                'token': token,
+                'bloqueado_hasta': ahora + timedelta(seconds=segundos_visibilidad)
+            },
+            '$inc': {'intentos': 1}
+        }
+    )
+    return list(db.cola_pedidos.find({'token': token}))
+
+
+def _quitar_lineas_carrito(usuario_id, items):
+    """
+    Quita del carrito solo las unidades de items (las líneas del pedido); lo que el usuario
+    agregó después se conserva. La escritura es condicional al arreglo leído y se reintenta
+    si el carrito cambió entre la lectura y la escritura.
+    """
+    for _ in range(5):
+        carrito = db.carrito.find_one({'usuario_id': usuario_id}, {'productos': 1})
+        if not carrito:
+            return
+        por_quitar = {item['producto_id']: item['cantidad'] for item in items}
+        restantes = []
+        for producto_id in carrito.get('productos', []):
+            if por_quitar.get(producto_id, 0) > 0:
+                por_quitar[producto_id] -= 1
+            else:
+                restantes.append(producto_id)
+
+        resultado = db.carrito.update_one(
+            {'_id': carrito['_id'], 'productos': carrito.get('productos', [])},
+            {'$set': {'productos': restantes}}
+        )
+        if resultado.matched_count:
+            _recalcular_total_carrito(usuario_id)
+            return
+    print(f"No se pudieron quitar del carrito las líneas del pedido del usuario {usuario_id}")
+
+
+def procesar_trabajo_checkout(trabajo):
+    """
+    Finaliza un checkout: convierte las reservas en descuentos, deja el pedido como 'pendiente'
+    (o 'cancelado' si no alcanzó el inventario) y quita sus líneas del carrito.
+    Es seguro reintentarlo: confirmar_reservas_carrito trabaja con el _id del pedido como token
+    y retoma lo que un intento anterior dejó a medias; 'inventario_confirmado' se marca solo
+    cuando el descuento ya se aplicó, y con la marca el reintento solo termina el cambio de
+    estado. Devuelve el estado final del pedido y lanza RuntimeError si no pudo cambiarlo
+    (el worker lo reintenta).
+    """
+    pedido = db.pedidos.find_one(
+        {'_id': trabajo['pedido_id']}, {'productos': 1, 'estado': 1, 'inventario_confirmado': 1}
+    )
+    if not pedido or pedido.get('estado') != 'procesando':
+        # Ya se procesó en un intento anterior (o se eliminó): nada que hacer
+        return pedido.get('estado') if pedido else None
+
+    if not pedido.get('inventario_confirmado'):
+        insuficientes = confirmar_reservas_carrito(trabajo['usuario_id'], pedido['productos'], pedido['_id'])
+        if insuficientes:
+            # confirmar_reservas_carrito no descontó nada: el pedido se cancela
+            if not actualizar_estado_pedido(
+                pedido['_id'], 'cancelado', estado_actual='procesando',
+                campos_extra={'motivo': f'Inventario insuficiente para: {", ".join(insuficientes)}'}
+            ):
+                raise RuntimeError(f"No se pudo cancelar el pedido {pedido['_id']}")
+            # Tocar el carrito para que un nuevo intento de pago genere otra clave de idempotencia
+            db.carrito.update_one({'usuario_id': trabajo['usuario_id']}, {'$set': {'fecha_modificacion': datetime.now(timezone.utc)}})
+            return 'cancelado'
+        db.pedidos.update_one(
+            {'_id': pedido['_id'], 'estado': 'procesando'}, {'$set': {'inventario_confirmado': True}}
+        )
+    # Con la marca guardada ya no hacen falta las reservas aplicadas del lote
+    cerrar_reservas_confirmadas(pedido['_id'])
+
+    if not actualizar_estado_pedido(pedido['_id'], 'pendiente', estado_actual='procesando'):
+        raise RuntimeError(f"No se pudo cambiar el pedido {pedido['_id']} a 'pendiente'")
+    # Solo el intento que cambió el estado quita las líneas, así un reintento no las quita dos veces
+    _quitar_lineas_carrito(trabajo['usuario_id'], pedido['productos'])
+    return 'pendiente'
+
+
+def registrar_resultados_cola(resultados, max_intentos):
+    """
+    Guarda en un solo bulk_write el resultado de un lote de trabajos.
+    resultados = [(trabajo, error o None)]. Los errores se reintentan con espera exponencial
+    y al llegar a max_intentos el trabajo pasa a 'fallido'.
+    """
+    ahora = datetime.now()
+    operaciones = []
+    fallidos = []
+    for trabajo, error in resultados:
+        filtro = {'_id': trabajo['_id'], 'token': trabajo['token']}
+        if error is None:
+            operaciones.append(UpdateOne(filtro, {
+                # Campo del índice TTL: MongoDB lo compara en UTC
+                '$set': {'estado': 'completado', 'completado': datetime.now(timezone.utc)},
+                '$unset': {'token': '', 'bloqueado_hasta': ''}
+            }))
+        elif trabajo['intentos'] >= max_intentos:
+            fallidos.append(trabajo['pedido_id'])
+            operaciones.append(UpdateOne(filtro, {
+                '$set': {'estado': 'fallido', 'error': str(error)},
+                '$unset': {'token': '', 'bloqueado_hasta': ''}
+            }))
+        else:
+            espera = min(2 ** trabajo['intentos'], 300)
+            operaciones.append(UpdateOne(filtro, {
+                '$set': {'estado': 'pendiente', 'error': str(error), 'disponible_en': ahora + timedelta(seconds=espera)},
+                '$unset': {'token': '', 'bloqueado_hasta': ''}
+            }))
+
+    if operaciones:
+        db.cola_pedidos.bulk_write(operaciones, ordered=False)
+    for pedido_id in fallidos:
+        actualizar_estado_pedido(pedido_id, 'fallido', estado_actual='procesando')
+
+
+def reintentar_trabajos_fallidos():
+    """Devuelve a la cola los trabajos en dead-letter (por ejemplo, tras corregir la causa)."""
+    trabajos = list(db.cola_pedidos.find({'estado': 'fallido'}, {'pedido_id': 1}))
+    if not trabajos:
+        return 0
+
+    db.cola_pedidos.update_many(
+        {'_id': {'$in': [t['_id'] for t in trabajos]}, 'estado': 'fallido'},
+        {'$set': {'estado': 'pendiente', 'intentos': 0, 'disponible_en': datetime.now()}}
+    )
+    for trabajo in trabajos:
+        actualizar_estado_pedido(trabajo['pedido_id'], 'procesando', estado_actual='fallido')
+    return len(trabajos)
+
+
+def obtener_metricas_cola():
+    """Profundidad de la cola por estado y antigüedad del trabajo pendiente más viejo (segundos)."""
+    metricas = {'pendiente': 0, 'en_proceso': 0, 'completado': 0, 'fallido': 0}
+    for grupo in db.cola_pedidos.aggregate([{'$group': {'_id': '$estado', 'total': {'$sum': 1}}}]):
+        metricas[grupo['_id']] = grupo['total']
+
+    mas_antiguo = db.cola_pedidos.find_one({'estado': 'pendiente'}, {'creado': 1}, sort=[('creado', 1)])
+    metricas['antiguedad_pendiente_segundos'] = (
+        (datetime.now() - mas_antiguo['creado']).total_seconds() if mas_antiguo else 0
+    )
+    return metricas
+
+
+################################################################################################################
+# --- Índices y mantenimiento ---
+
+def _crear_indice_ttl(coleccion, campo, segundos):
+    """Crea un índice TTL o ajusta su expiración si ya existe con otro valor."""
+    try:
+        coleccion.create_index([(campo, -1)], expireAfterSeconds=segundos)
+    except OperationFailure:
+        db.command('collMod', coleccion.name, index={
+            'keyPattern': {campo: -1},
+            'expireAfterSeconds': segundos
+        })
+
+
+def crear_indices():
+    """Crea los índices que necesita la aplicación (idempotente)."""
+    # Carritos: búsqueda por usuario y expiración/orden por fecha de modificación
+    db.carrito.create_index('usuario_id', unique=True)
+    _crear_indice_ttl(db.carrito, 'fecha_modificacion', config.DIAS_EXPIRACION_CARRITO * 24 * 3600)
+
+    # Reservas de inventario: por usuario/producto, barrido por vencimiento y lotes por token
+    db.reservas.create_index([('usuario_id', 1), ('producto_id', 1), ('estado', 1)])
+    db.reservas.create_index([('estado', 1), ('expira', 1)])
+    db.reservas.create_index('token', sparse=True)
+    db.reservas.create_index([('estado', 1), ('reclamada', 1)])  # lotes abandonados
+
+    # Bus de invalidación de caché: colección capped (los eventos viejos se descartan solos)
+    if 'cambios' not in _db_primaria.list_collection_names():
+        _db_primaria.create_collection(
+            'cambios', capped=True, size=config.CAMBIOS_MAX_DOCUMENTOS * 512, max=config.CAMBIOS_MAX_DOCUMENTOS
+        )
+
+    # Sesiones del lado del servidor (sesiones.py)
+    db.sesiones.create_index('expira', expireAfterSeconds=0)
+    db.sesiones.create_index('usuario_id')
+
+    # Intentos de inicio de sesión fallidos (se borran al vencer la ventana)
+    db.intentos_login.create_index('expira', expireAfterSeconds=0)
+
+    # Usuarios: inicio de sesión por correo
+    db.usuarios.create_index('correo')
+
+    # Productos: clave de importación masiva (sku), respaldo por nombre y listado por categoría
+    db.productos.create_index('sku', unique=True, sparse=True)
+    db.productos.create_index('nombre')
+    db.productos.create_index('categoria')
+
+    # Inventario fragmentado (modo venta flash)
+    db.inventario_shards.create_index([('producto_id', 1), ('shard', 1)], unique=True)
+
+    # Resúmenes de ventas del dashboard
+    db.ventas_por_producto.create_index([('ingresos', -1)])
+
+    # Historial de pedidos del cliente (paginación por usuario y fecha)
+    db.pedidos.create_index([('usuario_id', 1), ('fecha', -1), ('_id', -1)])
+
+    # Exportaciones por rango de fechas
+    db.pedidos.create_index('fecha')
+    db.reseñas.create_index('fecha')
+
+    # Cambios de estado en lote (token temporal)
+    db.pedidos.create_index('lote_estado', sparse=True)
+
+    # Reseñas: listado por producto y una sola reseña por usuario y producto. El índice único
+    # necesita los ids normalizados (flask migrar-ids) y sin reseñas duplicadas.
+    db.reseñas.create_index([('producto_id', 1), ('fecha', -1)])
+    try:
+        db.reseñas.create_index([('usuario_id', 1), ('producto_id', 1)], unique=True)
+    except OperationFailure as e:
+        print(f"No se pudo crear el índice único de reseñas (ejecuta flask migrar-ids): {e}")
+
+    # Recomendaciones "comprados juntos" (recomendaciones.py): filas con top-k por recalcular y
+    # recorrido de los pedidos con venta al reconstruir
+    db.coocurrencias.create_index('pendiente', sparse=True)
+    db.pedidos.create_index([('estado', 1), ('_id', 1)])
+
+    # Cola de pedidos: idempotencia del checkout y búsqueda de trabajos disponibles
+    db.pedidos.create_index('clave_checkout', unique=True, sparse=True)
+    db.cola_pedidos.create_index([('estado', 1), ('disponible_en', 1)])
+    db.cola_pedidos.create_index([('estado', 1), ('creado', 1)])  # pendiente más antiguo (métricas)
+    db.cola_pedidos.create_index('token', sparse=True)
+    db.cola_pedidos.create_index('pedido_id', unique=True)  # un solo trabajo por pedido (upsert al encolar)
+    # Los trabajos completados se borran solos después de una semana
+    db.cola_pedidos.create_index('completado', expireAfterSeconds=7 * 24 * 3600)
+
+
+def completar_resumen_carritos():
+    """
+    Completa los campos precalculados en carritos antiguos que no los tienen,
+    para que aparezcan ordenados en el admin y puedan expirar por TTL.
+    """
+    resultado = db.carrito.update_many(
+        {'$or': [
+            {'fecha_modificacion': {'$exists': False}},
+            {'cantidad_total': {'$exists': False}}
+        ]},
+        [{'$set': {
+            'productos': {'$ifNull': ['$productos', []]},
+            'total': {'$ifNull': ['$total', 0]},
+            'cantidad_total': {'$size': {'$ifNull': ['$productos', []]}},
+            'productos_unicos': {'$size': {'$setUnion': [{'$ifNull': ['$productos', []]}, []]}},
+            'fecha_modificacion': {'$ifNull': ['$fecha_modificacion', '$$NOW']}
+        }}]
+    )
+    return resultado.modified_count
+
+
+def completar_resumen_pedidos():
+    """Guarda num_productos en los pedidos antiguos que no lo tienen (para el listado resumido)."""
+    resultado = db.pedidos.update_many(
+        {'num_productos': {'$exists': False}},
+        [{'$set': {'num_productos': {'$size': {'$ifNull': ['$productos', []]}}}}]
+    )
+    return resultado.modified_count
+
+
+def completar_productos_comprados():
+    """Construye productos_comprados la primera vez (si está vacía). Devuelve cuántos registros tiene."""
+    if db.productos_comprados.estimated_document_count() == 0:
+        reconstruir_productos_comprados()
+    return db.productos_comprados.estimated_document_count()
+
+
+# Referencias que migrar_ids_object_id convierte a ObjectId: (campo, forma) donde forma es
+# 'valor', 'arreglo' (arreglo de ids, como carrito.productos) o 'lineas' (subdocumentos con producto_id)
+MIGRACION_IDS = {
+    'reseñas': [('usuario_id', 'valor'), ('producto_id', 'valor')],
+    'carrito': [('usuario_id', 'valor'), ('productos', 'arreglo')],
+    'pedidos': [('usuario_id', 'valor'), ('productos', 'lineas')],
+}
+
+
+def _migracion_ids_coleccion(campos):
+    """(filtro de documentos con algún id de texto, pipeline de actualización que los convierte)."""
+    condiciones = []
+    etapa = {}
+    for campo, forma in campos:
+        if forma == 'valor':
+            condiciones.append({campo: {'$type': 'string'}})
+            etapa[campo] = _expr_a_object_id(f'${campo}')
+            continue
+
+        if forma == 'arreglo':
+            condiciones.append({campo: {'$type': 'string'}})
+            convertir = _expr_a_object_id('$$this')
+        else:
+            condiciones.append({f'{campo}.producto_id': {'$type': 'string'}})
+            convertir = {'$mergeObjects': ['$$this', {'producto_id': _expr_a_object_id('$$this.producto_id')}]}
+        etapa[campo] = {'$cond': [
+            {'$isArray': f'${campo}'},
+            {'$map': {'input': f'${campo}', 'in': convertir}},
+            f'${campo}'
+        ]}
+    return {'$or': condiciones}, [{'$set': etapa}]
+
+
+def migrar_ids_object_id(tamano_lote=1000, reiniciar=False):
+    """
+    Migración única: convierte a ObjectId las referencias guardadas como texto (MIGRACION_IDS).
+    Recorre cada colección por _id en lotes y guarda el avance en 'migraciones', así que se puede
+    interrumpir y volver a ejecutar. La conversión corre en el servidor (actualización con
+    pipeline), por lo que no pisa cambios hechos mientras tanto en los mismos documentos.
+    Devuelve {coleccion: documentos corregidos, 'reseñas_duplicadas': [...]}.
+    """
+    if reiniciar:
+        db.migraciones.delete_one({'_id': 'ids_object_id'})
+    avance = db.migraciones.find_one({'_id': 'ids_object_id'}) or {}
+
+    reporte = {}
+    for coleccion, campos in MIGRACION_IDS.items():
+        filtro, pipeline = _migracion_ids_coleccion(campos)
+        ultimo = avance.get(coleccion)
+        corregidos = 0
+        while True:
+            consulta = {'$and': [filtro, {'_id': {'$gt': ultimo}}]} if ultimo else filtro
+            ids = [doc['_id'] for doc in db[coleccion].find(consulta, {'_id': 1}).sort('_id', 1).limit(tamano_lote)]
+            if not ids:
+                break
+            corregidos += db[coleccion].update_many({'_id': {'$in': ids}}, pipeline).modified_count
+            ultimo = ids[-1]
+            db.migraciones.update_one({'_id': 'ids_object_id'}, {'$set': {coleccion: ultimo}}, upsert=True)
+        reporte[coleccion] = corregidos
+
+    if reporte['pedidos']:
+        reconstruir_productos_comprados()
+
+    # Reseñas que quedaron repetidas al unificar los tipos; impiden el índice único
+    reporte['reseñas_duplicadas'] = list(db.reseñas.aggregate([
+        {'$group': {
+            '_id': {'usuario_id': '$usuario_id', 'producto_id': '$producto_id'},
+            'reseñas': {'$push': '$_id'},
+            'total': {'$sum': 1}
+        }},
+        {'$match': {'total': {'$gt': 1}}}
+    ], allowDiskUse=True))
+    if not reporte['reseñas_duplicadas']:
+        db.reseñas.create_index([('usuario_id', 1), ('producto_id', 1)], unique=True)
+    return reporte
+
+
+# --- Política de lectura ---
+# Único lugar donde se decide qué lecturas pueden ir a un secundario (con atraso máximo de
+# MONGO_MAX_STALENESS_SEGUNDOS). Todo lo que no aparece aquí, y en especial carrito, checkout
+# y autenticación, lee del primario. Las funciones llamadas desde otra heredan su política.
+
+POLITICA_LECTURA = {
+    # Catálogo
+    'obtener_categorias': 'secundaria',
+    'obtener_categoria_por_id': 'secundaria',
+    'obtener_productos': 'secundaria',
+    'obtener_productos_por_categoria': 'secundaria',
+    'obtener_producto_catalogo': 'secundaria',
+    # Reseñas públicas
+    'obtener_reseñas': 'secundaria',
+    'obtener_reseñas_por_producto': 'secundaria',
+    'calcular_promedio_calificacion': 'secundaria',
+    # Reportes del admin
+    'obtener_dashboard_ventas': 'secundaria',
+    'obtener_metricas_cola': 'secundaria',
+    'generar_exportacion': 'secundaria',  # exportacion.py
+    # Recomendaciones (recomendaciones.py); se recalculan fuera de línea
+    'obtener_comprados_juntos': 'secundaria',
+    'obtener_recomendaciones_carrito': 'secundaria',
+    # Siempre del primario aunque se llamen desde una lectura tolerante
+    'obtener_usuario_por_correo': 'primaria',
+    'login_bloqueado': 'primaria',
+    'obtener_carrito_por_usuario': 'primaria',
+    'obtener_producto_por_id': 'primaria',  # formulario del admin y validación del carrito
+    'obtener_inventario_disponible': 'primaria',
+    'obtener_inventarios_disponibles': 'primaria',  # stock del catálogo cacheado
+    'verificar_inventario_suficiente': 'primaria',
+    'verificar_usuario_puede_reseñar': 'primaria',
+}
+
+
+def politica_lectura(funcion):
+    """Decorador: ejecuta la función con la política declarada para su nombre en POLITICA_LECTURA."""
+    politica = POLITICA_LECTURA.get(funcion.__name__, 'primaria')
+
+    @wraps(funcion)
+    def envoltura(*args, **kwargs):
+        token = _lectura_actual.set(politica)
+        try:
+            return funcion(*args, **kwargs)
+        finally:
+            _lectura_actual.reset(token)
+    return envoltura
+
+
+for _nombre in POLITICA_LECTURA:
+    if _nombre in globals():
+        globals()[_nombre] = politica_lectura(globals()[_nombre])
+
+
+# --- Trazas ---
+# Un span por llamada a cada función pública de este módulo (ver trazas.py). Los ayudantes que
+# no consultan la base de datos se dejan fuera para no llenar las trazas de ruido.
+_SIN_TRAZA = {'a_object_id', 'rango_fechas', 'politica_lectura'}
+
+if trazas_activas():
+    for _nombre, _funcion in list(globals().items()):
+        if (callable(_funcion) and getattr(_funcion, '__module__', None) == __name__
+                and not _nombre.startswith('_') and _nombre not in _SIN_TRAZA and not isinstance(_funcion, type)):
+            globals()[_nombre] = trazar(_funcion)
+
+
+def diagnosticar_lecturas():
+    """Para cada política, el servidor que atiende una lectura de prueba (host, puerto)."""
+    servidores = {}
+    for politica, base in (('primaria', _db_primaria), ('secundaria', _db_secundaria)):
+        cursor = base.categorias.find({}, {'_id': 1}).limit(1)
+        list(cursor)
+        servidores[politica] = cursor.address
+    return servidores
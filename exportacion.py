@@ -0,0 +1,133 @@
+# ecommerce-flask/exportacion.py
+
+import csv
+import io
+import json
+from datetime import datetime
+
+from bson import ObjectId
+
+import config
+from database import db, rango_fechas, politica_lectura, _sumar_inventario_fragmentado
+
+# --- Exportaciones en streaming (CSV o JSONL) ---
+# Se leen directamente de un cursor de MongoDB con proyección en el servidor y batch_size,
+# y se emiten en bloques de texto, así que la memoria no depende del número de filas.
+
+EXPORTACIONES = {
+    'pedidos': {
+        'coleccion': 'pedidos',
+        'campos': ['_id', 'usuario_id', 'fecha', 'estado', 'total', 'num_productos'],
+        'campo_fecha': 'fecha'
+    },
+    'resenas': {
+        'coleccion': 'reseñas',
+        'campos': ['_id', 'producto_id', 'usuario_id', 'calificacion', 'comentario', 'fecha'],
+        'campo_fecha': 'fecha'
+    },
+    'productos': {
+        'coleccion': 'productos',
+        'campos': ['_id', 'sku', 'nombre', 'descripcion', 'precio', 'inventario', 'categoria', 'activo', 'imagen_url'],
+        'campo_fecha': None,
+        # El inventario de los productos fragmentados es la suma de sus shards (una consulta por lote)
+        'preparar_lote': _sumar_inventario_fragmentado,
+        'campos_extra': ['inventario_fragmentado']
+    }
+}
+
+FORMATOS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+
+def _a_texto(valor):
+    if isinstance(valor, ObjectId):
+        return str(valor)
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    return valor
+
+
+def _cursor_exportacion(tipo, desde=None, hasta=None):
+    definicion = EXPORTACIONES[tipo]
+    filtro = {}
+    orden = [('_id', 1)]
+    if definicion['campo_fecha']:
+        rango = rango_fechas(desde, hasta)
+        if rango:
+            filtro[definicion['campo_fecha']] = rango
+        orden = [(definicion['campo_fecha'], 1)]
+
+    proyeccion = {campo: 1 for campo in definicion['campos'] + definicion.get('campos_extra', [])}
+    return (
+        db[definicion['coleccion']]
+        .find(filtro, proyeccion)
+        .sort(orden)
+        .batch_size(config.EXPORTACION_BATCH_SIZE)
+    )
+
+
+def _documentos(cursor, preparar_lote):
+    """Los documentos del cursor; con preparar_lote se procesan en lotes de EXPORTACION_BATCH_SIZE."""
+    if preparar_lote is None:
+        yield from cursor
+        return
+    lote = []
+    for documento in cursor:
+        lote.append(documento)
+        if len(lote) >= config.EXPORTACION_BATCH_SIZE:
+            yield from preparar_lote(lote)
+            lote = []
+    if lote:
+        yield from preparar_lote(lote)
+
+
+def _emitir_bloques(cursor, campos, formato, preparar_lote=None):
+    buffer = io.StringIO()
+    escritor = None
+    if formato == 'csv':
+        escritor = csv.DictWriter(buffer, fieldnames=campos, extrasaction='ignore')
+        escritor.writeheader()
+
+    try:
+        for documento in _documentos(cursor, preparar_lote):
+            fila = {campo: _a_texto(documento.get(campo)) for campo in campos}
+            if escritor:
+                escritor.writerow(fila)
+            else:
+                buffer.write(json.dumps(fila, ensure_ascii=False, default=str))
+                buffer.write('\n')
+
+            if buffer.tell() >= config.EXPORTACION_TAMANO_BLOQUE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    finally:
+        cursor.close()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+@politica_lectura
+def generar_exportacion(tipo, formato='csv', desde=None, hasta=None):
+    """
+    Devuelve un generador con la exportación en bloques de texto.
+    Valida antes de empezar: KeyError si el tipo o formato no existen y
+    ValueError si las fechas no tienen formato AAAA-MM-DD.
+    """
+    if tipo not in EXPORTACIONES or formato not in FORMATOS:
+        raise KeyError(f'{tipo}.{formato}')
+    rango_fechas(desde, hasta)  # también para los tipos sin fecha: el nombre del archivo las usa
+    definicion = EXPORTACIONES[tipo]
+    cursor = _cursor_exportacion(tipo, desde, hasta)
+    return _emitir_bloques(cursor, definicion['campos'], formato, definicion.get('preparar_lote'))
+
+
+def nombre_archivo_exportacion(tipo, formato, desde=None, hasta=None):
+    """Nombre del archivo descargado. Las fechas se vuelven a formatear (ValueError si no son AAAA-MM-DD)."""
+    partes = [tipo]
+    if EXPORTACIONES[tipo]['campo_fecha']:
+        if desde:
+            partes.append(f"desde_{datetime.strptime(desde, '%Y-%m-%d'):%Y-%m-%d}")
+        if hasta:
+            partes.append(f"hasta_{datetime.strptime(hasta, '%Y-%m-%d'):%Y-%m-%d}")
+    return '_'.join(partes) + f'.{formato}'
@@ -0,0 +1,191 @@
+# ecommerce-flask/importacion.py
+
+import csv
+import io
+import json
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import config
+from database import db, establecer_inventario_producto
+
+# --- Importación masiva de productos (CSV o JSONL) ---
+# El archivo se lee fila por fila y se escribe en lotes con bulk_write(ordered=False),
+# así que la memoria usada depende del tamaño de lote y no del tamaño del archivo.
+# Columnas: nombre*, precio*, categoria* (nombre de la categoría), descripcion, inventario,
+# activo, imagen_url, sku. Si hay sku el producto se actualiza por sku; si no, por nombre.
+# El inventario de los productos con inventario fragmentado (venta flash) vive en sus contadores,
+# así que no se escribe en el documento: se reparte con establecer_inventario_producto.
+
+VALORES_VERDADEROS = {'1', 'true', 'si', 'sí', 'yes', 'x'}
+
+
+def _leer_filas(archivo, formato):
+    """Genera (número de línea, fila como dict) sin cargar el archivo completo."""
+    if formato == 'csv':
+        lector = csv.DictReader(archivo)
+        for fila in lector:
+            yield lector.line_num, fila
+    else:
+        for numero, linea in enumerate(archivo, start=1):
+            linea = linea.strip()
+            if not linea:
+                continue
+            try:
+                yield numero, json.loads(linea)
+            except json.JSONDecodeError as e:
+                yield numero, e
+
+
+def _mapa_categorias():
+    """Nombre de categoría (en minúsculas) -> ObjectId, cargado una sola vez por importación."""
+    return {
+        cat['nombre'].strip().lower(): cat['_id']
+        for cat in db.categorias.find({}, {'nombre': 1})
+        if cat.get('nombre')
+    }
+
+
+def _productos_fragmentados():
+    """('sku' o 'nombre', valor) -> ObjectId de los productos con inventario fragmentado (son pocos)."""
+    fragmentados = {}
+    for prod in db.productos.find({'inventario_fragmentado': True}, {'sku': 1, 'nombre': 1}):
+        if prod.get('sku'):
+            fragmentados[('sku', prod['sku'])] = prod['_id']
+        fragmentados[('nombre', prod.get('nombre'))] = prod['_id']
+    return fragmentados
+
+
+def _tiene_valor(fila, campo):
+    return fila.get(campo) not in (None, '')
+
+
+def _fila_a_operacion(fila, categorias, fragmentados):
+    """
+    Valida una fila y la convierte en un UpdateOne con upsert. Lanza ValueError si es inválida.
+    Devuelve (operación, (producto_id, inventario) si el producto tiene inventario fragmentado o None).
+    """
+    if isinstance(fila, Exception):
+        raise ValueError(f'JSON inválido: {fila}')
+    if not isinstance(fila, dict):
+        raise ValueError('Cada línea debe ser un objeto JSON')
+
+    nombre = str(fila.get('nombre') or '').strip()
+    if not nombre:
+        raise ValueError('Falta el nombre')
+
+    try:
+        precio = float(fila.get('precio'))
+    except (TypeError, ValueError):
+        raise ValueError(f"Precio inválido: {fila.get('precio')!r}")
+
+    nombre_categoria = str(fila.get('categoria') or '').strip().lower()
+    if nombre_categoria not in categorias:
+        raise ValueError(f"Categoría desconocida: {fila.get('categoria')!r}")
+
+    producto = {'nombre': nombre, 'precio': precio, 'categoria': categorias[nombre_categoria]}
+    # Las columnas opcionales solo se actualizan si vienen en la fila; si no, se usan al insertar
+    por_defecto = {'descripcion': '', 'inventario': 0, 'activo': True, 'imagen_url': ''}
+
+    if _tiene_valor(fila, 'inventario'):
+        try:
+            producto['inventario'] = int(fila['inventario'])
+        except (TypeError, ValueError):
+            raise ValueError(f"Inventario inválido: {fila.get('inventario')!r}")
+
+    if _tiene_valor(fila, 'activo'):
+        activo = fila['activo']
+        producto['activo'] = activo if isinstance(activo, bool) else str(activo).strip().lower() in VALORES_VERDADEROS
+
+    for campo in ('descripcion', 'imagen_url'):
+        if _tiene_valor(fila, campo):
+            producto[campo] = str(fila[campo])
+
+    sku = str(fila.get('sku') or '').strip()
+    if sku:
+        producto['sku'] = sku
+        filtro = {'sku': sku}
+    else:
+        filtro = {'nombre': nombre}
+
+    inventario_fragmentado = None
+    producto_fragmentado = fragmentados.get(('sku', sku) if sku else ('nombre', nombre))
+    if producto_fragmentado and 'inventario' in producto:
+        inventario_fragmentado = (producto_fragmentado, producto.pop('inventario'))
+
+    al_insertar = {campo: valor for campo, valor in por_defecto.items() if campo not in producto}
+    actualizacion = {'$set': producto}
+    if al_insertar:
+        actualizacion['$setOnInsert'] = al_insertar
+    return UpdateOne(filtro, actualizacion, upsert=True), inventario_fragmentado
+
+
+def _escribir_lote(operaciones, lineas, inventarios, reporte):
+    """Escribe el lote; inventarios = {índice en el lote: (producto_id, inventario)} fragmentados."""
+    fallidos = set()
+    try:
+        resultado = db.productos.bulk_write(operaciones, ordered=False)
+        detalles = resultado.bulk_api_result
+    except BulkWriteError as e:
+        detalles = e.details
+        for error in detalles.get('writeErrors', []):
+            fallidos.add(error['index'])
+            _agregar_error(reporte, lineas[error['index']], error.get('errmsg', 'Error de escritura'))
+
+    for indice, (producto_id, inventario) in inventarios.items():
+        if indice not in fallidos:
+            establecer_inventario_producto(producto_id, inventario)
+
+    reporte['insertados'] += detalles.get('nUpserted', 0)
+    reporte['actualizados'] += detalles.get('nModified', 0)
+
+
+def _agregar_error(reporte, linea, mensaje):
+    reporte['total_errores'] += 1
+    if len(reporte['errores']) < config.IMPORTACION_MAX_ERRORES_REPORTE:
+        reporte['errores'].append({'linea': linea, 'error': mensaje})
+
+
+def importar_productos(archivo, formato='csv', tamano_lote=None):
+    """
+    Importa productos desde un archivo de texto abierto (CSV o JSONL).
+    Devuelve un reporte con filas procesadas, insertadas, actualizadas y los errores por línea.
+    """
+    tamano_lote = tamano_lote or config.IMPORTACION_TAMANO_LOTE
+    categorias = _mapa_categorias()
+    fragmentados = _productos_fragmentados()
+    reporte = {'procesadas': 0, 'insertados': 0, 'actualizados': 0, 'total_errores': 0, 'errores': []}
+
+    operaciones = []
+    lineas = []
+    inventarios = {}
+    for linea, fila in _leer_filas(archivo, formato):
+        reporte['procesadas'] += 1
+        try:
+            operacion, inventario_fragmentado = _fila_a_operacion(fila, categorias, fragmentados)
+            if inventario_fragmentado:
+                inventarios[len(operaciones)] = inventario_fragmentado
+            operaciones.append(operacion)
+            lineas.append(linea)
+        except ValueError as e:
+            _agregar_error(reporte, linea, str(e))
+
+        if len(operaciones) >= tamano_lote:
+            _escribir_lote(operaciones, lineas, inventarios, reporte)
+            operaciones, lineas, inventarios = [], [], {}
+
+    if operaciones:
+        _escribir_lote(operaciones, lineas, inventarios, reporte)
+
+    return reporte
+
+
+def formato_por_nombre(nombre_archivo):
+    """Deduce el formato ('csv' o 'jsonl') a partir de la extensión del archivo."""
+    return 'jsonl' if nombre_archivo.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def abrir_como_texto(flujo_binario):
+    """Envuelve un flujo binario (por ejemplo, un archivo subido) para leerlo como texto UTF-8."""
+    return io.TextIOWrapper(flujo_binario, encoding='utf-8-sig', newline='')
@@ -0,0 +1,212 @@
+# ecommerce-flask/memoria.py
+
+import itertools
+import os
+import threading
+import tracemalloc
+from datetime import datetime
+
+from flask import g, request
+
+import config
+
+# --- Diagnóstico de memoria ---
+# Desde /admin/memoria se inicia o detiene tracemalloc, se toman instantáneas y se comparan dos
+# de ellas agrupadas por archivo/línea. Mientras el rastreo está activo, cada petición registra
+# el pico de memoria que alcanzó sobre la memoria que había al empezar, agrupado por ruta.
+# Todo es por proceso: cada worker tiene su propio rastreo, instantáneas y picos.
+# El pico de tracemalloc es uno solo por proceso: solo se registra el de las peticiones que
+# corrieron solas de principio a fin; las que se traslaparon con otra se cuentan como omitidas.
+# Con varios hilos por worker los picos son de una muestra; con el rastreo detenido el costo por
+# petición es una comprobación.
+
+_lock = threading.Lock()
+_instantaneas = []  # (id, fecha, snapshot), las más recientes al final
+_contador = itertools.count(1)
+_rutas = {}  # endpoint -> {'peticiones', 'omitidas', 'pico_maximo', 'pico_total', 'retenido_total'}
+_activas = 0  # peticiones en curso con el rastreo activo
+_traslapada = False  # otra petición empezó mientras corría la que reinició el pico
+
+_FILTROS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+]
+
+
+def iniciar_rastreo(marcos=None):
+    """Inicia tracemalloc guardando 'marcos' niveles de la pila por asignación."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(marcos or config.MEMORIA_MARCOS)
+
+
+def detener_rastreo():
+    """Detiene tracemalloc y descarta las instantáneas (liberan la memoria que ocupan)."""
+    tracemalloc.stop()
+    with _lock:
+        _instantaneas.clear()
+
+
+def tomar_instantanea():
+    """Guarda una instantánea de las asignaciones actuales. Devuelve su id o None si no hay rastreo."""
+    if not tracemalloc.is_tracing():
+        return None
+    instantanea = tracemalloc.take_snapshot().filter_traces(_FILTROS)
+    with _lock:
+        instantanea_id = next(_contador)
+        _instantaneas.append((instantanea_id, datetime.utcnow(), instantanea))
+        del _instantaneas[:-config.MEMORIA_MAX_INSTANTANEAS]
+    return instantanea_id
+
+
+def listar_instantaneas():
+    with _lock:
+        return [
+            {'id': instantanea_id, 'fecha': fecha, 'total': sum(stat.size for stat in instantanea.statistics('filename'))}
+            for instantanea_id, fecha, instantanea in _instantaneas
+        ]
+
+
+def comparar_instantaneas(desde=None, hasta=None, agrupar='lineno', limite=None):
+    """
+    Diferencias de memoria entre dos instantáneas (por defecto, las dos últimas), de mayor a menor
+    crecimiento. agrupar es 'lineno', 'filename' o 'traceback'. None si no hay dos instantáneas.
+    """
+    with _lock:
+        por_id = {instantanea_id: instantanea for instantanea_id, _, instantanea in _instantaneas}
+        ids = [instantanea_id for instantanea_id, _, _ in _instantaneas]
+    if desde is None or hasta is None:
+        if len(ids) < 2:
+            return None
+        desde, hasta = ids[-2], ids[-1]
+    if desde not in por_id or hasta not in por_id:
+        return None
+
+    diferencias = por_id[hasta].compare_to(por_id[desde], agrupar)
+    return {
+        'desde': desde,
+        'hasta': hasta,
+        'agrupar': agrupar,
+        'diferencias': [
+            {
+                'ubicacion': _ubicacion(stat.traceback, agrupar),
+                'diferencia': stat.size_diff,
+                'tamano': stat.size,
+                'bloques': stat.count,
+                'bloques_diferencia': stat.count_diff
+            }
+            for stat in diferencias[:limite or config.MEMORIA_LIMITE_DIFERENCIAS]
+        ]
+    }
+
+
+def _ubicacion(traceback, agrupar):
+    if agrupar == 'filename':
+        return traceback[0].filename
+    if agrupar == 'traceback':
+        return '\n'.join(f'{marco.filename}:{marco.lineno}' for marco in reversed(traceback))
+    return f'{traceback[0].filename}:{traceback[0].lineno}'
+
+
+# --- Picos por ruta ---
+def medir_inicio_peticion():
+    """before_request: si no hay otra petición en curso, reinicia el pico de tracemalloc."""
+    global _activas, _traslapada
+    if not tracemalloc.is_tracing():
+        return
+    with _lock:
+        if _activas:
+            _traslapada = True
+        else:
+            _traslapada = False
+            tracemalloc.reset_peak()
+            g.memoria_inicio = tracemalloc.get_traced_memory()[0]
+        _activas += 1
+    g.memoria_activa = True
+
+
+def medir_fin_peticion(respuesta):
+    """after_request: acumula el pico y la memoria retenida de la petición en su ruta."""
+    if not g.get('memoria_activa') or not tracemalloc.is_tracing():
+        return respuesta
+
+    inicio = g.pop('memoria_inicio', None)
+    actual, pico = tracemalloc.get_traced_memory()
+    endpoint = request.endpoint or request.path
+    with _lock:
+        ruta = _rutas.setdefault(
+            endpoint, {'peticiones': 0, 'omitidas': 0, 'pico_maximo': 0, 'pico_total': 0, 'retenido_total': 0}
+        )
+        if inicio is None or _traslapada:
+            ruta['omitidas'] += 1
+            return respuesta
+        ruta['peticiones'] += 1
+        ruta['pico_maximo'] = max(ruta['pico_maximo'], pico - inicio)
+        ruta['pico_total'] += max(pico - inicio, 0)
+        ruta['retenido_total'] += actual - inicio
+    return respuesta
+
+
+def terminar_medicion(error=None):
+    """teardown_request: la petición deja de contar como en curso (también si terminó con error)."""
+    global _activas
+    if g.pop('memoria_activa', None):
+        with _lock:
+            _activas -= 1
+
+
+def picos_por_ruta():
+    """Rutas ordenadas por su pico máximo, con el pico y la memoria retenida promedio."""
+    with _lock:
+        rutas = [
+            {
+                'endpoint': endpoint,
+                'peticiones': datos['peticiones'],
+                'omitidas': datos['omitidas'],
+                'pico_maximo': datos['pico_maximo'],
+                'pico_promedio': datos['pico_total'] // max(datos['peticiones'], 1),
+                'retenido_promedio': datos['retenido_total'] // max(datos['peticiones'], 1)
+            }
+            for endpoint, datos in _rutas.items()
+        ]
+    return sorted(rutas, key=lambda ruta: ruta['pico_maximo'], reverse=True)
+
+
+def reiniciar_picos():
+    with _lock:
+        _rutas.clear()
+
+
+# --- Resumen del proceso ---
+def _rss():
+    """(RSS actual, RSS máximo) en bytes; None donde el sistema no lo expone."""
+    actual = maximo = None
+    try:
+        with open('/proc/self/statm') as archivo:
+            actual = int(archivo.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KB en Linux
+    except (ImportError, AttributeError):
+        pass
+    return actual, maximo
+
+
+def resumen_memoria(caches):
+    """Estado del proceso: RSS, tracemalloc, tamaños de las cachés dadas ({nombre: entradas})."""
+    rss, rss_maximo = _rss()
+    rastreada, pico = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (None, None)
+    return {
+        'pid': os.getpid(),
+        'rss': rss,
+        'rss_maximo': rss_maximo,
+        'rastreo_activo': tracemalloc.is_tracing(),
+        'marcos': tracemalloc.get_traceback_limit() if tracemalloc.is_tracing() else None,
+        'memoria_rastreada': rastreada,
+        'pico_rastreado': pico,
+        'sobrecarga_rastreo': tracemalloc.get_tracemalloc_memory() if tracemalloc.is_tracing() else None,
+        'caches': caches,
+    }
@@ -0,0 +1,211 @@
+# ecommerce-flask/perfilador.py
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import stat
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import g, request, session
+
+import config
+
+# --- Perfilado bajo demanda ---
+# Un admin agrega ?_perfil=1 (o el encabezado X-Perfil: 1) a cualquier URL y esa petición se
+# ejecuta completa bajo cProfile. El perfil se guarda en PERFILES_DIRECTORIO como archivo pstats
+# (se abre con snakeviz, gprof2dot o pstats) junto con un resumen en JSON, y la respuesta trae
+# los encabezados X-Perfil-Id y Server-Timing con el desglose.
+# Sin el indicador, el costo por petición es revisar un parámetro y un encabezado.
+# Las respuestas en streaming (exportaciones) solo se perfilan hasta que empieza el envío.
+
+# Cada categoría se reconoce por (archivo, función). Se suma su tiempo propio más el de las
+# funciones nativas que llama (socket, escape de HTML, ...), así las categorías no se traslapan;
+# el tiempo de código de la app llamado desde una plantilla no cuenta como Jinja.
+CATEGORIAS = {
+    'mongo': lambda archivo, funcion: '/pymongo/' in archivo or '/bson/' in archivo,
+    'mapear_id': lambda archivo, funcion: funcion == '_mapear_id' and archivo.endswith('database.py'),
+    'jinja': lambda archivo, funcion: '/jinja2/' in archivo or archivo.endswith('.html'),
+}
+
+_ID_VALIDO = re.compile(r'^[0-9]{14}-[0-9a-f]{8}$')
+
+# cProfile no admite dos perfiles activos a la vez en el mismo proceso
+_lock = threading.Lock()
+
+
+def iniciar_perfil():
+    """before_request: empieza a perfilar si un admin lo pidió."""
+    if request.args.get('_perfil') != '1' and request.headers.get('X-Perfil') != '1':
+        return
+    if session.get('rol') != 'admin' or not _lock.acquire(blocking=False):
+        return
+
+    perfil = cProfile.Profile()
+    g.perfil = (perfil, time.perf_counter())
+    perfil.enable()
+
+
+def terminar_perfil(respuesta):
+    """after_request: detiene el perfil, lo guarda y agrega los encabezados a la respuesta."""
+    datos = _detener()
+    if datos is None:
+        return respuesta
+
+    perfil, total = datos
+    try:
+        resumen = _guardar(perfil, total, respuesta.status_code)
+    except Exception as e:
+        print(f"Error guardando el perfil de {request.path}: {e}")
+        return respuesta
+
+    respuesta.headers['X-Perfil-Id'] = resumen['id']
+    respuesta.headers['Server-Timing'] = ', '.join(
+        [f'total;dur={total * 1000:.1f}'] +
+        [f'{nombre};dur={valores["segundos"] * 1000:.1f}' for nombre, valores in resumen['desglose'].items()]
+    )
+    return respuesta
+
+
+def descartar_perfil(error=None):
+    """teardown_request: libera el perfil si la petición terminó con una excepción."""
+    _detener()
+
+
+def _detener():
+    datos = g.pop('perfil', None)
+    if datos is None:
+        return None
+    perfil, inicio = datos
+    perfil.disable()
+    _lock.release()
+    return perfil, time.perf_counter() - inicio
+
+
+def _categoria(archivo, funcion):
+    archivo = archivo.replace('\\', '/')
+    for nombre, pertenece in CATEGORIAS.items():
+        if pertenece(archivo, funcion):
+            return nombre
+    return None
+
+
+def _desglose(estadisticas):
+    """
+    Segundos y llamadas por categoría a partir de las estadísticas de cProfile. Las llamadas son
+    las que entran a la categoría desde otro código (por ejemplo, consultas o plantillas).
+    """
+    desglose = {nombre: {'segundos': 0.0, 'llamadas': 0} for nombre in CATEGORIAS}
+    for (archivo, _, funcion), (_, _, propio, _, llamadores) in estadisticas.stats.items():
+        if archivo == '~':
+            # Función nativa: su tiempo se reparte según quién la llamó
+            for (archivo_llamador, _, funcion_llamador), (_, _, propio_llamador, _) in llamadores.items():
+                nombre = _categoria(archivo_llamador, funcion_llamador)
+                if nombre:
+                    desglose[nombre]['segundos'] += propio_llamador
+            continue
+
+        nombre = _categoria(archivo, funcion)
+        if nombre is None:
+            continue
+        desglose[nombre]['segundos'] += propio
+        for (archivo_llamador, _, funcion_llamador), (llamadas, _, _, _) in llamadores.items():
+            if _categoria(archivo_llamador, funcion_llamador) != nombre:
+                desglose[nombre]['llamadas'] += llamadas
+    return desglose
+
+
+def directorio_privado(ruta):
+    """
+    Crea ruta con permisos 0700 si no existe y la devuelve si es un directorio del usuario del
+    proceso (sin permisos para otros), o None si no lo es: alguien más podría dejar ahí archivos
+    que pstats cargaría con marshal.
+    """
+    # Los valores por defecto cuelgan de DIRECTORIO_PRIVADO: también se verifica ese
+    if os.path.dirname(ruta) == config.DIRECTORIO_PRIVADO and directorio_privado(config.DIRECTORIO_PRIVADO) is None:
+        return None
+    try:
+        os.makedirs(ruta, mode=0o700, exist_ok=True)
+        if hasattr(os, 'getuid'):
+            info = os.lstat(ruta)
+            if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+                print(f"{ruta} no es un directorio del usuario del proceso: no se usa")
+                return None
+            if info.st_mode & 0o077:
+                os.chmod(ruta, 0o700)
+        return ruta
+    except OSError as e:
+        print(f"No se pudo preparar el directorio {ruta}: {e}")
+        return None
+
+
+def _guardar(perfil, total, estado):
+    if directorio_privado(config.PERFILES_DIRECTORIO) is None:
+        raise RuntimeError(f'{config.PERFILES_DIRECTORIO} no es un directorio privado')
+    perfil_id = f"{datetime.utcnow():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+    perfil.dump_stats(os.path.join(config.PERFILES_DIRECTORIO, f'{perfil_id}.prof'))
+
+    resumen = {
+        'id': perfil_id,
+        'fecha': datetime.utcnow().isoformat(timespec='seconds'),
+        'metodo': request.method,
+        'ruta': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'estado': estado,
+        'total': total,
+        'desglose': _desglose(pstats.Stats(perfil))
+    }
+    with open(os.path.join(config.PERFILES_DIRECTORIO, f'{perfil_id}.json'), 'w', encoding='utf-8') as archivo:
+        json.dump(resumen, archivo)
+
+    _podar()
+    return resumen
+
+
+def _podar():
+    """Conserva solo los PERFILES_MAXIMOS más recientes."""
+    ids = sorted(nombre[:-5] for nombre in os.listdir(config.PERFILES_DIRECTORIO) if nombre.endswith('.json'))
+    for perfil_id in ids[:-config.PERFILES_MAXIMOS]:
+        for extension in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(config.PERFILES_DIRECTORIO, perfil_id + extension))
+            except OSError:
+                pass
+
+
+def listar_perfiles():
+    """Resúmenes de los perfiles guardados, del más reciente al más antiguo."""
+    if directorio_privado(config.PERFILES_DIRECTORIO) is None:
+        return []
+    perfiles = []
+    for nombre in sorted(os.listdir(config.PERFILES_DIRECTORIO), reverse=True):
+        if nombre.endswith('.json'):
+            try:
+                with open(os.path.join(config.PERFILES_DIRECTORIO, nombre), encoding='utf-8') as archivo:
+                    perfiles.append(json.load(archivo))
+            except (OSError, ValueError):
+                continue
+    return perfiles
+
+
+def ruta_perfil(perfil_id):
+    """Ruta del archivo pstats, o None si el id no es válido o ya no existe."""
+    if not _ID_VALIDO.match(perfil_id) or directorio_privado(config.PERFILES_DIRECTORIO) is None:
+        return None
+    ruta = os.path.join(config.PERFILES_DIRECTORIO, f'{perfil_id}.prof')
+    return ruta if os.path.exists(ruta) else None
+
+
+def reporte_perfil(perfil_id, orden='cumulative', limite=60):
+    """Reporte de texto de pstats (las funciones más costosas), o None si el perfil no existe."""
+    ruta = ruta_perfil(perfil_id)
+    if ruta is None:
+        return None
+    salida = io.StringIO()
+    pstats.Stats(ruta, stream=salida).strip_dirs().sort_stats(orden).print_stats(limite)
+    return salida.getvalue()
@@ -0,0 +1,45 @@
+# ecommerce-flask/plantillas.py
+
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+import config
+
+# --- Plantillas ---
+# Jinja compila cada plantilla a código Python la primera vez que se usa, en cada proceso. Con
+# la caché de bytecode el resultado se guarda en disco y los demás workers
+# (y los reinicios) solo lo cargan; `flask precompilar-plantillas` la llena de antemano, por
+# ejemplo al construir la imagen. Cada entrada lleva el checksum de la fuente, así que una
+# plantilla modificada se vuelve a compilar sola y las entradas viejas no se usan.
+# Jinja lee las entradas con marshal, así que el directorio no puede ser uno compartido: por
+# defecto se usa el de Jinja (por usuario, 0700 y con el dueño verificado) y uno configurado
+# se crea solo para el usuario del proceso.
+# Al iniciar, el proceso carga todas las plantillas para que la primera petición no pague la
+# compilación.
+
+
+def configurar_plantillas(app):
+    """Caché de bytecode y recarga automática. Debe llamarse antes de usar app.jinja_env."""
+    if config.PLANTILLAS_CACHE_BYTECODE:
+        if config.PLANTILLAS_CACHE_DIRECTORIO:
+            os.makedirs(config.PLANTILLAS_CACHE_DIRECTORIO, mode=0o700, exist_ok=True)
+        app.jinja_options = {
+            **app.jinja_options,
+            'bytecode_cache': FileSystemBytecodeCache(config.PLANTILLAS_CACHE_DIRECTORIO)
+        }
+    # None: recarga solo en modo debug (el valor por defecto de Flask)
+    app.config['TEMPLATES_AUTO_RELOAD'] = config.PLANTILLAS_AUTO_RECARGA
+
+
+def cargar_plantillas(app):
+    """Compila (o lee de la caché de bytecode) todas las plantillas. Devuelve (cantidad, segundos)."""
+    inicio = time.perf_counter()
+    nombres = [nombre for nombre in app.jinja_env.list_templates() if nombre.endswith('.html')]
+    for nombre in nombres:
+        try:
+            app.jinja_env.get_template(nombre)
+        except Exception as e:
+            print(f"Error cargando la plantilla {nombre}: {e}")
+    return len(nombres), time.perf_counter() - inicio
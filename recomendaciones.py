@@ -0,0 +1,212 @@
+# ecommerce-flask/recomendaciones.py
+
+import heapq
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import combinations
+
+from bson import ObjectId
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+import config
+from cache import obtener_o_calcular, publicar_cambio
+from database import db, ESTADOS_CON_VENTA, politica_lectura, _mapear_id
+
+# --- Recomendaciones "comprados juntos" ---
+# Tarea fuera de línea (flask recalcular-recomendaciones, por ejemplo desde cron) que mantiene una
+# matriz de coocurrencia dispersa guardada por filas:
+#   coocurrencias:   {_id: producto_id, conteos: {otro_producto_id: veces}, pendiente: True}
+#   recomendaciones: {_id: producto_id, vecinos: [{producto_id, conteo}]}  (los TOP_K mayores)
+# La matriz no sigue un punto de control sobre _id: cada vez que un pedido entra o sale de
+# ESTADOS_CON_VENTA (creado, cancelado, reactivado, eliminado) database.py deja un registro en
+# coocurrencias_cambios con sus productos y el signo, y cada ejecución suma o resta esos registros.
+# Así las cancelaciones posteriores se descuentan y no importa en qué orden se generaron los _id.
+# La primera ejecución (o --reconstruir) recorre el historial completo en su lugar.
+# Las filas marcadas como 'pendiente' recalculan su top-k al final, así que una ejecución
+# interrumpida se completa en la siguiente. Las vistas solo leen 'recomendaciones' por _id.
+# Los ids se guardan como texto para que los pedidos con ids de distinto tipo coincidan.
+
+ESTADO_ID = 'comprados_juntos'
+
+
+def _tomar_bloqueo():
+    """Evita dos ejecuciones simultáneas (contarían los mismos pedidos dos veces). None si ya hay una."""
+    ahora = datetime.utcnow()
+    try:
+        return db.recomendaciones_estado.find_one_and_update(
+            {'_id': ESTADO_ID, 'bloqueado_hasta': {'$not': {'$gt': ahora}}},
+            {'$set': {'bloqueado_hasta': ahora + timedelta(seconds=config.RECOMENDACIONES_BLOQUEO_SEGUNDOS)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        return None
+
+
+def _liberar_bloqueo():
+    db.recomendaciones_estado.update_one({'_id': ESTADO_ID}, {'$unset': {'bloqueado_hasta': ''}})
+
+
+def _ids_del_pedido(pedido):
+    return sorted({str(linea.get('producto_id')) for linea in pedido.get('productos', []) if linea.get('producto_id')})
+
+
+def _sumar_lote(cambios):
+    """Suma (signo=1) o resta (signo=-1) a la matriz los pares de productos de cada (ids, signo)."""
+    conteos = defaultdict(lambda: defaultdict(int))
+    for ids, signo in cambios:
+        # Un pedido con n productos aporta n² pares; los muy grandes se recortan
+        for a, b in combinations(ids[:config.RECOMENDACIONES_MAX_PRODUCTOS_PEDIDO], 2):
+            conteos[a][b] += signo
+            conteos[b][a] += signo
+
+    operaciones = [
+        UpdateOne(
+            {'_id': producto_id},
+            {'$inc': {f'conteos.{otro}': veces for otro, veces in fila.items() if veces}, '$set': {'pendiente': True}},
+            upsert=True
+        )
+        for producto_id, fila in conteos.items() if any(fila.values())
+    ]
+    if operaciones:
+        db.coocurrencias.bulk_write(operaciones, ordered=False)
+
+
+def _reconstruir(tamano_lote):
+    """Borra la matriz y la arma de nuevo con todos los pedidos con venta. Devuelve cuántos sumó."""
+    # Los registros anteriores ya quedan incluidos en el recorrido; los que lleguen mientras corre
+    # pueden contarse dos veces, así que conviene ejecutarlo con poco tráfico
+    db.coocurrencias_cambios.delete_many({})
+    db.coocurrencias.delete_many({})
+    db.recomendaciones.delete_many({})
+
+    cursor = db.pedidos.find(
+        {'estado': {'$in': list(ESTADOS_CON_VENTA)}}, {'productos.producto_id': 1}
+    ).sort('_id', 1).batch_size(tamano_lote)
+    pedidos = 0
+    lote = []
+    for pedido in cursor:
+        lote.append((_ids_del_pedido(pedido), 1))
+        if len(lote) >= tamano_lote:
+            _sumar_lote(lote)
+            pedidos += len(lote)
+            lote = []
+    if lote:
+        _sumar_lote(lote)
+        pedidos += len(lote)
+
+    db.recomendaciones_estado.update_one(
+        {'_id': ESTADO_ID}, {'$set': {'construida': True}, '$unset': {'ultimo_pedido': ''}}
+    )
+    return pedidos
+
+
+def _aplicar_cambios(tamano_lote):
+    """Suma a la matriz los registros de coocurrencias_cambios y los borra. Devuelve cuántos aplicó."""
+    # Si la ejecución muere entre la suma y el borrado, ese lote se cuenta dos veces (--reconstruir lo corrige)
+    pedidos = 0
+    while True:
+        lote = list(db.coocurrencias_cambios.find().limit(tamano_lote))
+        if not lote:
+            return pedidos
+        _sumar_lote([(registro.get('productos', []), registro.get('signo', 1)) for registro in lote])
+        db.coocurrencias_cambios.delete_many({'_id': {'$in': [registro['_id'] for registro in lote]}})
+        pedidos += len(lote)
+
+
+def _actualizar_vecinos(tamano_lote):
+    """Recalcula el top-k de las filas pendientes. Devuelve cuántos productos se actualizaron."""
+    actualizados = 0
+    while True:
+        filas = list(db.coocurrencias.find({'pendiente': True}).limit(tamano_lote))
+        if not filas:
+            return actualizados
+
+        db.recomendaciones.bulk_write([
+            ReplaceOne(
+                {'_id': fila['_id']},
+                {'vecinos': [
+                    {'producto_id': otro, 'conteo': veces}
+                    for otro, veces in heapq.nlargest(
+                        config.RECOMENDACIONES_TOP_K,
+                        # Las cancelaciones pueden dejar pares en 0
+                        ((otro, veces) for otro, veces in fila.get('conteos', {}).items() if veces > 0),
+                        key=lambda par: (par[1], par[0])
+                    )
+                ]},
+                upsert=True
+            )
+            for fila in filas
+        ], ordered=False)
+        db.coocurrencias.update_many(
+            {'_id': {'$in': [fila['_id'] for fila in filas]}},
+            {'$unset': {'pendiente': ''}}
+        )
+        actualizados += len(filas)
+
+
+def recalcular_comprados_juntos(reconstruir=False, tamano_lote=None):
+    """
+    Aplica a la matriz los pedidos que entraron o salieron de la venta desde la última ejecución
+    y actualiza el top-k de los productos afectados.
+    reconstruir=True (o si la matriz nunca se armó) borra todo y recorre el historial completo.
+    Devuelve {'pedidos', 'productos'} o None si ya hay otra ejecución en curso.
+    """
+    tamano_lote = tamano_lote or config.RECOMENDACIONES_TAMANO_LOTE
+    estado = _tomar_bloqueo()
+    if estado is None:
+        return None
+
+    try:
+        if reconstruir or not estado.get('construida'):
+            pedidos = _reconstruir(tamano_lote)
+        else:
+            pedidos = _aplicar_cambios(tamano_lote)
+
+        productos = _actualizar_vecinos(tamano_lote)
+        if productos:
+            publicar_cambio('recomendaciones:*')
+        return {'pedidos': pedidos, 'productos': productos}
+    finally:
+        _liberar_bloqueo()
+
+
+def _productos_recomendados(ids, limite):
+    """Combina los vecinos de los productos dados (una lectura por _id) y excluye los propios."""
+    puntajes = defaultdict(int)
+    for fila in db.recomendaciones.find({'_id': {'$in': ids}}):
+        for vecino in fila.get('vecinos', []):
+            puntajes[vecino['producto_id']] += vecino['conteo']
+    for producto_id in ids:
+        puntajes.pop(producto_id, None)
+
+    # Holgura por si algunos candidatos ya no existen o están inactivos
+    candidatos = heapq.nlargest(limite * 2, puntajes.items(), key=lambda par: (par[1], par[0]))
+    productos = {
+        str(prod['_id']): prod
+        for prod in db.productos.find(
+            {'_id': {'$in': [ObjectId(i) for i, _ in candidatos if ObjectId.is_valid(i)]}, 'activo': {'$ne': False}},
+            {'nombre': 1, 'precio': 1, 'imagen_url': 1}
+        )
+    }
+    return [_mapear_id(productos[i]) for i, _ in candidatos if i in productos][:limite]
+
+
+@politica_lectura
+def obtener_comprados_juntos(producto_id, limite=None):
+    """Productos que se compran junto con producto_id (para la página del producto)."""
+    limite = limite or config.RECOMENDACIONES_MOSTRAR
+    return obtener_o_calcular(
+        f'recomendaciones:{producto_id}:{limite}',
+        lambda: _productos_recomendados([str(producto_id)], limite)
+    )
+
+
+@politica_lectura
+def obtener_recomendaciones_carrito(producto_ids, limite=None):
+    """Productos que se compran junto con los del carrito, sin repetir los que ya están en él."""
+    ids = [str(producto_id) for producto_id in producto_ids]
+    if not ids:
+        return []
+    return _productos_recomendados(ids, limite or config.RECOMENDACIONES_MOSTRAR)
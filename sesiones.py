@@ -0,0 +1,231 @@
+# ecommerce-flask/sesiones.py
+
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface
+
+import config
+from cache import publicar_cambio, registrar_manejador
+
+# --- Sesiones del lado del servidor ---
+# Las sesiones con usuario autenticado se guardan en la colección 'sesiones' (índice TTL sobre
+# 'expira') con un LRU en memoria al frente; la cookie solo lleva un identificador aleatorio.
+# Las sesiones anónimas (por ejemplo, el carrito de invitado) siguen en la cookie firmada,
+# así que los visitantes no generan escrituras.
+# La sesión guarda el perfil proyectado del usuario (user_id, user_nombre, rol), de modo que
+# los decoradores y las rutas del carrito no consultan 'usuarios'.
+
+PREFIJO_COOKIE = 'srv.'
+
+
+class AlmacenMongo:
+    """Respaldo en MongoDB: un documento por sesión."""
+
+    def __init__(self, coleccion):
+        self.coleccion = coleccion
+
+    def obtener(self, sid):
+        doc = self.coleccion.find_one({'_id': sid, 'expira': {'$gt': datetime.utcnow()}}, {'datos': 1, 'expira': 1})
+        return (doc['datos'], doc['expira']) if doc else None
+
+    def guardar(self, sid, datos, usuario_id, expira):
+        self.coleccion.replace_one(
+            {'_id': sid},
+            {'datos': datos, 'usuario_id': usuario_id, 'expira': expira},
+            upsert=True
+        )
+
+    def eliminar(self, sid):
+        self.coleccion.delete_one({'_id': sid})
+
+    def actualizar_usuario(self, usuario_id, cambios):
+        """Actualiza los datos cacheados en todas las sesiones de un usuario."""
+        self.coleccion.update_many(
+            {'usuario_id': usuario_id},
+            {'$set': {f'datos.{campo}': valor for campo, valor in cambios.items()}}
+        )
+
+    def eliminar_usuario(self, usuario_id):
+        return self.coleccion.delete_many({'usuario_id': usuario_id}).deleted_count
+
+
+class AlmacenLRU:
+    """
+    Caché LRU en memoria delante de otro almacén. Las escrituras pasan al respaldo; las lecturas
+    locales duran como máximo 'segundos', lo que acota cuánto tarda otro proceso en ver un cambio.
+    """
+
+    def __init__(self, respaldo, capacidad, segundos):
+        self.respaldo = respaldo
+        self.capacidad = capacidad
+        self.segundos = segundos
+        self._entradas = OrderedDict()  # sid -> (datos, expira, usuario_id, vigente_hasta)
+        self._lock = threading.Lock()
+
+    def _recordar(self, sid, datos, expira, usuario_id):
+        with self._lock:
+            self._entradas[sid] = (datos, expira, usuario_id, datetime.utcnow() + timedelta(seconds=self.segundos))
+            self._entradas.move_to_end(sid)
+            while len(self._entradas) > self.capacidad:
+                self._entradas.popitem(last=False)
+
+    def obtener(self, sid):
+        ahora = datetime.utcnow()
+        with self._lock:
+            entrada = self._entradas.get(sid)
+            if entrada and entrada[3] > ahora and entrada[1] > ahora:
+                self._entradas.move_to_end(sid)
+                return dict(entrada[0]), entrada[1]
+
+        resultado = self.respaldo.obtener(sid)
+        if resultado:
+            datos, expira = resultado
+            self._recordar(sid, dict(datos), expira, datos.get('user_id'))
+        else:
+            self._olvidar(sid)
+        return resultado
+
+    def guardar(self, sid, datos, usuario_id, expira):
+        self.respaldo.guardar(sid, datos, usuario_id, expira)
+        self._recordar(sid, dict(datos), expira, datos.get('user_id'))
+
+    def _olvidar(self, sid):
+        with self._lock:
+            self._entradas.pop(sid, None)
+
+    def eliminar(self, sid):
+        self._olvidar(sid)
+        self.respaldo.eliminar(sid)
+
+    def olvidar_usuario(self, usuario_id):
+        """Solo desaloja las entradas locales del usuario (el respaldo no cambia)."""
+        with self._lock:
+            for sid in [sid for sid, entrada in self._entradas.items() if entrada[2] == usuario_id]:
+                del self._entradas[sid]
+
+    def actualizar_usuario(self, usuario_id, cambios):
+        self.olvidar_usuario(usuario_id)
+        self.respaldo.actualizar_usuario(usuario_id, cambios)
+
+    def eliminar_usuario(self, usuario_id):
+        self.olvidar_usuario(usuario_id)
+        return self.respaldo.eliminar_usuario(usuario_id)
+
+    def tamano(self):
+        return len(self._entradas)
+
+
+class SesionServidor(SecureCookieSession):
+    """Sesión con identificador. sid=None mientras los datos viven en la cookie firmada."""
+
+    def __init__(self, datos=None, sid=None, expira=None):
+        super().__init__(datos)
+        self.sid = sid
+        self.expira = expira
+        self.regenerar = False
+
+
+class InterfazSesionServidor(SecureCookieSessionInterface):
+    session_class = SesionServidor
+
+    def __init__(self, almacen, duracion):
+        self.almacen = almacen
+        self.duracion = duracion
+
+    def open_session(self, app, request):
+        valor = request.cookies.get(self.get_cookie_name(app))
+        if valor and valor.startswith(PREFIJO_COOKIE):
+            sid = valor[len(PREFIJO_COOKIE):]
+            resultado = self.almacen.obtener(sid)
+            if resultado:
+                datos, expira = resultado
+                return SesionServidor(datos, sid, expira)
+            # Sesión vencida o revocada: se empieza una nueva
+            sesion = SesionServidor()
+            sesion.modified = True
+            return sesion
+
+        sesion_cookie = super().open_session(app, request)
+        if sesion_cookie is None:
+            return None
+        return SesionServidor(dict(sesion_cookie))
+
+    def save_session(self, app, session, response):
+        usuario_id = session.get('user_id')
+        if not usuario_id:
+            if session.sid:
+                # Cierre de sesión: se borra del servidor y se vuelve a la cookie firmada
+                self.almacen.eliminar(session.sid)
+                session.sid = None
+                session.modified = True
+            return super().save_session(app, session, response)
+
+        ahora = datetime.utcnow()
+        sid_anterior = None
+        if session.sid is None or session.regenerar:
+            sid_anterior = session.sid
+            session.sid = secrets.token_urlsafe(32)
+            session.modified = True
+
+        # La vigencia solo se renueva cuando ya pasó la mitad, para no escribir en cada petición
+        renovar = session.expira is None or session.expira - ahora < self.duracion / 2
+        if not (session.modified or renovar):
+            return
+
+        session.expira = ahora + self.duracion
+        self.almacen.guardar(session.sid, dict(session), usuario_id, session.expira)
+        if sid_anterior:
+            self.almacen.eliminar(sid_anterior)
+
+        response.set_cookie(
+            self.get_cookie_name(app),
+            PREFIJO_COOKIE + session.sid,
+            expires=session.expira,
+            httponly=self.get_cookie_httponly(app),
+            domain=self.get_cookie_domain(app),
+            path=self.get_cookie_path(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+
+def crear_interfaz_sesiones(coleccion):
+    """Interfaz según config.SESIONES_ALMACEN: 'servidor' (LRU + MongoDB) o 'cookie' (Flask por defecto)."""
+    if config.SESIONES_ALMACEN != 'servidor':
+        return SecureCookieSessionInterface()
+    almacen = AlmacenLRU(AlmacenMongo(coleccion), config.SESIONES_LRU_CAPACIDAD, config.SESIONES_LRU_SEGUNDOS)
+    # Los demás procesos desalojan su copia local al recibir el cambio por el bus de caché
+    registrar_manejador('sesion_usuario:', almacen.olvidar_usuario)
+    return InterfazSesionServidor(almacen, timedelta(days=config.SESIONES_DIAS))
+
+
+def regenerar_sesion(session):
+    """Cambia el identificador de la sesión (al iniciar sesión, contra fijación de sesión)."""
+    if isinstance(session, SesionServidor):
+        session.regenerar = True
+
+
+def actualizar_sesiones_usuario(app, usuario_id, cambios):
+    """Refresca el perfil cacheado en las sesiones de un usuario (por ejemplo, al editarlo)."""
+    if isinstance(app.session_interface, InterfazSesionServidor):
+        app.session_interface.almacen.actualizar_usuario(str(usuario_id), cambios)
+        publicar_cambio(f'sesion_usuario:{usuario_id}')
+
+
+def revocar_sesiones_usuario(app, usuario_id):
+    """Cierra todas las sesiones de un usuario. Devuelve cuántas se cerraron."""
+    if isinstance(app.session_interface, InterfazSesionServidor):
+        cerradas = app.session_interface.almacen.eliminar_usuario(str(usuario_id))
+        publicar_cambio(f'sesion_usuario:{usuario_id}')
+        return cerradas
+    return 0
+
+
+def tamano_cache_sesiones(app):
+    """Sesiones guardadas en el LRU local de este proceso (0 con sesiones en cookie)."""
+    if isinstance(app.session_interface, InterfazSesionServidor):
+        return app.session_interface.almacen.tamano()
+    return 0
@@ -0,0 +1,40 @@
+# ecommerce-flask/tareas.py
+
+import threading
+import time
+
+# --- Tareas periódicas en segundo plano ---
+# Cada tarea es (nombre, intervalo en segundos, función sin argumentos).
+_tareas = []
+_hilo = None
+
+
+def registrar_tarea(nombre, intervalo, funcion):
+    """Registra una función para ejecutarse periódicamente."""
+    _tareas.append((nombre, intervalo, funcion))
+
+
+def _ejecutar_tareas():
+    proxima_ejecucion = {nombre: time.monotonic() + intervalo for nombre, intervalo, _ in _tareas}
+    while True:
+        ahora = time.monotonic()
+        for nombre, intervalo, funcion in _tareas:
+            if ahora < proxima_ejecucion.get(nombre, ahora):
+                continue
+            try:
+                resultado = funcion()
+                if resultado:
+                    print(f"Tarea {nombre}: {resultado}")
+            except Exception as e:
+                print(f"Error en la tarea {nombre}: {e}")
+            proxima_ejecucion[nombre] = time.monotonic() + intervalo
+        time.sleep(1)
+
+
+def iniciar_tareas_periodicas():
+    """Inicia (una sola vez por proceso) el hilo que ejecuta las tareas registradas."""
+    global _hilo
+    if _hilo is not None or not _tareas:
+        return
+    _hilo = threading.Thread(target=_ejecutar_tareas, name='tareas-periodicas', daemon=True)
+    _hilo.start()
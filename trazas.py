@@ -0,0 +1,382 @@
+# ecommerce-flask/trazas.py
+
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import before_render_template, g, request, template_rendered
+from pymongo import monitoring
+
+import config
+from perfilador import directorio_privado
+
+# --- Trazas ---
+# Cada petición muestreada genera una traza con un span por la petición, uno por cada función
+# pública de database.py (con los documentos que devolvió), uno por cada comando enviado a
+# MongoDB (colección, etapas del pipeline y documentos recibidos) y uno por cada plantilla.
+# Los spans se codifican como OTLP/JSON y un hilo por proceso los envía en lotes:
+#   TRAZAS_EXPORTADOR=archivo  una línea por lote en TRAZAS_ARCHIVO (la lee el receptor
+#                              otlpjsonfile del OpenTelemetry Collector)
+#   TRAZAS_EXPORTADOR=otlp     POST a un collector local (TRAZAS_OTLP_URL, OTLP/HTTP)
+# Se muestrea por petición (TRAZAS_MUESTREO); la decisión de un encabezado traceparent entrante
+# solo se respeta con TRAZAS_RESPETAR_TRACEPARENT=1, aunque su id de traza se usa siempre que la
+# petición se muestree. Sin traza activa (petición no muestreada, tareas, CLI) el costo por
+# llamada es leer una ContextVar. Si la cola de envío se llena, los spans se descartan.
+
+# Span en curso; _NO_MUESTREADA marca una petición que decidió no trazarse
+_span_actual = ContextVar('span_actual', default=None)
+_NO_MUESTREADA = object()
+
+SERVIDOR, INTERNO, CLIENTE = 2, 1, 3  # SpanKind de OTLP
+
+_cola = None
+_pid_exportador = None
+_lock_exportador = threading.Lock()
+descartados = 0
+
+
+class Span:
+    __slots__ = ('traza_id', 'span_id', 'padre_id', 'nombre', 'tipo', 'inicio', 'fin', 'atributos', 'error')
+
+    def __init__(self, nombre, traza_id, padre_id=None, tipo=INTERNO, atributos=None):
+        self.traza_id = traza_id
+        self.span_id = os.urandom(8).hex()
+        self.padre_id = padre_id
+        self.nombre = nombre
+        self.tipo = tipo
+        self.inicio = time.time_ns()
+        self.fin = None
+        self.atributos = atributos or {}
+        self.error = None
+
+    def terminar(self, error=None):
+        if self.fin is not None:
+            return
+        self.fin = time.time_ns()
+        if error is not None:
+            self.error = f'{type(error).__name__}: {error}'
+        _encolar(self)
+
+    def a_otlp(self):
+        span = {
+            'traceId': self.traza_id,
+            'spanId': self.span_id,
+            'name': self.nombre,
+            'kind': self.tipo,
+            'startTimeUnixNano': str(self.inicio),
+            'endTimeUnixNano': str(self.fin),
+            'attributes': [_atributo_otlp(clave, valor) for clave, valor in self.atributos.items() if valor is not None],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 0}
+        }
+        if self.padre_id:
+            span['parentSpanId'] = self.padre_id
+        return span
+
+
+def _atributo_otlp(clave, valor):
+    if isinstance(valor, bool):
+        return {'key': clave, 'value': {'boolValue': valor}}
+    if isinstance(valor, int):
+        return {'key': clave, 'value': {'intValue': str(valor)}}
+    if isinstance(valor, float):
+        return {'key': clave, 'value': {'doubleValue': valor}}
+    return {'key': clave, 'value': {'stringValue': str(valor)}}
+
+
+def activas():
+    return config.TRAZAS_EXPORTADOR in ('archivo', 'otlp')
+
+
+def span_actual():
+    """Span en curso o None (sin traza o petición no muestreada)."""
+    span = _span_actual.get()
+    return span if isinstance(span, Span) else None
+
+
+def _iniciar_hijo(nombre, tipo=INTERNO, atributos=None):
+    padre = span_actual()
+    if padre is None:
+        return None
+    return Span(nombre, padre.traza_id, padre.span_id, tipo, atributos)
+
+
+@contextmanager
+def span(nombre, **atributos):
+    """Span hijo del actual mientras dura el bloque; no hace nada si no hay traza activa."""
+    hijo = _iniciar_hijo(nombre, atributos=atributos)
+    if hijo is None:
+        yield None
+        return
+    token = _span_actual.set(hijo)
+    try:
+        yield hijo
+    except BaseException as e:
+        hijo.terminar(e)
+        raise
+    finally:
+        _span_actual.reset(token)
+        hijo.terminar()
+
+
+# --- Funciones de database.py ---
+def _documentos_devueltos(resultado):
+    if resultado is None:
+        return 0
+    if isinstance(resultado, dict):
+        return 1
+    if isinstance(resultado, (list, tuple)):
+        return len(resultado)
+    return None
+
+
+def trazar(funcion):
+    """Decorador: un span por llamada con la función y los documentos que devolvió."""
+    nombre = f'{funcion.__module__}.{funcion.__name__}'
+
+    @wraps(funcion)
+    def envoltura(*args, **kwargs):
+        if span_actual() is None:
+            return funcion(*args, **kwargs)
+        with span(nombre, **{'code.namespace': funcion.__module__, 'code.function': funcion.__name__}) as actual:
+            resultado = funcion(*args, **kwargs)
+            actual.atributos['db.documentos_devueltos'] = _documentos_devueltos(resultado)
+            return resultado
+    return envoltura
+
+
+# --- Comandos de MongoDB ---
+_COMANDOS_SIN_COLECCION = {'getMore', 'killCursors', 'endSessions', 'hello', 'ismaster', 'ping'}
+
+
+class MonitorTrazas(monitoring.CommandListener):
+    """
+    Un span por comando enviado a MongoDB, hijo de la función de database.py que lo envió.
+    pymongo publica los eventos en el mismo hilo (y contexto) que ejecuta la operación.
+    """
+
+    def __init__(self):
+        self._pendientes = {}
+
+    def started(self, event):
+        comando = event.command
+        atributos = {
+            'db.system': 'mongodb',
+            'db.namespace': event.database_name,
+            'db.operation.name': event.command_name,
+        }
+        if event.command_name == 'getMore':
+            atributos['db.collection.name'] = comando.get('collection')
+        elif event.command_name not in _COMANDOS_SIN_COLECCION:
+            atributos['db.collection.name'] = comando.get(event.command_name)
+        if 'pipeline' in comando:
+            atributos['db.mongodb.etapas_pipeline'] = len(comando['pipeline'])
+        hijo = _iniciar_hijo(f'mongo.{event.command_name}', CLIENTE, atributos)
+        if hijo is not None:
+            self._pendientes[(event.request_id, event.connection_id)] = hijo
+
+    def succeeded(self, event):
+        hijo = self._pendientes.pop((event.request_id, event.connection_id), None)
+        if hijo is None:
+            return
+        respuesta = event.reply
+        cursor = respuesta.get('cursor')
+        if cursor:
+            hijo.atributos['db.response.returned_rows'] = len(cursor.get('firstBatch', cursor.get('nextBatch', ())))
+        elif 'n' in respuesta:
+            hijo.atributos['db.mongodb.afectados'] = respuesta['n']
+        hijo.terminar()
+
+    def failed(self, event):
+        hijo = self._pendientes.pop((event.request_id, event.connection_id), None)
+        if hijo is not None:
+            hijo.error = str(event.failure.get('errmsg', event.failure))
+            hijo.terminar()
+
+
+def oyentes_mongo():
+    """Oyentes de comandos para el MongoClient de database.py."""
+    return [MonitorTrazas()] if activas() else []
+
+
+# --- Peticiones y plantillas ---
+def _leer_traceparent(valor):
+    """(traza_id, padre_id, muestreada) de un encabezado W3C traceparent, o None si no es válido."""
+    partes = (valor or '').strip().split('-')
+    if len(partes) != 4 or len(partes[1]) != 32 or len(partes[2]) != 16 or len(partes[3]) != 2:
+        return None
+    try:
+        muestreada = int(partes[3], 16) & 1 == 1
+        int(partes[1], 16), int(partes[2], 16)
+    except ValueError:
+        return None
+    if partes[1] == '0' * 32 or partes[2] == '0' * 16:
+        return None
+    return partes[1], partes[2], muestreada
+
+
+def iniciar_traza_peticion():
+    """before_request: abre el span de la petición si se muestrea."""
+    entrante = _leer_traceparent(request.headers.get('traceparent'))
+    traza_id, padre_id, muestreada = entrante or (None, None, None)
+    if not entrante or not config.TRAZAS_RESPETAR_TRACEPARENT:
+        # Un cliente no puede forzar el trazado: la tasa local se aplica igual
+        muestreada = random.random() < config.TRAZAS_MUESTREO
+
+    if not muestreada:
+        g.traza = (None, _span_actual.set(_NO_MUESTREADA))
+        return
+
+    ruta = request.url_rule.rule if request.url_rule else request.path
+    raiz = Span(f'{request.method} {ruta}', traza_id or os.urandom(16).hex(), padre_id, SERVIDOR, {
+        'http.request.method': request.method,
+        'http.route': ruta,
+        'url.path': request.path,
+        'flask.endpoint': request.endpoint,
+    })
+    g.traza = (raiz, _span_actual.set(raiz))
+
+
+def registrar_estado_peticion(respuesta):
+    """after_request: agrega el código de estado al span de la petición."""
+    raiz = g.get('traza', (None, None))[0]
+    if raiz is not None:
+        raiz.atributos['http.response.status_code'] = respuesta.status_code
+        if respuesta.status_code >= 500:
+            raiz.error = f'HTTP {respuesta.status_code}'
+    return respuesta
+
+
+def terminar_traza_peticion(error=None):
+    """teardown_request: cierra el span de la petición (con el error, si lo hubo)."""
+    datos = g.pop('traza', None)
+    if datos is None:
+        return
+    raiz, token = datos
+    # Plantillas que no terminaron de renderizarse por una excepción
+    for hijo, _ in reversed(g.pop('trazas_plantillas', [])):
+        hijo.terminar(error)
+    try:
+        _span_actual.reset(token)
+    except ValueError:
+        # Respuestas en streaming: el teardown corre en otro contexto
+        _span_actual.set(None)
+    if raiz is not None:
+        raiz.terminar(error)
+
+
+def _antes_de_plantilla(sender, template, context, **extra):
+    hijo = _iniciar_hijo(f'render {template.name}', atributos={'jinja.plantilla': template.name})
+    if hijo is not None:
+        g.setdefault('trazas_plantillas', []).append((hijo, _span_actual.set(hijo)))
+
+
+def _plantilla_renderizada(sender, template, context, **extra):
+    pila = g.get('trazas_plantillas')
+    if pila:
+        hijo, token = pila.pop()
+        _span_actual.reset(token)
+        hijo.terminar()
+
+
+def instalar(app):
+    """Registra los hooks de la petición y las señales de plantillas en la app."""
+    app.before_request(iniciar_traza_peticion)
+    app.after_request(registrar_estado_peticion)
+    app.teardown_request(terminar_traza_peticion)
+    before_render_template.connect(_antes_de_plantilla, app)
+    template_rendered.connect(_plantilla_renderizada, app)
+
+
+# --- Exportación ---
+def _encolar(span):
+    global _cola, _pid_exportador, descartados
+    if _pid_exportador != os.getpid():
+        # Primer span del proceso (o de un worker recién creado con fork): arranca su hilo
+        with _lock_exportador:
+            if _pid_exportador != os.getpid():
+                _cola = queue.Queue(maxsize=config.TRAZAS_COLA_MAXIMA)
+                threading.Thread(target=_enviar_lotes, args=(_cola,), name='exportador-trazas', daemon=True).start()
+                _pid_exportador = os.getpid()
+    try:
+        _cola.put_nowait(span)
+    except queue.Full:
+        descartados += 1
+
+
+def _enviar_lotes(cola):
+    while True:
+        lote = [cola.get()]
+        limite = time.monotonic() + config.TRAZAS_INTERVALO_ENVIO
+        while len(lote) < config.TRAZAS_TAMANO_LOTE:
+            try:
+                lote.append(cola.get(timeout=max(0, limite - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            exportar(lote)
+        except Exception as e:
+            print(f"Error exportando {len(lote)} spans: {e}")
+
+
+def _vaciar_cola():
+    """Al salir del proceso, exporta lo que quedó en la cola."""
+    if _cola is None or _pid_exportador != os.getpid():
+        return
+    lote = []
+    while True:
+        try:
+            lote.append(_cola.get_nowait())
+        except queue.Empty:
+            break
+    if lote:
+        try:
+            exportar(lote)
+        except Exception as e:
+            print(f"Error exportando {len(lote)} spans al salir: {e}")
+
+
+atexit.register(_vaciar_cola)
+
+
+def cuerpo_otlp(spans):
+    """ExportTraceServiceRequest en OTLP/JSON."""
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': [
+                _atributo_otlp('service.name', config.TRAZAS_SERVICIO),
+                _atributo_otlp('process.pid', os.getpid()),
+            ]},
+            'scopeSpans': [{
+                'scope': {'name': 'ecommerce-flask.trazas'},
+                'spans': [span.a_otlp() for span in spans]
+            }]
+        }]
+    }
+
+
+def exportar(spans):
+    datos = json.dumps(cuerpo_otlp(spans), separators=(',', ':'))
+    if config.TRAZAS_EXPORTADOR == 'archivo':
+        directorio = os.path.dirname(config.TRAZAS_ARCHIVO)
+        if directorio == config.DIRECTORIO_PRIVADO and directorio_privado(directorio) is None:
+            raise RuntimeError(f'{directorio} no es un directorio privado')
+        # Sin seguir enlaces simbólicos y, si se crea, legible solo por el usuario del proceso
+        descriptor = os.open(
+            config.TRAZAS_ARCHIVO, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600
+        )
+        with os.fdopen(descriptor, 'a', encoding='utf-8') as archivo:
+            archivo.write(datos + '\n')
+    elif config.TRAZAS_EXPORTADOR == 'otlp':
+        solicitud = urllib.request.Request(
+            config.TRAZAS_OTLP_URL, data=datos.encode('utf-8'), headers={'Content-Type': 'application/json'}
+        )
+        with urllib.request.urlopen(solicitud, timeout=config.TRAZAS_OTLP_TIMEOUT):
+            pass
@@ -0,0 +1,345 @@
+# ecommerce-flask/verificar_indices.py
+#
+# Verifica que ninguna lectura de database.py se convierta en un recorrido completo de colección.
+# Llena una base de datos aparte con datos sintéticos, crea los índices de crear_indices(),
+# ejecuta cada función pública de lectura capturando los comandos que envía a MongoDB y corre
+# explain("executionStats") sobre cada uno. Falla (código de salida 1) si algún plan sobre una
+# colección con más de --umbral documentos tiene COLLSCAN, un SORT en memoria o un $lookup sin
+# índice, salvo las excepciones de PERMITIDOS, o si hay una función pública de database.py que no
+# esté ni en LECTURAS ni en NO_LECTURAS.
+#
+#   python verificar_indices.py --documentos 5000 --umbral 1000
+#
+# Necesita un servidor MongoDB real (mongomock no implementa explain). Usa la base de datos
+# MONGO_DB_INDICES (ecommerce_indices por defecto), nunca MONGO_DB, y se niega a tocar una cuyo
+# nombre no termine en _indices.
+
+import argparse
+import os
+import random
+import sys
+import threading
+from datetime import datetime, timedelta
+
+# Siempre una base de datos propia: sembrar() la borra completa. MONGO_DB no se respeta a propósito.
+os.environ['MONGO_DB'] = os.environ.get('MONGO_DB_INDICES', 'ecommerce_indices')
+os.environ.setdefault('CONSULTAS_LENTAS_ACTIVAS', '0')
+os.environ.setdefault('TRAZAS_EXPORTADOR', '')
+os.environ.setdefault('CACHE_BUS_ACTIVO', '0')
+
+from bson import ObjectId  # noqa: E402
+from pymongo import monitoring  # noqa: E402
+
+from consultas_lentas import comando_para_explain, resumir_explicacion, forma_comando  # noqa: E402
+
+_COMANDOS_LECTURA = ('find', 'aggregate', 'count', 'distinct')
+
+
+class _Capturador(monitoring.CommandListener):
+    """Guarda los comandos de lectura enviados mientras 'activo' está encendido (mismo hilo)."""
+
+    def __init__(self):
+        self.activo = False
+        self.comandos = []
+        self._hilo = None
+
+    def iniciar(self):
+        self.comandos = []
+        self._hilo = threading.get_ident()
+        self.activo = True
+
+    def detener(self):
+        self.activo = False
+        return self.comandos
+
+    def started(self, event):
+        if self.activo and threading.get_ident() == self._hilo and event.command_name in _COMANDOS_LECTURA:
+            self.comandos.append((event.database_name, event.command_name, dict(event.command)))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# Se registra antes de crear el MongoClient de database.py
+_capturador = _Capturador()
+monitoring.register(_capturador)
+
+import database  # noqa: E402  (debe importarse después de fijar MONGO_DB y registrar el capturador)
+from cache import vaciar_cache  # noqa: E402
+
+
+# --- Casos ---
+# Argumentos de cada función de lectura a partir de la muestra de ids sembrados. Toda función
+# pública de database.py debe estar en LECTURAS o en NO_LECTURAS; una nueva que no esté en
+# ninguna de las dos hace fallar la verificación hasta que alguien decida dónde va.
+
+LECTURAS = {
+    'obtener_usuario_por_correo': lambda m: (m['correo'],),
+    'obtener_usuario_por_id': lambda m: (m['usuario_id'],),
+    'login_bloqueado': lambda m: (m['correo'], '10.0.0.1'),
+    'obtener_usuarios': lambda m: (),
+    'obtener_categorias': lambda m: (),
+    'obtener_categoria_por_id': lambda m: (m['categoria_id'],),
+    'obtener_productos': lambda m: (),
+    'obtener_productos_por_categoria': lambda m: (m['categoria_id'],),
+    'obtener_producto_por_id': lambda m: (m['producto_id'],),
+    'obtener_producto_catalogo': lambda m: (m['producto_id'],),
+    'obtener_reseñas': lambda m: (),
+    'obtener_reseñas_por_producto': lambda m: (m['producto_id'],),
+    'verificar_usuario_puede_reseñar': lambda m: (m['usuario_id'], m['producto_id']),
+    'usuario_ya_reseño_producto': lambda m: (m['usuario_id'], m['producto_id']),
+    'obtener_todas_las_reseñas_admin': lambda m: (),
+    'obtener_reseña_por_id_admin': lambda m: (m['reseña_id'],),
+    'calcular_promedio_calificacion': lambda m: (m['producto_id'],),
+    'obtener_inventario_disponible': lambda m: (m['producto_id'],),
+    'obtener_inventarios_disponibles': lambda m: ([m['producto_id']],),
+    'obtener_carrito_por_usuario': lambda m: (m['usuario_id'],),
+    'obtener_carrito_invitado': lambda m: ({str(m['producto_id']): 2},),
+    'obtener_todos_los_carritos_admin': lambda m: (),
+    'obtener_carrito_detallado_admin': lambda m: (m['usuario_id'],),
+    'obtener_todos_los_pedidos': lambda m: (),
+    'obtener_pedidos_por_usuario': lambda m: (m['usuario_id'],),
+    'obtener_resumen_pedidos_por_usuario': lambda m: (m['usuario_id'],),
+    'obtener_pedido_por_id': lambda m: (m['pedido_id'],),
+    'verificar_inventario_suficiente': lambda m: (m['producto_id'], 1),
+    'obtener_pedidos_con_usuario': lambda m: (),
+    'obtener_productos_para_pedido': lambda m: (),
+    'construir_lineas_pedido': lambda m: ([{'producto_id': str(m['producto_id']), 'cantidad': 1}],),
+    'obtener_dashboard_ventas': lambda m: (),
+    'obtener_metricas_cola': lambda m: (),
+}
+
+# Escrituras, tareas de mantenimiento y utilidades que no se verifican con explain
+NO_LECTURAS = {
+    # Usuarios y sesiones
+    'crear_usuario', 'actualizar_hash_contrasena', 'registrar_login_fallido', 'limpiar_login_fallidos',
+    # Catálogo e inventario
+    'eliminar_producto', 'establecer_inventario_producto', 'ajustar_inventario_producto',
+    'reducir_inventario_producto', 'activar_inventario_fragmentado', 'desactivar_inventario_fragmentado',
+    'invalidar_cache_productos', 'invalidar_cache_categorias',
+    # Reseñas
+    'crear_reseña', 'eliminar_reseña', 'eliminar_reseña_admin',
+    # Carrito y reservas
+    'agregar_producto_al_carrito_db', 'actualizar_cantidad_carrito', 'eliminar_producto_carrito', 'vaciar_carrito_db',
+    'fusionar_carrito_invitado', 'actualizar_cantidad_producto_carrito_admin', 'eliminar_producto_carrito_admin',
+    'vaciar_carrito_admin', 'eliminar_producto_de_todos_los_carritos', 'barrer_productos_fantasma_carritos',
+    'reservar_inventario', 'liberar_unidades_reservadas', 'liberar_reservas', 'liberar_reservas_vencidas',
+    'confirmar_reservas_carrito', 'cerrar_reservas_confirmadas',
+    # Pedidos y cola de checkout
+    'crear_pedido', 'crear_pedido_desde_admin', 'actualizar_estado_pedido', 'eliminar_pedido',
+    'cambiar_estado_pedidos_lote', 'encolar_checkout', 'tomar_lote_cola', 'procesar_trabajo_checkout',
+    'registrar_resultados_cola', 'reintentar_trabajos_fallidos',
+    # Índices, migraciones y resúmenes (recorren colecciones completas a propósito)
+    'crear_indices', 'migrar_ids_object_id', 'reconstruir_resumenes_ventas', 'reconstruir_productos_comprados',
+    'completar_productos_comprados', 'completar_resumen_carritos', 'completar_resumen_pedidos',
+    # Utilidades sin consultas propias
+    'a_object_id', 'rango_fechas', 'politica_lectura', 'diagnosticar_lecturas',
+}
+
+# Excepciones intencionales: (función, problema) -> motivo. Problemas: 'COLLSCAN', 'SORT', 'LOOKUP'.
+PERMITIDOS = {
+    ('obtener_usuarios', 'COLLSCAN'): 'Lista completa de usuarios para el admin',
+    ('obtener_reseñas', 'COLLSCAN'): 'Lista completa de reseñas',
+    ('obtener_productos', 'COLLSCAN'): 'Catálogo completo; se sirve desde la caché del catálogo',
+    ('obtener_metricas_cola', 'COLLSCAN'): 'Conteo por estado de toda la cola (los completados expiran a la semana)',
+}
+
+
+# --- Datos sintéticos ---
+SUFIJO_BASE = '_indices'
+
+
+def _verificar_base_de_prueba():
+    """Aborta si la base de datos no es una de prueba (su nombre debe terminar en _indices)."""
+    nombre = database._db_primaria.name
+    if not nombre.endswith(SUFIJO_BASE):
+        sys.exit(f"La base de datos '{nombre}' no termina en '{SUFIJO_BASE}'; no se usa para la verificación.")
+
+
+def sembrar(documentos):
+    """Vacía la base de datos de prueba y la llena con ~documentos por colección grande."""
+    _verificar_base_de_prueba()
+    base = database._db_primaria
+    database.client.drop_database(base.name)
+    aleatorio = random.Random(42)
+    ahora = datetime.utcnow()
+    estados = ('pendiente', 'procesando', 'enviado', 'entregado', 'cancelado')
+
+    categorias = [{'_id': ObjectId(), 'nombre': f'Categoría {i}'} for i in range(20)]
+    base.categorias.insert_many(categorias)
+
+    usuarios = [
+        {'_id': ObjectId(), 'nombre': f'Usuario {i}', 'correo': f'usuario{i}@ejemplo.com', 'password': '-', 'rol': 'cliente'}
+        for i in range(documentos)
+    ]
+    base.usuarios.insert_many(usuarios)
+
+    productos = [
+        {
+            '_id': ObjectId(), 'nombre': f'Producto {i}', 'descripcion': 'Producto de prueba',
+            'precio': round(aleatorio.uniform(10, 2000), 2), 'inventario': aleatorio.randint(0, 100),
+            'categoria': aleatorio.choice(categorias)['_id'], 'imagen_url': '', 'activo': True
+        }
+        for i in range(documentos)
+    ]
+    base.productos.insert_many(productos)
+
+    pares = set()
+    while len(pares) < documentos:
+        pares.add((aleatorio.randrange(documentos), aleatorio.randrange(documentos)))
+    base.reseñas.insert_many([
+        {
+            'usuario_id': usuarios[u]['_id'], 'producto_id': productos[p]['_id'],
+            'calificacion': aleatorio.randint(1, 5), 'comentario': 'Reseña de prueba',
+            'fecha': ahora - timedelta(minutes=aleatorio.randrange(525600))
+        }
+        for u, p in pares
+    ])
+
+    pedidos = []
+    for _ in range(documentos):
+        lineas = []
+        for producto in aleatorio.sample(productos, aleatorio.randint(1, 4)):
+            cantidad = aleatorio.randint(1, 3)
+            lineas.append({
+                'producto_id': producto['_id'], 'nombre': producto['nombre'], 'precio': producto['precio'],
+                'cantidad': cantidad, 'subtotal': producto['precio'] * cantidad, 'imagen_url': ''
+            })
+        pedidos.append({
+            'usuario_id': aleatorio.choice(usuarios)['_id'], 'productos': lineas, 'num_productos': len(lineas),
+            'total': sum(linea['subtotal'] for linea in lineas), 'estado': aleatorio.choice(estados),
+            'fecha': ahora - timedelta(minutes=aleatorio.randrange(525600))
+        })
+    base.pedidos.insert_many(pedidos)
+
+    carritos = []
+    for usuario in aleatorio.sample(usuarios, documentos // 2):
+        contenido = [p['_id'] for p in aleatorio.sample(productos, aleatorio.randint(1, 5))]
+        carritos.append({
+            'usuario_id': usuario['_id'], 'productos': contenido, 'total': 0, 'productos_unicos': len(contenido),
+            'cantidad_total': len(contenido), 'fecha_modificacion': ahora - timedelta(minutes=aleatorio.randrange(10000))
+        })
+    base.carrito.insert_many(carritos)
+
+    base.cola_pedidos.insert_many([
+        {
+            'tipo': 'checkout', 'pedido_id': ObjectId(), 'usuario_id': aleatorio.choice(usuarios)['_id'],
+            'estado': aleatorio.choice(('pendiente', 'en_proceso', 'completado', 'fallido')), 'intentos': 0,
+            'disponible_en': ahora, 'creado': ahora - timedelta(seconds=aleatorio.randrange(86400))
+        }
+        for _ in range(documentos)
+    ])
+
+    database.reconstruir_resumenes_ventas()
+    database.crear_indices()
+
+    comprador = base.productos_comprados.find_one()
+    return {
+        'correo': usuarios[0]['correo'],
+        'usuario_id': str(comprador['_id']['usuario_id']) if comprador else str(usuarios[0]['_id']),
+        'producto_id': str(comprador['_id']['producto_id']) if comprador else str(productos[0]['_id']),
+        'categoria_id': str(categorias[0]['_id']),
+        'reseña_id': str(base.reseñas.find_one()['_id']),
+        'pedido_id': str(pedidos[0]['_id']),
+    }
+
+
+# --- Verificación ---
+def _problemas(resumen):
+    problemas = []
+    if resumen['collscan']:
+        problemas.append('COLLSCAN')
+    if resumen['sort_en_memoria']:
+        problemas.append('SORT')
+    if resumen['lookups_sin_indice']:
+        problemas.append('LOOKUP')
+    return problemas
+
+
+def verificar(muestra, umbral):
+    """Ejecuta cada caso y devuelve (resultados, fallas)."""
+    conteos = {}
+    resultados = []
+    fallas = []
+
+    for nombre, argumentos in LECTURAS.items():
+        vaciar_cache()
+        _capturador.iniciar()
+        try:
+            getattr(database, nombre)(*argumentos(muestra))
+        finally:
+            comandos = _capturador.detener()
+        if not comandos:
+            resultados.append((nombre, '-', '-', 'sin consultas', ''))
+
+        for base, comando_nombre, comando in comandos:
+            coleccion = comando.get(comando_nombre)
+            if (base, coleccion) not in conteos:
+                conteos[(base, coleccion)] = database.client[base][coleccion].estimated_document_count()
+            explicacion = database.client[base].command(
+                {'explain': comando_para_explain(comando_nombre, comando), 'verbosity': 'executionStats'}
+            )
+            resumen = resumir_explicacion(explicacion)
+            problemas = _problemas(resumen) if conteos[(base, coleccion)] > umbral else []
+            estado = 'ok'
+            for problema in problemas:
+                motivo = PERMITIDOS.get((nombre, problema))
+                if motivo is None:
+                    estado = 'FALLA'
+                    fallas.append((nombre, coleccion, problema, forma_comando(comando_nombre, comando)))
+                elif estado == 'ok':
+                    estado = f'permitido ({motivo})'
+            resultados.append((
+                nombre, f'{coleccion}.{comando_nombre}', f"{resumen['examinados']}/{resumen['devueltos']}",
+                estado, ' '.join(resumen['etapas'])
+            ))
+
+    sin_caso = sorted(
+        nombre for nombre, funcion in vars(database).items()
+        if callable(funcion) and not nombre.startswith('_') and getattr(funcion, '__module__', None) == 'database'
+        and nombre not in LECTURAS and nombre not in NO_LECTURAS
+    )
+    for nombre in sin_caso:
+        fallas.append((nombre, '-', 'SIN CASO', 'Agrega la función a LECTURAS o a NO_LECTURAS en verificar_indices.py'))
+    return resultados, fallas
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verifica con explain que las lecturas de database.py usen índices')
+    parser.add_argument('--documentos', type=int, default=5000, help='documentos por colección grande')
+    parser.add_argument('--umbral', type=int, default=1000, help='colecciones más chicas no se revisan')
+    parser.add_argument('--sin-sembrar', action='store_true', help='reutiliza los datos de una ejecución anterior')
+    args = parser.parse_args()
+
+    _verificar_base_de_prueba()
+    if args.sin_sembrar:
+        base = database._db_primaria
+        muestra = {
+            'correo': base.usuarios.find_one()['correo'],
+            'usuario_id': str(base.usuarios.find_one()['_id']),
+            'producto_id': str(base.productos.find_one()['_id']),
+            'categoria_id': str(base.categorias.find_one()['_id']),
+            'reseña_id': str(base.reseñas.find_one()['_id']),
+            'pedido_id': str(base.pedidos.find_one()['_id']),
+        }
+    else:
+        print(f"Sembrando {database._db_primaria.name} con {args.documentos} documentos por colección...")
+        muestra = sembrar(args.documentos)
+
+    resultados, fallas = verificar(muestra, args.umbral)
+    for nombre, comando, examinados, estado, etapas in resultados:
+        print(f"{nombre:40} {comando:32} {examinados:>12}  {estado:10}  {etapas}")
+
+    if fallas:
+        print(f"\n{len(fallas)} problema(s):")
+        for nombre, coleccion, problema, forma in fallas:
+            print(f"  {nombre} [{coleccion}] {problema}: {forma}")
+        sys.exit(1)
+    print("\nTodas las lecturas usan índices (o son excepciones permitidas).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# ecommerce-flask/worker_pedidos.py
+#
+# Proceso que finaliza los checkouts encolados por /proceder_pago.
+# Se ejecuta aparte del servidor web (se pueden levantar varios):
+#
+#   python worker_pedidos.py
+
+import time
+
+import config
+from database import (
+    tomar_lote_cola, procesar_trabajo_checkout, registrar_resultados_cola, obtener_metricas_cola
+)
+
+
+def procesar_lote():
+    """Toma un lote de trabajos, los procesa y guarda los resultados. Devuelve cuántos procesó."""
+    trabajos = tomar_lote_cola(config.COLA_TAMANO_LOTE, config.COLA_SEGUNDOS_VISIBILIDAD)
+    resultados = []
+    for trabajo in trabajos:
+        try:
+            procesar_trabajo_checkout(trabajo)
+            resultados.append((trabajo, None))
+        except Exception as e:
+            print(f"Error procesando el pedido {trabajo['pedido_id']} (intento {trabajo['intentos']}): {e}")
+            resultados.append((trabajo, e))
+
+    registrar_resultados_cola(resultados, config.COLA_MAX_INTENTOS)
+    return len(trabajos)
+
+
+def main():
+    print("Worker de pedidos iniciado.")
+    ultimo_reporte = 0
+    while True:
+        try:
+            procesados = procesar_lote()
+            if time.monotonic() - ultimo_reporte > 60:
+                print(f"Cola de pedidos: {obtener_metricas_cola()}")
+                ultimo_reporte = time.monotonic()
+        except Exception as e:
+            print(f"Error en el worker de pedidos: {e}")
+            procesados = 0
+
+        if not procesados:
+            time.sleep(config.COLA_ESPERA_SIN_TRABAJO)
+
+
+if __name__ == '__main__':
+    main()